@@ -0,0 +1,229 @@
+import argparse
+import glob
+import multiprocessing
+import os
+import sys
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import excel
+import export
+import instrument
+import loader
+import main
+import pricestore
+import refcache
+import resultcache
+import stream
+
+
+def collect_inputs(source):
+    """
+    List the input workbooks of a directory or glob pattern.
+
+    Args:
+        source (str): A directory (all .xlsx files in it) or a glob pattern.
+
+    Returns:
+        list: Sorted .xlsx paths, without Excel lock files (~$*.xlsx).
+    """
+    pattern = os.path.join(source, '*.xlsx') if os.path.isdir(source) else source
+    return sorted(
+        path for path in glob.glob(pattern)
+        if path.lower().endswith('.xlsx') and not os.path.basename(path).startswith('~$')
+    )
+
+
+def process_file(input_path, output_dir, write_only=True, use_cache=True, chunk_size=None, export_formats=(),
+                 fast_reader=False, rollup=False, price_store=None):
+    """
+    Process one workbook into a temporary file in output_dir.
+
+    The caller moves the file to its final name, so that two inputs that map
+    to the same output name never write the same path concurrently. Like
+    main.cached_main, an input processed before with the same options is
+    copied from the result cache; runs with export_formats or without
+    use_cache do not use it.
+
+    Args:
+        input_path (str): 輸入 Excel 檔案路徑
+        output_dir (str): 輸出資料夾
+        write_only (bool): See main.write_cost_sheet.
+        use_cache (bool): See main.main; also turns the result cache on or off.
+        chunk_size (int, optional): See main.main.
+        export_formats (list, optional): See main.main; the export files get
+            temporary names next to the temporary output as well.
+        fast_reader (bool): See main.main.
+        rollup (bool): See main.main; not used with chunk_size.
+        price_store (PriceStore, optional): See main.main.
+
+    Returns:
+        dict: output_name, temp_path, export_paths (format -> temporary path),
+              rows and seconds of the job.
+    """
+    start = time.perf_counter()
+    cache = refcache.ReferenceCache() if use_cache else None
+    temp_path = os.path.join(output_dir, f'.batch-{uuid.uuid4().hex}.xlsx')
+    exports = []
+    result_cache = resultcache.ResultCache() if use_cache and not export_formats else None
+    key = None
+    try:
+        exports = export.open_exports(temp_path, export_formats)
+        if chunk_size and price_store is not None:
+            raise ValueError("分段串流模式不支援價格資料庫")
+        if result_cache is not None:
+            key = main.result_key(result_cache, input_path, {'write_only': write_only, 'chunk_size': chunk_size,
+                                                             'rollup': rollup, 'price_store': price_store})
+        hit = result_cache.fetch(key, temp_path) if key is not None else None
+        if hit is not None:
+            output_name = excel.format_output_filename(*loader.peek_output_name(input_path))
+            rows = hit['rows']
+        elif chunk_size:
+            output_name = excel.format_output_filename(*loader.peek_output_name(input_path))
+            metrics = instrument.RunMetrics()
+            stream.stream_cost_sheet(input_path, temp_path, cache, chunk_size, metrics=metrics, exports=exports)
+            rows = metrics.rows
+        else:
+            model = loader.load_cost_model(input_path, cache, fast_reader=fast_reader, price_store=price_store)
+            output_name = excel.get_output_filename(model.base)
+            main.write_cost_sheet(model, temp_path, write_only, exports=exports, rollup=rollup)
+            rows = max(model.base.max_row - 4, 0)
+        if hit is None and key is not None:
+            result_cache.put(key, temp_path, rows)
+    except BaseException:
+        export.abort_exports(exports)
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    return {
+        'output_name': output_name,
+        'temp_path': temp_path,
+        'export_paths': {fmt: export.export_path(temp_path, fmt) for fmt in dict.fromkeys(export_formats)},
+        'rows': rows,
+        'seconds': time.perf_counter() - start,
+    }
+
+
+def unique_output_path(output_dir, output_name, taken):
+    """
+    Get an output path that no other file of this run has used, adding ' (2)', ' (3)', ... if needed.
+    """
+    stem, ext = os.path.splitext(output_name)
+    candidate = output_name
+    n = 2
+    while candidate in taken:
+        candidate = f'{stem} ({n}){ext}'
+        n += 1
+    taken.add(candidate)
+    return os.path.join(output_dir, candidate)
+
+
+def run_batch(inputs, output_dir, workers=None, write_only=True, use_cache=True, chunk_size=None,
+              export_formats=(), fast_reader=False, rollup=False, price_store=None):
+    """
+    Process workbooks on a process pool, continuing past files that fail.
+
+    Args:
+        inputs (list): Input workbook paths.
+        output_dir (str): 輸出資料夾
+        workers (int, optional): Number of worker processes, defaults to the CPU count.
+        write_only (bool): See main.write_cost_sheet.
+        use_cache (bool): See main.main.
+        chunk_size (int, optional): See main.main.
+        export_formats (list, optional): See main.main.
+        fast_reader (bool): See main.main.
+        rollup (bool): See main.main.
+        price_store (PriceStore, optional): See main.main.
+
+    Returns:
+        list: One dict per input with input, output, rows, seconds and error (None on success).
+    """
+    results = []
+    taken = set()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(process_file, path, output_dir, write_only, use_cache, chunk_size,
+                                   export_formats, fast_reader, rollup, price_store): path for path in inputs}
+        for future in as_completed(futures):
+            input_path = futures[future]
+            try:
+                job = future.result()
+            except Exception as e:
+                results.append({'input': input_path, 'output': None, 'rows': 0,
+                                'seconds': None, 'error': str(e) or type(e).__name__})
+                continue
+            output_path = unique_output_path(output_dir, job['output_name'], taken)
+            try:
+                os.replace(job['temp_path'], output_path)
+                for fmt, temp_export in job['export_paths'].items():
+                    os.replace(temp_export, export.export_path(output_path, fmt))
+            except OSError as e:
+                # E.g. the output is open in Excel: this file fails, the others go on.
+                for path in (job['temp_path'], *job['export_paths'].values()):
+                    if os.path.exists(path):
+                        os.remove(path)
+                results.append({'input': input_path, 'output': None, 'rows': 0,
+                                'seconds': job['seconds'], 'error': str(e)})
+                continue
+            results.append({'input': input_path, 'output': output_path, 'rows': job['rows'],
+                            'seconds': job['seconds'], 'error': None})
+    results.sort(key=lambda r: r['input'])
+    return results
+
+
+def print_summary(results, elapsed):
+    """
+    Print throughput, failures and per-file timings of a batch run.
+    """
+    done = [r for r in results if r['error'] is None]
+    failed = [r for r in results if r['error'] is not None]
+    rows = sum(r['rows'] for r in done)
+    print(f'完成 {len(done)}/{len(results)} 個檔案，耗時 {elapsed:.2f} 秒'
+          f'（{len(done) / elapsed:.2f} 檔/秒，{rows / elapsed:.0f} 列/秒）')
+
+    print('各檔案耗時：')
+    for r in done:
+        print(f"  {os.path.basename(r['input'])}: {r['seconds']:.2f} 秒，{r['rows']} 列 -> {os.path.basename(r['output'])}")
+
+    if failed:
+        print(f'失敗 {len(failed)} 個：')
+        for r in failed:
+            print(f"  {os.path.basename(r['input'])}: {r['error']}")
+
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description='批次處理資料夾中的 ERP 成本結構表')
+    parser.add_argument('source', help='輸入資料夾或萬用字元路徑，例如 "exports/*.xlsx"')
+    parser.add_argument('output_dir', help='輸出資料夾')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='同時處理的程序數（預設為 CPU 核心數）')
+    parser.add_argument('--no-cache', action='store_true', help='不使用參照表快取，每次重新解析')
+    parser.add_argument('--chunk-size', type=int, default=None,
+                        help='以固定列數分段讀取、計算並寫出，記憶體用量不隨檔案大小增加（適用超大 BOM）')
+    parser.add_argument('--export', action='append', choices=export.EXPORT_FORMATS, default=[],
+                        help='另外輸出計算結果的 CSV、JSON 或 Parquet 檔（可重複指定）')
+    parser.add_argument('--fast-reader', action='store_true',
+                        help='以 lxml 直接讀取輸入檔，速度約快一倍；無法讀取時自動改用 openpyxl')
+    parser.add_argument('--rollup', action='store_true',
+                        help='另外輸出「組件小計」工作表，列出每個組件（含所有下階）的成本小計')
+    pricestore.add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    inputs = collect_inputs(args.source)
+    if not inputs:
+        print(f'找不到輸入檔案: {args.source}')
+        return 1
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    start = time.perf_counter()
+    results = run_batch(inputs, args.output_dir, args.workers, use_cache=not args.no_cache,
+                        chunk_size=args.chunk_size, export_formats=args.export,
+                        fast_reader=args.fast_reader, rollup=args.rollup,
+                        price_store=pricestore.from_arguments(args))
+    print_summary(results, time.perf_counter() - start)
+    return 1 if any(r['error'] for r in results) else 0
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(cli())
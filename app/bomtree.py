@@ -0,0 +1,201 @@
+import math
+
+import numpy as np
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
+from openpyxl.utils import get_column_letter
+
+import excel
+
+LEVEL_MARK = '。'
+ROLLUP_SHEET = '組件小計'
+ROLLUP_HEADERS = ['查詢品號', '階次及子件料號', '本地品名', '階層', '列號', '下階項數', '本身合計', '組件小計']
+ROLLUP_WIDTHS = [14, 24, 24, 6, 8, 10, 14, 14]
+SUBTOTAL_LETTER = get_column_letter(len(ROLLUP_HEADERS))
+# Output column of 合計 on the cost sheet, and the rows of the first BOM node.
+TOTAL_LETTER = 'S'
+BASE_FIRST_ROW = 5
+OUTPUT_FIRST_ROW = 3
+
+
+def level_of(value):
+    """
+    Get the BOM depth of a 階次及子件料號 value: the number of leading 。 marks.
+
+    Returns:
+        int: 0 for a top-level item, None for a blank value.
+    """
+    if value is None or value == '':
+        return None
+    text = str(value)
+    return len(text) - len(text.lstrip(LEVEL_MARK))
+
+
+class BomTree:
+    """
+    The BOM of 標準成本結構表 as parallel arrays in row order, node i being
+    base row 5 + i (output row 3 + i).
+
+    parent holds the index of the nearest earlier node of a smaller depth (-1
+    for top-level items), so a depth that skips levels still hangs under the
+    last shallower item. A node's descendants are the nodes after it up to
+    end, which is the range its subtotal covers on the cost sheet. Rows
+    without a 階次及子件料號 count as parts right under the current top-level item.
+    """
+
+    def __init__(self, values):
+        """
+        Args:
+            values (list): Column A of 標準成本結構表 from row 5 on.
+        """
+        self.values = list(values)
+        count = len(self.values)
+        depths = [0] * count
+        parents = [-1] * count
+        ends = [count - 1] * count
+        roots = list(range(count))
+
+        # One pass with a stack of the open ancestors of the current row.
+        stack = []
+        for i, value in enumerate(self.values):
+            depth = level_of(value)
+            if depth is None:
+                depth = 1 if stack else 0
+            while stack and depths[stack[-1]] >= depth:
+                ends[stack.pop()] = i - 1
+            depths[i] = depth
+            if stack:
+                parents[i] = stack[-1]
+                roots[i] = roots[stack[-1]]
+            stack.append(i)
+
+        self.depth = np.array(depths, dtype=np.int32)
+        self.parent = np.array(parents, dtype=np.int64)
+        self.end = np.array(ends, dtype=np.int64)
+        self.root = np.array(roots, dtype=np.int64)
+
+        # Nodes grouped by depth, deepest first, for the bottom-up passes.
+        order = np.argsort(-self.depth, kind='stable')
+        bounds = np.flatnonzero(np.diff(self.depth[order])) + 1
+        self.levels = [level for level in np.split(order, bounds) if len(level)]
+
+    @classmethod
+    def from_base(cls, base):
+        """
+        Build the tree of a parsed 標準成本結構表 sheet.
+        """
+        values = list(base.column_values(1, min_row=BASE_FIRST_ROW))
+        return cls(values[:max(base.max_row - BASE_FIRST_ROW + 1, 0)])
+
+    def __len__(self):
+        return len(self.depth)
+
+    def assemblies(self):
+        """
+        Get the nodes with at least one child, in row order.
+
+        Returns:
+            ndarray: Node indexes.
+        """
+        return np.flatnonzero(self.end > np.arange(len(self)))
+
+    def roll_up(self, values):
+        """
+        Add the values of every node's descendants to it, one depth level at a time.
+
+        NaN (a #VALUE! 合計) propagates to all ancestors, as it does in Excel.
+
+        Args:
+            values (ndarray): One float per node.
+
+        Returns:
+            ndarray: Subtree sums, one per node.
+        """
+        sums = np.array(values, dtype=float)
+        count = len(self)
+        for level in self.levels:
+            children = level[self.parent[level] >= 0]
+            if len(children):
+                sums += np.bincount(self.parent[children], weights=sums[children], minlength=count)
+        return sums
+
+
+def node_totals(totals):
+    """
+    Turn the 合計 values of the output rows into floats for BomTree.roll_up.
+
+    Args:
+        totals (list): One 合計 per node; None or blank for the first row, FORMULA_ERROR for #VALUE!.
+
+    Returns:
+        ndarray: The values, NaN for #VALUE!.
+    """
+    values = np.zeros(len(totals))
+    for i, total in enumerate(totals):
+        if total == excel.FORMULA_ERROR:
+            values[i] = np.nan
+        elif isinstance(total, (int, float)):
+            values[i] = total
+    return values
+
+
+def _sheet_ref(title):
+    return "'" + title.replace("'", "''") + "'"
+
+
+def write_rollup_sheet(wb, tree, base, totals, cost_sheet_title):
+    """
+    Append a 組件小計 sheet: one line per assembly with its own 合計 and the
+    subtotal of its whole subtree.
+
+    The subtotal is a SUM over the subtree's 合計 cells on the cost sheet, so
+    it follows edits made in Excel; the rolled-up value is returned to be
+    saved as the formula's cached result.
+
+    Args:
+        wb (Workbook): Workbook holding the cost sheet, write-only or not.
+        tree (BomTree): The BOM tree of base.
+        base (BaseSheet): The parsed 標準成本結構表 sheet.
+        totals (list): 合計 of each node, see node_totals.
+        cost_sheet_title (str): Title of the cost sheet the formulas refer to.
+
+    Returns:
+        tuple: (sheet, cached), cached holding the subtotal of each 小計 cell
+               by coordinate, to save with xlsx.save_workbook.
+    """
+    ws = wb.create_sheet(ROLLUP_SHEET)
+    for col, width in enumerate(ROLLUP_WIDTHS, start=1):
+        ws.column_dimensions[get_column_letter(col)].width = width
+    ws.freeze_panes = 'A2'
+    bold = Font(bold=True)
+
+    def cell(value, number_format=None, font=None):
+        result = WriteOnlyCell(ws, value=value)
+        if number_format:
+            result.number_format = number_format
+        if font is not None:
+            result.font = font
+        return result
+
+    own = node_totals(totals)
+    subtotals = tree.roll_up(own)
+    sheet_ref = _sheet_ref(cost_sheet_title)
+    ws.append([cell(title, font=bold) for title in ROLLUP_HEADERS])
+    cached = {}
+    for row, node in enumerate(tree.assemblies().tolist(), start=2):
+        first, last = node + OUTPUT_FIRST_ROW, int(tree.end[node]) + OUTPUT_FIRST_ROW
+        own_value = excel.FORMULA_ERROR if math.isnan(own[node]) else float(own[node])
+        subtotal = excel.FORMULA_ERROR if math.isnan(subtotals[node]) else float(subtotals[node])
+        formula = f'=SUM({sheet_ref}!{TOTAL_LETTER}{first}:{TOTAL_LETTER}{last})'
+        ws.append([
+            tree.values[int(tree.root[node])],
+            tree.values[node],
+            base.value(node + BASE_FIRST_ROW, 2),
+            int(tree.depth[node]),
+            first,
+            last - first,
+            cell(own_value, '0.00'),
+            cell(formula, '0.00'),
+        ])
+        cached[f'{SUBTOTAL_LETTER}{row}'] = subtotal
+    return ws, cached
@@ -0,0 +1,111 @@
+import argparse
+import json
+import os
+import sys
+import urllib.error
+import urllib.request
+from urllib.parse import unquote
+
+DEFAULT_URL = 'http://127.0.0.1:8765'
+TIMEOUT = 600
+
+
+class ServiceError(Exception):
+    """
+    An error response of the cost service, with its HTTP status.
+    """
+
+    def __init__(self, status, message):
+        super().__init__(f'{status} {message}')
+        self.status = status
+        self.message = message
+
+
+def _open(request):
+    try:
+        return urllib.request.urlopen(request, timeout=TIMEOUT)
+    except urllib.error.HTTPError as e:
+        try:
+            message = json.loads(e.read().decode('utf-8')).get('error', e.reason)
+        except ValueError:
+            message = e.reason
+        raise ServiceError(e.code, message)
+
+
+def output_name(response):
+    """
+    Get the output file name from the Content-Disposition header of a response.
+    """
+    disposition = response.headers.get('Content-Disposition', '')
+    for part in disposition.split(';'):
+        part = part.strip()
+        if part.startswith("filename*=UTF-8''"):
+            return unquote(part[len("filename*=UTF-8''"):])
+    return None
+
+
+def calculate(input_path, url=DEFAULT_URL, summary=False):
+    """
+    Send a workbook to the cost service.
+
+    Args:
+        input_path (str): 輸入 Excel 檔案路徑
+        url (str): Base URL of the service.
+        summary (bool): Ask for the JSON summary instead of the xlsx.
+
+    Returns:
+        tuple: (output_name, content) – content is the xlsx bytes, or the
+               summary dict when summary is set.
+    """
+    with open(input_path, 'rb') as f:
+        body = f.read()
+    request = urllib.request.Request(f"{url.rstrip('/')}/cost?format={'json' if summary else 'xlsx'}",
+                                     data=body, method='POST',
+                                     headers={'Content-Type': 'application/octet-stream'})
+    with _open(request) as response:
+        content = response.read()
+        if summary:
+            result = json.loads(content.decode('utf-8'))
+            return result.get('output_name'), result
+        return output_name(response), content
+
+
+def get_json(path, url=DEFAULT_URL):
+    """
+    GET a JSON endpoint of the service, e.g. '/metrics'.
+    """
+    with _open(urllib.request.Request(f"{url.rstrip('/')}{path}")) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description='呼叫本機 HTTP 成本計算服務')
+    parser.add_argument('inputs', nargs='*', help='輸入 Excel 檔案')
+    parser.add_argument('--url', default=DEFAULT_URL, help=f'服務位址（預設 {DEFAULT_URL}）')
+    parser.add_argument('-o', '--output-dir', default='.', help='輸出資料夾')
+    parser.add_argument('--json', action='store_true', help='只取得 JSON 摘要，不下載輸出檔')
+    parser.add_argument('--metrics', action='store_true', help='顯示服務的 /metrics')
+    args = parser.parse_args(argv)
+
+    failed = 0
+    for input_path in args.inputs:
+        try:
+            name, content = calculate(input_path, args.url, args.json)
+        except (ServiceError, OSError) as e:
+            print(f'{os.path.basename(input_path)}: 失敗 {e}')
+            failed += 1
+            continue
+        if args.json:
+            print(json.dumps(content, ensure_ascii=False, indent=2))
+        else:
+            output_path = os.path.join(args.output_dir, name or 'ERP成本計算結果.xlsx')
+            with open(output_path, 'wb') as f:
+                f.write(content)
+            print(f'{os.path.basename(input_path)} -> {output_path}')
+    if args.metrics:
+        print(json.dumps(get_json('/metrics', args.url), ensure_ascii=False, indent=2))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(cli())
@@ -0,0 +1,367 @@
+import argparse
+import json
+import os
+import sys
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
+from openpyxl.utils import get_column_letter
+
+import excel
+import export
+import incremental
+import instrument
+import loader
+import refcache
+from writer import BASE_FIRST_ROW, COPIED_COLUMNS
+
+REPORT_SHEET = '成本差異'
+REPORT_HEADERS = ['變動', '查詢品號', '階次及子件料號', '本地品名', '舊列號', '新列號', '變動內容', '舊合計', '新合計', '差額']
+REPORT_WIDTHS = [8, 14, 22, 20, 8, 8, 60, 12, 12, 12]
+CHANGE_LABELS = {'added': '新增', 'removed': '刪除', 'changed': '變更'}
+SIDE_LABELS = ('舊版', '新版')
+# 標準成本結構表 column -> its title in the output, e.g. 4 -> '材質'.
+FIELD_NAMES = {src: export.EXPORT_COLUMNS[dest - 1] for dest, src in COPIED_COLUMNS.items()}
+REFERENCE_FIELD = '參照資料'
+COST_KEYS = ('weight', 'material', 'iron', 'iron_mm')
+PRINTED_ROWS = 20
+
+
+def part_number(value):
+    """
+    Get the part number of a 階次及子件料號 value: the value without its level marks (。).
+    """
+    return value.lstrip('。') if isinstance(value, str) else value
+
+
+def row_keys(base):
+    """
+    Key every BOM row for the hash join by (query label, part number, occurrence).
+
+    The query label is the parent label get_labels_and_numbers gives the row.
+    The occurrence counts earlier rows with the same label and part number,
+    so a part used twice under one parent pairs up in order.
+
+    Args:
+        base (BaseSheet): The parsed 標準成本結構表 sheet.
+
+    Returns:
+        dict: key -> row number, in row order from row 6 to base.max_row.
+    """
+    labels = incremental.query_labels(base)
+    seen = Counter()
+    keys = {}
+    for base_row in range(BASE_FIRST_ROW + 1, base.max_row + 1):
+        index = base_row - BASE_FIRST_ROW
+        label = labels[index] if index < len(labels) else None
+        part = (label, part_number(base.rows[base_row - 1][0]))
+        keys[(*part, seen[part])] = base_row
+        seen[part] += 1
+    return keys
+
+
+def changed_materials(old_tables, new_tables):
+    """
+    Get the materials whose reference data differs between two inputs.
+
+    Returns:
+        set: repr(material) of every changed material, or None when the 米數
+             table error differs, which affects every material.
+    """
+    if repr(old_tables.mm_error) != repr(new_tables.mm_error):
+        return None
+    old = incremental.material_signatures(old_tables)
+    new = incremental.material_signatures(new_tables)
+    return {material for material in old.keys() | new.keys() if old.get(material) != new.get(material)}
+
+
+def row_cost(base, tables, row):
+    """
+    Calculate one BOM row as the output does: calculate_row, then the 合計 formula.
+
+    Args:
+        base (BaseSheet): The parsed 標準成本結構表 sheet.
+        tables (ReferenceTables): Indexed reference sheets.
+        row (int): Row number in base.
+
+    Returns:
+        dict: weight, material, iron and iron_mm (None when the row is not
+              calculated), and total, excel.FORMULA_ERROR where Excel gives #VALUE!.
+    """
+    res = excel.calculate_row(base, tables, row)
+    costs = dict(zip(COST_KEYS, res if res is not None else (None,) * len(COST_KEYS)))
+    iron, iron_mm = ('', '') if res is None else (res[2], res[3])
+    _, costs['total'] = excel.row_formula_values(base.value(row, 8), iron, iron_mm, None, None, base.value(row, 9))
+    return costs
+
+
+def _side_cost(model, row, side):
+    try:
+        return row_cost(model.base, model.tables, row)
+    except Exception as e:
+        raise Exception(f'{SIDE_LABELS[side]}：{e}')
+
+
+def _delta(old_cost, new_cost):
+    totals = [0 if cost is None else cost['total'] for cost in (old_cost, new_cost)]
+    if excel.FORMULA_ERROR in totals:
+        return None
+    return totals[1] - totals[0]
+
+
+def diff_models(old, new, metrics=None):
+    """
+    Compare two versions of a BOM and cost only the rows that differ.
+
+    Rows are paired by row_keys. A paired row is changed when one of columns
+    A–I differs. When only the reference data of its material differs between
+    the two inputs, it is calculated on both sides and changed if its costs
+    are. Other rows are not calculated at all.
+
+    Args:
+        old (CostModel): The earlier input.
+        new (CostModel): The revised input.
+        metrics (RunMetrics, optional): Receives the diff and calculate_costs
+            timings and rows_calculated.
+
+    Returns:
+        dict: summary (row counts per change, total_delta: the change of the
+              sum of 合計, errors: rows whose 合計 is #VALUE!) and rows: one dict
+              per added, removed or changed row with change, label, part, name,
+              old_row, new_row, fields ([field, old, new] of each changed column),
+              old and new (see row_cost) and delta.
+    """
+    metrics = metrics or instrument.RunMetrics()
+    with metrics.phase('diff'):
+        old_keys = row_keys(old.base)
+        new_keys = row_keys(new.base)
+        materials = changed_materials(old.tables, new.tables)
+        old_rows, new_rows = old.base.rows, new.base.rows
+        pending = []
+        for key, new_row in new_keys.items():
+            old_row = old_keys.get(key)
+            if old_row is None:
+                pending.append(('added', key, None, new_row, []))
+                continue
+            old_values, new_values = old_rows[old_row - 1], new_rows[new_row - 1]
+            material = new_values[3]
+            reference = material is not None and (materials is None or (materials and repr(material) in materials))
+            if old_values == new_values and not reference:
+                continue
+            fields = [[FIELD_NAMES[col], a, b]
+                      for col, (a, b) in enumerate(zip(old_values, new_values), start=1) if a != b]
+            if reference:
+                fields.append([REFERENCE_FIELD, material, material])
+            pending.append(('changed', key, old_row, new_row, fields))
+        pending.extend(('removed', key, old_row, None, [])
+                       for key, old_row in old_keys.items() if key not in new_keys)
+
+    rows = []
+    with metrics.phase('calculate_costs'):
+        for change, (label, part, _), old_row, new_row, fields in pending:
+            old_cost = None if old_row is None else _side_cost(old, old_row, 0)
+            new_cost = None if new_row is None else _side_cost(new, new_row, 1)
+            metrics.count('rows_calculated', (old_cost is not None) + (new_cost is not None))
+            if fields and fields[0][0] == REFERENCE_FIELD and old_cost == new_cost:
+                # Only the reference data changed, and not the part this row uses.
+                continue
+            name = (new if new_row is not None else old).base.value(new_row or old_row, 2)
+            rows.append({'change': change, 'label': label, 'part': part, 'name': name,
+                         'old_row': old_row, 'new_row': new_row, 'fields': fields,
+                         'old': old_cost, 'new': new_cost, 'delta': _delta(old_cost, new_cost)})
+
+    counts = Counter(row['change'] for row in rows)
+    deltas = [row['delta'] for row in rows]
+    summary = {
+        'old_rows': len(old_keys),
+        'new_rows': len(new_keys),
+        'added': counts['added'],
+        'removed': counts['removed'],
+        'changed': counts['changed'],
+        'unchanged': len(new_keys) - counts['added'] - counts['changed'],
+        'total_delta': sum(delta for delta in deltas if delta is not None),
+        'errors': deltas.count(None),
+    }
+    metrics.rows = len(old_keys) + len(new_keys)
+    return {'summary': summary, 'rows': rows}
+
+
+def _load(path, use_cache):
+    cache = refcache.ReferenceCache() if use_cache else None
+    return loader.load_cost_model(path, cache, fast_reader=True, values_only=True)
+
+
+def diff_workbooks(old_path, new_path, workers=None, use_cache=True, metrics=None):
+    """
+    Load two versions of an input workbook and compare them, see diff_models.
+
+    Only the values of 標準成本結構表 are read. With more than one CPU the two
+    workbooks are loaded at the same time in worker processes.
+
+    Args:
+        old_path (str): The earlier input.
+        new_path (str): The revised input.
+        workers (int, optional): 1 loads both in this process; defaults to 2
+            when there is more than one CPU.
+        use_cache (bool): Reuse parsed reference sheets from the on-disk cache.
+        metrics (RunMetrics, optional): Receives the load, diff and calculate_costs timings.
+
+    Returns:
+        dict: The report, with the two paths added as old and new.
+    """
+    metrics = metrics or instrument.RunMetrics()
+    if workers is None:
+        workers = min(2, os.cpu_count() or 1)
+    with metrics.phase('load'):
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=2) as executor:
+                futures = [executor.submit(_load, path, use_cache) for path in (old_path, new_path)]
+                old, new = [future.result() for future in futures]
+        else:
+            old, new = [_load(path, use_cache) for path in (old_path, new_path)]
+    return {'old': old_path, 'new': new_path, **diff_models(old, new, metrics)}
+
+
+def _total(cost):
+    return None if cost is None else export.plain_value(cost['total'])
+
+
+def format_number(value):
+    """
+    Format a cost for the messages, e.g. 1234.5 -> '1,234.50'; #VALUE! and blanks as they are.
+    """
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return f'{value:,.2f}'
+    return '' if value is None else str(value)
+
+
+def format_fields(row):
+    """
+    Describe the changed columns of a row, e.g. '厚度 5 → 6；累計用量[含損耗] 2 → 3'.
+    """
+    parts = []
+    for field, old, new in row['fields']:
+        if field == REFERENCE_FIELD:
+            parts.append(f'{REFERENCE_FIELD}（材質 {new}）')
+        else:
+            parts.append(f"{field} {'' if old is None else old} → {'' if new is None else new}")
+    return '；'.join(parts)
+
+
+def format_delta(delta):
+    """
+    Format a change of cost with its sign, e.g. '+12.30'; None is #VALUE!.
+    """
+    if delta is None:
+        return excel.FORMULA_ERROR
+    return f"{'+' if delta >= 0 else ''}{format_number(delta)}"
+
+
+def format_row(row):
+    """
+    Describe a changed row on one line, e.g. '變更 P001 C0-4：20.50 → 24.10（+3.60） 厚度 5 → 6'.
+    """
+    text = (f"{CHANGE_LABELS[row['change']]} {row['label']} {row['part']}："
+            f"{format_number(_total(row['old']))} → {format_number(_total(row['new']))}（{format_delta(row['delta'])}）")
+    if row['fields']:
+        text += f' {format_fields(row)}'
+    return text
+
+
+def format_summary(report):
+    """
+    Summarise a report on one line, e.g. '新增 3 列、刪除 1 列、變更 12 列，合計差額 +1,234.50'.
+    """
+    summary = report['summary']
+    text = (f"新增 {summary['added']} 列、刪除 {summary['removed']} 列、變更 {summary['changed']} 列，"
+            f"合計差額 {format_delta(summary['total_delta'])}")
+    if summary['errors']:
+        text += f"（另有 {summary['errors']} 列的合計為 {excel.FORMULA_ERROR}）"
+    return text
+
+
+def write_report(report, output_path):
+    """
+    Save a report as a 成本差異 sheet: one line per row that differs, then the counts and the total change.
+
+    Args:
+        report (dict): From diff_workbooks.
+        output_path (str): Report file path.
+    """
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(REPORT_SHEET)
+    for col, width in enumerate(REPORT_WIDTHS, start=1):
+        ws.column_dimensions[get_column_letter(col)].width = width
+    ws.freeze_panes = 'A2'
+    bold = Font(bold=True)
+
+    def bold_row(values):
+        cells = []
+        for value in values:
+            cell = WriteOnlyCell(ws, value=value)
+            cell.font = bold
+            cells.append(cell)
+        return cells
+
+    def number_cell(value):
+        cell = WriteOnlyCell(ws, value=value)
+        if isinstance(value, (int, float)):
+            cell.number_format = '0.00'
+        return cell
+
+    ws.append(bold_row(REPORT_HEADERS))
+    for row in report['rows']:
+        ws.append([CHANGE_LABELS[row['change']], row['label'], row['part'], row['name'],
+                   row['old_row'], row['new_row'], format_fields(row),
+                   number_cell(_total(row['old'])), number_cell(_total(row['new'])),
+                   number_cell(row['delta'] if row['delta'] is not None else excel.FORMULA_ERROR)])
+    ws.append([])
+    summary = report['summary']
+    for label, value in (('舊版', f"{report['old']}（{summary['old_rows']} 列）"),
+                         ('新版', f"{report['new']}（{summary['new_rows']} 列）"),
+                         *((CHANGE_LABELS[change], summary[change]) for change in CHANGE_LABELS),
+                         ('未變更', summary['unchanged'])):
+        ws.append(bold_row([label]) + [value])
+    ws.append(bold_row(['合計差額']) + [number_cell(summary['total_delta'])])
+    wb.save(output_path)
+
+
+def write_json(report, output_path):
+    """
+    Save a report as JSON, with the structure diff_workbooks returns.
+    """
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2, default=str)
+
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description='比較同一產品兩個版本的 ERP 成本結構表，只計算有變動的列')
+    parser.add_argument('old', help='舊版輸入 Excel 檔案')
+    parser.add_argument('new', help='新版輸入 Excel 檔案')
+    parser.add_argument('--report', default=None, help='另存差異報告 Excel 檔的路徑')
+    parser.add_argument('--json', default=None, help='另存差異報告 JSON 檔的路徑')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='同時讀取兩個檔案的程序數（1 表示依序讀取）')
+    parser.add_argument('--no-cache', action='store_true', help='不使用參照表快取，每次重新解析')
+    args = parser.parse_args(argv)
+
+    metrics = instrument.RunMetrics()
+    report = diff_workbooks(args.old, args.new, args.workers, not args.no_cache, metrics)
+    if args.report:
+        write_report(report, args.report)
+    if args.json:
+        write_json(report, args.json)
+
+    largest = sorted(report['rows'], key=lambda row: -abs(row['delta'] or 0))[:PRINTED_ROWS]
+    for row in largest:
+        print(format_row(row))
+    if len(report['rows']) > PRINTED_ROWS:
+        print(f"...另有 {len(report['rows']) - PRINTED_ROWS} 列有變動")
+    print(f"{format_summary(report)}，耗時 {metrics.as_dict()['seconds']:.2f} 秒")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(cli())
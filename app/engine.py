@@ -0,0 +1,173 @@
+import numpy as np
+import pandas as pd
+
+import excel
+from reference import to_number
+
+INT_PATTERN = r'^[+-]?\d+$'
+FLOAT_PATTERN = r'^[+-]?(?:\d+\.\d*|\.\d+)(?:[eE][+-]?\d+)?$'
+NUMBER_TYPES = (int, float)
+
+
+def coerce_dimensions(series):
+    """
+    Convert a column of 厚度/長/寬 values in bulk, matching calculate_row:
+    strings containing '.' become floats, others ints.
+
+    Values the two patterns do not cover fall back to the scalar conversion.
+
+    Args:
+        series (Series): Object column of raw cell values.
+
+    Returns:
+        tuple: (values, bad) float64 Series and a mask of values that fail to convert.
+    """
+    text = series.astype(str).str.strip()
+    plain = text.str.match(INT_PATTERN) | text.str.match(FLOAT_PATTERN)
+    values = pd.to_numeric(text.where(plain), errors='coerce').astype('float64')
+    bad = pd.Series(False, index=series.index)
+
+    for idx in series.index[~plain]:
+        number = to_number(series[idx])
+        if number is None:
+            bad[idx] = True
+        else:
+            values[idx] = float(number)
+    return values, bad
+
+
+def round2(values):
+    """
+    Round to 2 decimals exactly like Python's round(x, 2).
+
+    np.round scales by 100 and rounds half to even, which can disagree with
+    round() when x * 100 lands on a half; those few values use round().
+
+    Args:
+        values (ndarray): float64 values.
+
+    Returns:
+        ndarray: Rounded values.
+    """
+    scaled = values * 100
+    rounded = np.round(scaled) / 100
+    frac = scaled - np.floor(scaled)
+    near_half = np.abs(frac - 0.5) <= 1e-6 + np.abs(scaled) * 1e-15
+    for idx in np.flatnonzero(near_half):
+        rounded[idx] = round(float(values[idx]), 2)
+    return rounded
+
+
+def reference_frames(tables):
+    """
+    Turn the reference indexes into DataFrames for merging.
+
+    Entries whose values calculate_row could not use (non-numeric coefficient,
+    price or 米數) are left out, so rows that need them come out unmatched.
+
+    Args:
+        tables (ReferenceTables): Indexed reference sheets.
+
+    Returns:
+        tuple: (coefficients, prices, mm) DataFrames.
+    """
+    coefficients = []
+    for material, coefficient in tables.coefficients.items():
+        try:
+            coefficients.append((material, float(coefficient)))
+        except (TypeError, ValueError):
+            pass
+
+    prices = [
+        (material, float(thickness), float(price), round(price, 2))
+        for (material, thickness), price in tables.prices.items()
+        if isinstance(thickness, NUMBER_TYPES) and isinstance(price, NUMBER_TYPES)
+    ]
+
+    mm = []
+    for material, (thicknesses, values) in tables.mm_index.items():
+        seen = set()
+        for thickness, value in zip(thicknesses, values):
+            # Keep the first row of tied thicknesses, as mm_by_thickness does.
+            if thickness in seen:
+                continue
+            seen.add(thickness)
+            if isinstance(value, NUMBER_TYPES):
+                mm.append((material, float(thickness), float(value)))
+
+    return (
+        pd.DataFrame(coefficients, columns=['material', 'coefficient'])
+            .astype({'material': object, 'coefficient': 'float64'}),
+        pd.DataFrame(prices, columns=['material', 'thickness', 'price', 'price_rounded'])
+            .astype({'material': object, 'thickness': 'float64', 'price': 'float64', 'price_rounded': object}),
+        pd.DataFrame(mm, columns=['material', 'mm_thickness', 'mm'])
+            .astype({'material': object, 'mm_thickness': 'float64', 'mm': 'float64'})
+            .sort_values('mm_thickness'),
+    )
+
+
+def calculate_rows(base, tables, base_row, count):
+    """
+    Calculate the costs of a block of BOM rows with array operations.
+
+    Gives the same results as calling excel.calculate_row for each row. When
+    any row fails, the first failing row is re-run through calculate_row so the
+    raised error is identical too.
+
+    Args:
+        base (BaseSheet): The parsed 標準成本結構表 sheet.
+        tables (ReferenceTables): Indexed reference sheets.
+        base_row (int): First BOM row in base.
+        count (int): Number of rows.
+
+    Returns:
+        list: Per row, rounded [weight, material, iron, iron_mm], or None if any of columns D–G is empty.
+    """
+    rows = [base.row_values(i, 4, 7) for i in range(base_row, base_row + count)]
+    df = pd.DataFrame(rows, columns=['material', 'thickness', 'length', 'width'], dtype=object)
+    df['pos'] = np.arange(len(df))
+
+    raw = df[['material', 'thickness', 'length', 'width']]
+    incomplete = (raw.isna() | (raw == '')).any(axis=1)
+    df = df[~incomplete].copy()
+
+    bad = pd.Series(False, index=df.index)
+    for col in ('thickness', 'length', 'width'):
+        df[col], col_bad = coerce_dimensions(df[col])
+        bad |= col_bad
+    df = df[~bad]
+
+    coefficients, prices, mm = reference_frames(tables)
+    df = df.merge(coefficients, on='material', how='left')
+    df = df.merge(prices, on=['material', 'thickness'], how='left')
+    df = pd.merge_asof(df.sort_values('thickness'), mm, left_on='thickness', right_on='mm_thickness',
+                       by='material', direction='forward')
+    if tables.mm_error is not None:
+        df['mm'] = np.nan
+    df = df.sort_values('pos')
+
+    found = df[['coefficient', 'price', 'mm']].notna()
+    for name, col in (('coefficient', 'coefficient'), ('material_price', 'price'), ('mm', 'mm')):
+        tables.lookups[f'{name}_hits'] += int(found[col].sum())
+    matched = found.all(axis=1).to_numpy()
+    df = df[matched]
+
+    thickness = df['thickness'].to_numpy()
+    length = df['length'].to_numpy()
+    width = df['width'].to_numpy()
+    weight = thickness * length * width * df['coefficient'].to_numpy()
+    iron = weight * df['price'].to_numpy()
+    iron_mm = (length + width) * df['mm'].to_numpy() * 2 / 1000
+
+    results = [None] * count
+    columns = zip(round2(weight).tolist(), df['price_rounded'].tolist(),
+                  round2(iron).tolist(), round2(iron_mm).tolist())
+    for pos, res in zip(df['pos'].tolist(), columns):
+        results[pos] = list(res)
+
+    # Complete rows without a result failed a conversion or lookup; the scalar
+    # path raises the same error the row-by-row calculation would.
+    for pos in np.flatnonzero(~incomplete.to_numpy()):
+        if results[pos] is None:
+            results[pos] = excel.calculate_row(base, tables, base_row + int(pos))
+    return results
@@ -1,58 +1,119 @@
+import time
+from decimal import Decimal, ROUND_HALF_UP
 from openpyxl.utils import get_column_letter
 from openpyxl.styles import Alignment, Font, Border, Side, PatternFill
-import re
-
 import style
-
-def write_excel_header(sheet):
+from reference import to_number
+
+DEFAULT_OUTPUT_FILENAME = 'ERP成本計算結果.xlsx'
+FORMULA_ERROR = '#VALUE!'
+
+HEADER_TITLES = [
+    '查詢品號', '展開順序', '階次及子件料號', '本地品名', '自定義欄位一',
+    '規格呎吋', '', '', '',
+    '累計用量[含損耗]', '鐵板重量/片', '材料費/單價', '鐵板材料費/片',
+    '鐵板米數/片', '孔費/片', '折刀/片', '採購單價', '每片小計', '合計'
+]
+HEADER_SUB_TITLES = ['材質', '厚度', '長', '寬']
+
+# (start column, end column, set_style_in_range arguments), applied in order to rows 3..total_row + 3
+BASIC_STYLE_RANGES = [
+    ('A', 'A', {'alignment': Alignment(horizontal='left', vertical='center', wrap_text=True)}),
+    ('B', 'B', {'alignment': Alignment(horizontal='right', vertical='center', wrap_text=True)}),
+    ('C', 'C', {'alignment': Alignment(horizontal='left', vertical='center', wrap_text=True)}),
+    ('D', 'D', {'alignment': Alignment(horizontal='left', vertical='center', wrap_text=True)}),
+    ('E', 'E', {'alignment': Alignment(horizontal='left', vertical='center', wrap_text=True)}),
+    ('F', 'J', {}),
+    ('K', 'N', {'fill': PatternFill(fill_type='solid', start_color='FFF2CC', end_color='FFF2CC')}),
+    ('O', 'P', {'fill': PatternFill(fill_type='solid', start_color='FFFFFF', end_color='FFFFFF')}),
+    ('Q', 'Q', {'fill': PatternFill(fill_type='solid', start_color='D8E4BC', end_color='D8E4BC'), 'format': '0.0000'}),
+    ('R', 'S', {'fill': PatternFill(fill_type='solid', start_color='F4B084', end_color='F4B084')}),
+    ('J', 'J', {'format': '0.00'}),
+]
+# Applied to row 3 only, after BASIC_STYLE_RANGES
+FIRST_ROW_STYLE_RANGES = [
+    ('B', 'D', {'font': Font(color="0000FF", size=9, bold=True),
+                'alignment': Alignment(horizontal='left', vertical='center', wrap_text=True)}),
+]
+# Applied to the two total rows below the data
+TOTAL_STYLE_RANGES = [
+    ('P', 'R', {'fill': PatternFill(fill_type='solid', start_color='F4B084', end_color='F4B084')}),
+    ('R', 'S', {'fill': PatternFill(fill_type='solid', start_color='F4B084', end_color='F4B084')}),
+]
+
+def get_header_style():
     """
-    Write the header of the worksheet with merged cells, titles, styles.
-
-    Args:
-        sheet (Worksheet): The target worksheet to write headers to.
+    Get the style shared by all header cells.
 
     Returns:
-        None
+        tuple: (font, alignment, border, fill)
     """
-    titles = [
-        '查詢品號', '展開順序', '階次及子件料號', '本地品名', '自定義欄位一',
-        '規格呎吋', '', '', '',
-        '累計用量[含損耗]', '鐵板重量/片', '材料費/單價', '鐵板材料費/片',
-        '鐵板米數/片', '孔費/片', '折刀/片', '採購單價', '每片小計', '合計'
-    ]
-    sub_titles = ['材質', '厚度', '長', '寬']
-
-    default_font = Font(color="800000", size=9)
+    font = Font(color="800000", size=9)
     alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
     border = Border(left=Side(style='thin'), right=Side(style='thin'),
                     top=Side(style='thin'), bottom=Side(style='thin'))
     fill = PatternFill(start_color='C0C0C0', end_color='C0C0C0', fill_type='solid')
+    return font, alignment, border, fill
 
-    sheet.merge_cells('F1:I1')
-    cell = sheet['F1']
-    cell.value = '規格呎吋'
-    style.apply_style(cell, default_font, alignment, border, fill)
+def get_header_merges():
+    """
+    Get the merged ranges of the two header rows.
 
-    for idx, title in enumerate(titles):
+    Returns:
+        list: Ranges in A1 notation.
+    """
+    merges = ['F1:I1']
+    for idx, title in enumerate(HEADER_TITLES):
         col = idx + 1
         if col in [6, 7, 8, 9]:
             continue
         if title:
             col_letter = get_column_letter(col)
-            sheet.merge_cells(f'{col_letter}1:{col_letter}2')
-            cell = sheet[f'{col_letter}1']
-            cell.value = title
-            cell.number_format = '0.00'
-            style.apply_style(cell, default_font, alignment, border, fill)
-
-    for i, subtitle in enumerate(sub_titles):
-        col_letter = get_column_letter(6 + i)
-        cell = sheet[f'{col_letter}2']
-        cell.value = subtitle
-        style.apply_style(cell, default_font, alignment, border, fill)
+            merges.append(f'{col_letter}1:{col_letter}2')
+    return merges
+
+def get_header_cells():
+    """
+    Get the styled cells of the two header rows.
+
+    Returns:
+        list: (row, col, value, number_format) tuples; value and number_format
+              are None when the cell keeps its default.
+    """
+    cells = [(1, 6, '規格呎吋', None)]
+    for idx, title in enumerate(HEADER_TITLES):
+        col = idx + 1
+        if col in [6, 7, 8, 9]:
+            continue
+        if title:
+            cells.append((1, col, title, '0.00'))
+
+    sub_titles = dict(enumerate(HEADER_SUB_TITLES, start=6))
+    for col in range(1, len(HEADER_TITLES) + 1):
+        cells.append((2, col, sub_titles.get(col), None))
+    return cells
+
+def write_excel_header(sheet):
+    """
+    Write the header of the worksheet with merged cells, titles, styles.
+
+    Args:
+        sheet (Worksheet): The target worksheet to write headers to.
 
-    for col in range(1, len(titles) + 1):
-        cell = sheet[f'{get_column_letter(col)}2']
+    Returns:
+        None
+    """
+    default_font, alignment, border, fill = get_header_style()
+
+    for cell_range in get_header_merges():
+        sheet.merge_cells(cell_range)
+
+    for row, col, value, number_format in get_header_cells():
+        cell = sheet.cell(row=row, column=col)
+        if value is not None:
+            cell.value = value
+        if number_format:
+            cell.number_format = number_format
         style.apply_style(cell, default_font, alignment, border, fill)
 
 def set_column_widths(sheet):
@@ -66,29 +127,66 @@ def set_column_widths(sheet):
     for col, width in width_map.items():
         sheet.column_dimensions[col].width = width
 
-def set_basic_styles(sheet, total_row):
+def set_basic_styles(sheet, total_row, progress=None):
     """
     Apply basic styles to sheet.
 
     Args:
         sheet (Worksheet): Target worksheet.
         total_row: Total row to filled.
+        progress (Progress, optional): Reports the set_basic_styles phase, one step per styled row of each range.
 
     Returns:
         None
     """
-    style.set_style_in_range(sheet, f'A3:A{total_row + 3}', alignment=Alignment(horizontal='left', vertical='center', wrap_text=True))
-    style.set_style_in_range(sheet, f'B3:B{total_row + 3}', alignment=Alignment(horizontal='right', vertical='center', wrap_text=True))
-    style.set_style_in_range(sheet, f'C3:C{total_row + 3}', alignment=Alignment(horizontal='left', vertical='center', wrap_text=True))
-    style.set_style_in_range(sheet, f'D3:D{total_row + 3}', alignment=Alignment(horizontal='left', vertical='center', wrap_text=True))
-    style.set_style_in_range(sheet, f'E3:E{total_row + 3}', alignment=Alignment(horizontal='left', vertical='center', wrap_text=True))
-    style.set_style_in_range(sheet, f'F3:J{total_row + 3}')
-    style.set_style_in_range(sheet, f'K3:N{total_row + 3}', fill=PatternFill(fill_type='solid', start_color='FFF2CC', end_color='FFF2CC'))
-    style.set_style_in_range(sheet, f'O3:P{total_row + 3}', fill=PatternFill(fill_type='solid', start_color='FFFFFF', end_color='FFFFFF'))
-    style.set_style_in_range(sheet, f'Q3:Q{total_row + 3}', fill=PatternFill(fill_type='solid', start_color='D8E4BC', end_color='D8E4BC'), format='0.0000')
-    style.set_style_in_range(sheet, f'R3:S{total_row + 3}', fill=PatternFill(fill_type='solid', start_color='F4B084', end_color='F4B084'))
-    style.set_style_in_range(sheet, f'J3:J{total_row + 3}', format='0.00')
-    style.set_style_in_range(sheet, f'B3:D3', font=Font(color="0000FF", size=9, bold=True), alignment=Alignment(horizontal='left', vertical='center', wrap_text=True))
+    if progress is not None:
+        progress.start('set_basic_styles', len(BASIC_STYLE_RANGES) * (total_row + 1))
+    for start, end, styles in BASIC_STYLE_RANGES:
+        style.set_style_in_range(sheet, f'{start}3:{end}{total_row + 3}', progress=progress, **styles)
+    for start, end, styles in FIRST_ROW_STYLE_RANGES:
+        style.set_style_in_range(sheet, f'{start}3:{end}3', **styles)
+
+def get_sheet_title(labels, label_name):
+    """
+    Get the output sheet title from the first parent label and the main name.
+
+    Args:
+        labels (list): List of parent labels.
+        label_name (str): The main name.
+
+    Returns:
+        str: The sheet title.
+    """
+    return f'{labels[0]}{label_name[0:5]} (成本計算)'
+
+def get_output_filename(base):
+    """
+    Get the output file name from the first parent label and the main name.
+
+    Args:
+        base (BaseSheet): The parsed 標準成本結構表 sheet.
+
+    Returns:
+        str: The output file name, or DEFAULT_OUTPUT_FILENAME if either is missing.
+    """
+    labels, _ = get_labels_and_numbers(base)
+    label_name = get_main_name(base)
+    return format_output_filename(labels[0] if labels else None, label_name)
+
+def format_output_filename(label, label_name):
+    """
+    Build the output file name from the first parent label and the main name.
+
+    Args:
+        label (str): The first parent label, or None.
+        label_name (str): The main name, or None.
+
+    Returns:
+        str: The output file name, or DEFAULT_OUTPUT_FILENAME if either is missing.
+    """
+    if label and label_name:
+        return f'{label}{label_name}.xlsx'
+    return DEFAULT_OUTPUT_FILENAME
 
 def extract_parent_and_counts(data):
     """
@@ -117,51 +215,45 @@ def extract_parent_and_counts(data):
 
     return parents, counts
 
-def get_column_content(sheet):
+def get_column_content(base):
     """
     Retrieve non-empty values from column A, starting from row 5.
 
     Args:
-        sheet (Worksheet): The target worksheet.
+        base (BaseSheet): The parsed 標準成本結構表 sheet.
 
     Returns:
         list: List of cell values from column A.
     """
-    a_column_values = []
-    for row in sheet.iter_rows(min_row=5, max_row=sheet.max_row, min_col=1, max_col=1):
-        cell = row[0]
-        if cell.value is not None:
-            a_column_values.append(cell.value)
-    return a_column_values
+    return [value for value in base.column_values(1, min_row=5) if value is not None]
 
 
-def get_labels_and_numbers(sheet):
+def get_labels_and_numbers(base):
     """
     Get parent labels and corresponding counts from column A.
 
     Args:
-        sheet (Worksheet): The target worksheet.
+        base (BaseSheet): The parsed 標準成本結構表 sheet.
 
     Returns:
         tuple: (labels, label_counts)
     """
-    values = get_column_content(sheet)
+    values = get_column_content(base)
     return extract_parent_and_counts(values)
 
-def get_main_name(sheet):
+def get_main_name(base):
     """
-    Get the main name from the first non-empty cell in column A.
+    Get the main name from the first non-empty cell in column B.
 
     Args:
-        sheet (Worksheet): The target worksheet.
+        base (BaseSheet): The parsed 標準成本結構表 sheet.
 
     Returns:
         str: The main name.
     """
-    for row in sheet.iter_rows(min_row=5, max_row=sheet.max_row, min_col=2, max_col=2):
-        cell = row[0]
-        if cell.value is not None:
-            return cell.value
+    for value in base.column_values(2, min_row=5):
+        if value is not None:
+            return value
     return ''
 
 def fill_query_no(sheet, labels, label_nums):
@@ -180,153 +272,203 @@ def fill_query_no(sheet, labels, label_nums):
     row = 3
     for label, count in zip(labels, label_nums):
         for _ in range(count):
-            sheet[f'A{row}'] = label
-            sheet[f'B{row}'] = row - 2
+            sheet.cell(row=row, column=1, value=label)
+            sheet.cell(row=row, column=2, value=row - 2)
             row += 1
 
-def get_row_range_values(sheet, row_num, start_col, end_col):
+def row_formulas(row):
     """
-    Retrieve values from a specific row and a range of columns.
+    Get the 每片小計 and 合計 formulas of an output row.
 
-    :param sheet: An openpyxl worksheet object
-    :param row_num: The row number to access (1 = first row)
-    :param start_col: Starting column number (1 = column A)
-    :param end_col: Ending column number (inclusive)
-    :return: List of values from start_col to end_col in the specified row
-    """
-    return [
-        sheet.cell(row=row_num, column=col).value
-        for col in range(start_col, end_col + 1)
-    ]
+    Args:
+        row (int): Output row number.
 
-def find_row_with_multiple_conditions(sheet, conditions, return_cols=None, start_row=2):
+    Returns:
+        tuple: (subtotal_formula, total_formula)
     """
-    Search for the first row matching multiple column-value conditions,
-    and return values from specified columns in that row.
+    return f'=P{row}+O{row}+N{row}+M{row}+Q{row}', f'=R{row}*J{row}'
 
-    :param sheet: openpyxl worksheet object
-    :param conditions: list of (col_number, expected_value) tuples
-                       e.g. [(1, 'ABC123'), (3, 50)]
-    :param return_cols: list of column numbers to return values from
-                        e.g. [2, 4]. If None, return the entire row as values.
-    :param start_row: row number to start searching from (default: 2 to skip header)
-    :return: list of cell values from the matched row (specified columns only),
-             or None if no match is found
+def total_formulas(total_row):
     """
-    for row in sheet.iter_rows(min_row=start_row):
-        if all(row[col - 1].value == expected for col, expected in conditions):
-            if return_cols:
-                return [row[col - 1].value for col in return_cols]
-            else:
-                return [cell.value for cell in row]  # return full row values
-    raise Exception("找不到鐵板材料費單價")
+    Get the 總合計 and 含其它製程費用 formulas below the data rows.
 
+    Args:
+        total_row (int): Number of BOM rows.
 
-def find_value_by_match(sheet, match_col, match_value, return_col, start_row=2):
+    Returns:
+        tuple: (sum_formula, with_process_formula)
     """
-    Search for a specific value in a given column and return the value from another column in the same row.
+    return f'=ROUND(SUM(S4:S{total_row + 3}), 0)', f'=S{total_row + 4}*1.05*1.3'
 
-    :param sheet: An openpyxl worksheet object
-    :param match_col: The column to search in (1 = column A)
-    :param match_value: The value to look for
-    :param return_col: The column to return the value from (1 = column A)
-    :param start_row: The row to start searching from (default is 2, assuming row 1 is the header)
-    :return: The matched row's value from the return_col, or None if not found
+def formula_operand(value):
     """
-    for row in sheet.iter_rows(min_row=start_row):
-        if row[match_col - 1].value == match_value:
-            return row[return_col - 1].value
-    raise Exception("找不到鐵板重量係數")
+    Get a cell value as Excel uses it in + and *: blanks count as 0 and
+    numeric text is converted.
 
+    Returns:
+        int | float: The operand, or None where Excel gives #VALUE!.
+    """
+    if value is None or value == '':
+        return 0
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str):
+        try:
+            return float(value.strip())
+        except ValueError:
+            return None
+    return None
 
-def parse_thickness(thickness_str):
-    if thickness_str is None:
-        return None
+def row_formula_values(quantity, iron, iron_mm, hole, bend, purchase):
+    """
+    Calculate the row_formulas of a row the way Excel does.
 
-    if not isinstance(thickness_str, str):
-        raise TypeError(f"請將鐵板米數計算-厚度: {thickness_str} 更改為格式如 '5T' 的字串")
+    Args:
+        quantity: 累計用量 (J).
+        iron: 鐵板材料費/片 (M).
+        iron_mm: 鐵板米數/片 (N).
+        hole: 孔費/片 (O).
+        bend: 折刀/片 (P).
+        purchase: 採購單價 (Q).
 
-    thickness_str = thickness_str.strip()
+    Returns:
+        tuple: (subtotal, total), FORMULA_ERROR where Excel gives #VALUE!.
+    """
+    operands = [formula_operand(value) for value in (bend, hole, iron_mm, iron, purchase)]
+    if None in operands:
+        return FORMULA_ERROR, FORMULA_ERROR
+    subtotal = operands[0] + operands[1] + operands[2] + operands[3] + operands[4]
+    quantity = formula_operand(quantity)
+    if quantity is None:
+        return subtotal, FORMULA_ERROR
+    return subtotal, subtotal * quantity
+
+def excel_round(value, digits=0):
+    """
+    Round like Excel's ROUND: halves go away from zero, unlike round().
+    """
+    return float(Decimal(repr(value)).quantize(Decimal(1).scaleb(-digits), rounding=ROUND_HALF_UP))
 
-    match_range = re.match(r".*-(\d+(?:\.\d+)?)T", thickness_str)
-    if match_range:
-        thickness_str = f"{match_range.group(1)}T"
+class FormulaTotals:
+    """
+    Running sum of the 合計 values of the rows, for the values of total_formulas.
+    """
 
-    match = re.match(r"([\d\.]+)", thickness_str)
-    if match:
-        return float(match.group(1))
+    def __init__(self):
+        self.sum = 0
+        self.error = False
+
+    def add(self, total):
+        if total == FORMULA_ERROR:
+            self.error = True
+        elif isinstance(total, (int, float)):
+            self.sum += total
+
+    def values(self):
+        """
+        Returns:
+            tuple: (sum_value, with_process_value), as Excel calculates total_formulas.
+        """
+        if self.error:
+            return FORMULA_ERROR, FORMULA_ERROR
+        sum_value = excel_round(self.sum)
+        return sum_value, sum_value * 1.05 * 1.3
+
+def calculate_row(base, tables, i):
+    """
+    Calculate weight, material price, iron cost and 米數 cost of one BOM row.
 
-    return None
+    Args:
+        base (BaseSheet): The parsed 標準成本結構表 sheet.
+        tables (ReferenceTables): Indexed reference sheets.
+        i (int): Row number in base.
 
+    Returns:
+        list: Rounded [weight, material, iron, iron_mm], or None if any of columns D–G is empty.
+    """
+    values = base.row_values(i, 4, 7)
+    if None in values or '' in values:
+        return None
 
-def find_value_by_thickness(sheet, material, input_thickness):
-    candidates = []
-    for row in sheet.iter_rows(min_row=2):
-        cell_material = row[0].value
-        cell_thickness_str = row[1].value
-        cell_thickness = parse_thickness(cell_thickness_str)
+    try:
+        # resolve the type 'str'
+        for idx in range(1, 4):
+            number = to_number(values[idx])
+            if number is None:
+                raise ValueError(f"轉換數值失敗：values[{idx}] = {values[idx]}")
+            values[idx] = number
+
+        coefficient = float(tables.coefficient(values[0]))
+        weight = values[1] * values[2] * values[3] * coefficient
+        material = tables.material_price(values[0], values[1])
+        iron = weight * material
+        mm = tables.mm_by_thickness(values[0], values[1])
+        iron_mm = (values[2] + values[3]) * mm * 2 / 1000
+
+        return [round(weight, 2), round(material, 2), round(iron, 2), round(iron_mm, 2)]
+
+    except Exception as e:
+        error_message = f"Row {i} error: {e}, values: {values}"
+        print(error_message)
+        raise Exception(error_message)
+
+def calculate_and_write_output(base, output_sheet, tables, total_row, base_row, output_row, costs=None,
+                               metrics=None, progress=None):
+    """
+    Calculate weight, material and 米數 costs for each BOM row and write them to the output sheet.
 
-        if cell_material == material and cell_thickness is not None:
-            if cell_thickness >= input_thickness:
-                candidates.append((cell_thickness, row[5].value))
-    if not candidates:
-        raise Exception("找不到鐵板米數厚度相關資料")
-    candidates.sort(key=lambda x: x[0])
-    return candidates[0][1]
+    Args:
+        base (BaseSheet): The parsed 標準成本結構表 sheet.
+        output_sheet (Worksheet): Target worksheet.
+        tables (ReferenceTables): Indexed reference sheets.
+        total_row (int): Number of BOM rows to calculate.
+        base_row (int): First BOM row in base.
+        output_row (int): First row to write in output_sheet.
+        costs (list, optional): Precomputed calculate_row results for each row,
+            e.g. from engine.calculate_rows. Calculated row by row if omitted.
+        metrics (RunMetrics, optional): Receives the time spent calculating
+            (calculate_and_write_output.calculate) and rows_calculated/rows_skipped.
+        progress (Progress, optional): Reports the calculate_and_write_output phase row by row.
 
-def calculate_and_write_output(base_sheet, output_sheet, weight_sheet, material_sheet, mm_sheet,
-                               total_row, base_row, output_row):
+    Returns:
+        None
+    """
     output_col = 11
+    calculate_seconds = 0
+    if progress is not None:
+        progress.start('calculate_and_write_output', total_row)
 
     for i in range(base_row, base_row + total_row):
-        values = get_row_range_values(base_sheet, i, 4, 7)
         output_i = output_row + (i - base_row)
-
-        if None in values or '' in values:
+        if costs is None:
+            start = time.perf_counter()
+            res = calculate_row(base, tables, i)
+            calculate_seconds += time.perf_counter() - start
+        else:
+            res = costs[i - base_row]
+
+        if metrics is not None:
+            metrics.count('rows_skipped' if res is None else 'rows_calculated')
+        if res is None:
             for j in range(4):
                 output_sheet.cell(row=output_i, column=output_col + j, value="")
-            cell1 = output_sheet.cell(row=output_i, column=output_col + 7, value=f'=P{output_i}+O{output_i}+N{output_i}+M{output_i}+Q{output_i}')
-            cell2 = output_sheet.cell(row=output_i, column=output_col + 8, value=f'=R{output_i}*J{output_i}')
-            cell1.number_format = '0.00'
-            cell2.number_format = '0.00'
-            continue
-        
-        try:
-            # resolve the type 'str'
-            for idx in range(1, 4):
-                try:
-                    val_str = str(values[idx]).strip()
-                    if '.' in val_str:
-                        values[idx] = float(val_str)
-                    else:
-                        values[idx] = int(val_str)
-                except Exception:
-                    raise ValueError(f"轉換數值失敗：values[{idx}] = {values[idx]}")
-
-            coefficient = float(find_value_by_match(weight_sheet, 2, values[0], 6))
-            weight = values[1] * values[2] * values[3] * coefficient
-            material = find_row_with_multiple_conditions(material_sheet, [(3, values[0]), (4, values[1])], [5])[0]
-            iron = weight * material
-            mm = find_value_by_thickness(mm_sheet, values[0], values[1])
-            iron_mm = (values[2] + values[3]) * mm * 2 / 1000
-
-            res = [round(weight, 2), round(material, 2), round(iron, 2), round(iron_mm, 2)]
-
+        else:
             for j, val in enumerate(res):
                 cell = output_sheet.cell(row=output_i, column=output_col + j, value=val)
                 cell.number_format = '0.00'
 
-        except Exception as e:
-            for j in range(4):
-                output_sheet.cell(row=output_i, column=output_col + j, value="")
-            error_message = f"Row {i} error: {e}, values: {values}"
-            print(error_message)
-            raise Exception(error_message)
-        
-        cell1 = output_sheet.cell(row=output_i, column=output_col + 7, value=f'=P{output_i}+O{output_i}+N{output_i}+M{output_i}+Q{output_i}')
-        cell2 = output_sheet.cell(row=output_i, column=output_col + 8, value=f'=R{output_i}*J{output_i}')
+        subtotal, total = row_formulas(output_i)
+        cell1 = output_sheet.cell(row=output_i, column=output_col + 7, value=subtotal)
+        cell2 = output_sheet.cell(row=output_i, column=output_col + 8, value=total)
         cell1.number_format = '0.00'
         cell2.number_format = '0.00'
+        if progress is not None:
+            progress.advance()
+
+    if metrics is not None and costs is None:
+        metrics.add_time('calculate_and_write_output.calculate', calculate_seconds)
 
 def total_result(sheet, total_row):
     output_col = 17
@@ -336,9 +478,10 @@ def total_result(sheet, total_row):
     cell_2 = sheet[f'P{total_row + 5}']
     cell_1.value = '總合計'
     cell_2.value = '含其它製程費用'
-    style.set_style_in_range(sheet, f'P{total_row + 4}:R{total_row + 5}', fill=PatternFill(fill_type='solid', start_color='F4B084', end_color='F4B084'))
-    cell1 = sheet.cell(row=total_row + 4, column=output_col + 2, value=f'=ROUND(SUM(S4:S{total_row + 3}), 0)')
-    cell2 = sheet.cell(row=total_row + 5, column=output_col + 2, value=f'=S{total_row + 4}*1.05*1.3')
+    sum_formula, with_process_formula = total_formulas(total_row)
+    cell1 = sheet.cell(row=total_row + 4, column=output_col + 2, value=sum_formula)
+    cell2 = sheet.cell(row=total_row + 5, column=output_col + 2, value=with_process_formula)
     cell1.number_format = '0.00'
     cell2.number_format = '0.00'
-    style.set_style_in_range(sheet, f'R{total_row + 4}:S{total_row + 5}', fill=PatternFill(fill_type='solid', start_color='F4B084', end_color='F4B084'))
\ No newline at end of file
+    for start, end, styles in TOTAL_STYLE_RANGES:
+        style.set_style_in_range(sheet, f'{start}{total_row + 4}:{end}{total_row + 5}', **styles)
\ No newline at end of file
@@ -0,0 +1,219 @@
+import abc
+import csv
+import json
+import os
+
+import excel
+
+EXPORT_FORMATS = ('csv', 'json', 'parquet')
+# Header titles with the 規格呎吋 columns F–I named after their sub-titles.
+EXPORT_COLUMNS = [*excel.HEADER_TITLES[:5], *excel.HEADER_SUB_TITLES, *excel.HEADER_TITLES[9:]]
+KIND_COLUMN = '類型'
+ROW_KIND = '明細'
+TOTAL_LABELS = ('總合計', '含其它製程費用')
+# J–S: 累計用量 to 合計, saved as numbers in Parquet.
+NUMERIC_COLUMNS = range(10, 20)
+PARQUET_BATCH_ROWS = 10000
+
+
+def export_path(output_path, fmt):
+    """
+    Get the path of an export file: the output path with the format as extension.
+    """
+    return f'{os.path.splitext(output_path)[0]}.{fmt}'
+
+
+def plain_value(value):
+    """
+    Write whole floats as ints and empty strings as None, as a value read back
+    from a saved sheet is, so the exports do not depend on whether the output
+    was built or patched.
+    """
+    if value == '':
+        return None
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+class ExportFile(abc.ABC):
+    """
+    An export file written to a temporary path and moved into place when closed,
+    so a failed run never leaves a partial file under the final name.
+
+    Args:
+        path (str): Final path of the file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.temp_path = f'{path}.tmp'
+
+    @abc.abstractmethod
+    def write_row(self, values):
+        """
+        Write one output row, formulas replaced by their values.
+        """
+
+    @abc.abstractmethod
+    def write_totals(self, sum_value, with_process_value):
+        """
+        Write the values of the 總合計 and 含其它製程費用 totals.
+        """
+
+    @abc.abstractmethod
+    def _close(self):
+        """
+        Finish writing the temporary file.
+        """
+
+    def close(self):
+        self._close()
+        os.replace(self.temp_path, self.path)
+
+    def abort(self):
+        try:
+            self._close()
+        except Exception:
+            pass
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+
+class CsvExport(ExportFile):
+    """
+    CSV with a 類型 column telling the 明細 rows from the two total rows,
+    whose value is in the 合計 column. UTF-8 with BOM, so Excel reads the
+    Chinese headers correctly.
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.file = open(self.temp_path, 'w', encoding='utf-8-sig', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow([KIND_COLUMN, *EXPORT_COLUMNS])
+
+    def write_row(self, values):
+        self.writer.writerow([ROW_KIND, *map(plain_value, values)])
+
+    def write_totals(self, sum_value, with_process_value):
+        for label, value in zip(TOTAL_LABELS, (sum_value, with_process_value)):
+            self.writer.writerow([label, *[None] * (len(EXPORT_COLUMNS) - 1), plain_value(value)])
+
+    def _close(self):
+        self.file.close()
+
+
+class JsonExport(ExportFile):
+    """
+    JSON object {"columns": [...], "rows": [{column: value}, ...], "totals": {label: value}},
+    written row by row.
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.file = open(self.temp_path, 'w', encoding='utf-8')
+        self.file.write('{"columns": ' + json.dumps(EXPORT_COLUMNS, ensure_ascii=False) + ', "rows": [')
+        self.first = True
+
+    def write_row(self, values):
+        self.file.write('\n' if self.first else ',\n')
+        self.first = False
+        json.dump(dict(zip(EXPORT_COLUMNS, map(plain_value, values))), self.file, ensure_ascii=False, default=str)
+
+    def write_totals(self, sum_value, with_process_value):
+        totals = dict(zip(TOTAL_LABELS, map(plain_value, (sum_value, with_process_value))))
+        self.file.write('\n], "totals": ' + json.dumps(totals, ensure_ascii=False) + '}\n')
+
+    def _close(self):
+        self.file.close()
+
+
+def _parquet_number(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    return float(value)
+
+
+def _parquet_text(value):
+    return None if value is None or value == '' else str(value)
+
+
+class ParquetExport(ExportFile):
+    """
+    Parquet with the same columns as the CSV export; J–S are float64 (errors
+    such as #VALUE! become null) and the other columns text. Needs pyarrow.
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+        # pyarrow is only needed, and imported, when Parquet is asked for.
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise Exception("輸出 Parquet 需要安裝 pyarrow（pip install pyarrow）")
+        self.pa = pa
+        fields = [pa.field(KIND_COLUMN, pa.string())]
+        for col, name in enumerate(EXPORT_COLUMNS, start=1):
+            fields.append(pa.field(name, pa.float64() if col in NUMERIC_COLUMNS else pa.string()))
+        self.schema = pa.schema(fields)
+        self.writer = pq.ParquetWriter(self.temp_path, self.schema)
+        self.rows = []
+
+    def _flush(self):
+        if self.rows:
+            columns = list(zip(*self.rows))
+            self.writer.write_table(self.pa.Table.from_arrays(
+                [self.pa.array(column, type=field.type) for column, field in zip(columns, self.schema)],
+                schema=self.schema))
+            self.rows = []
+
+    def write_row(self, values, kind=ROW_KIND):
+        self.rows.append((kind, *(_parquet_number(value) if col in NUMERIC_COLUMNS else _parquet_text(value)
+                                  for col, value in enumerate(values, start=1))))
+        if len(self.rows) >= PARQUET_BATCH_ROWS:
+            self._flush()
+
+    def write_totals(self, sum_value, with_process_value):
+        for label, value in zip(TOTAL_LABELS, (sum_value, with_process_value)):
+            self.write_row([None] * (len(EXPORT_COLUMNS) - 1) + [value], label)
+
+    def _close(self):
+        self._flush()
+        self.writer.close()
+
+
+EXPORT_CLASSES = {'csv': CsvExport, 'json': JsonExport, 'parquet': ParquetExport}
+
+
+def open_exports(output_path, formats):
+    """
+    Open the export files of an output.
+
+    Args:
+        output_path (str): 輸出 Excel 檔案路徑; the exports are saved next to it
+            with the same name, see export_path.
+        formats (list): Formats out of EXPORT_FORMATS.
+
+    Returns:
+        list: The open export files, to pass to writer.RowResults.
+    """
+    exports = []
+    try:
+        for fmt in dict.fromkeys(formats):
+            if fmt not in EXPORT_CLASSES:
+                raise ValueError(f"未知的輸出格式: {fmt}")
+            exports.append(EXPORT_CLASSES[fmt](export_path(output_path, fmt)))
+    except BaseException:
+        abort_exports(exports)
+        raise
+    return exports
+
+
+def abort_exports(exports):
+    """
+    Remove the unfinished files of a failed run.
+    """
+    for sink in exports:
+        sink.abort()
@@ -0,0 +1,362 @@
+import hashlib
+import json
+import os
+import uuid
+import zipfile
+
+from openpyxl import Workbook
+
+import excel
+import instrument
+import style
+import writer
+import xlsx
+from writer import BASE_FIRST_ROW, OUTPUT_FIRST_ROW, TOTAL_COLUMN
+
+MANIFEST_VERSION = 3  # bump when the signatures or the output layout change
+
+
+def manifest_path(output_path):
+    """
+    Get the manifest path of an output file: a dot file in the same folder.
+    """
+    folder, name = os.path.split(os.path.abspath(output_path))
+    return os.path.join(folder, f'.{name}.manifest.json')
+
+
+def _digest(value):
+    return hashlib.sha1(repr(value).encode('utf-8')).hexdigest()[:20]
+
+
+def file_digest(path):
+    """
+    Hash a file's bytes, to tell whether an output was changed since the manifest was written.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def query_labels(base):
+    """
+    Get the query label of every output row, as write_output assigns them.
+    """
+    labels, label_nums = excel.get_labels_and_numbers(base)
+    return [label for label, count in zip(labels, label_nums) for _ in range(count)]
+
+
+def row_signatures(base, labels):
+    """
+    Hash everything an output row is built from: the source row's values and
+    styles in columns A–I and its query label.
+
+    Args:
+        base (BaseSheet): The parsed 標準成本結構表 sheet.
+        labels (list): Query label of each output row, from query_labels.
+
+    Returns:
+        list: One signature per BOM row, from row 5 to base.max_row.
+    """
+    style_digests = [_digest(style) for style in base.styles]
+    signatures = []
+    for base_row in range(BASE_FIRST_ROW, base.max_row + 1):
+        index = base_row - BASE_FIRST_ROW
+        styles = tuple(None if sid is None else style_digests[sid]
+                       for sid in (base.style_id(base_row, col) for col in range(1, 10)))
+        label = labels[index] if index < len(labels) else None
+        signatures.append(_digest((base.row_values(base_row, 1, 9), styles, label)))
+    return signatures
+
+
+def material_signatures(tables):
+    """
+    Hash the reference data of each material across the three reference sheets.
+
+    A row only needs recalculating for a reference change when the signature
+    of its material changed.
+
+    Returns:
+        dict: repr(material) -> signature.
+    """
+    entries = {}
+    for material, coefficient in tables.coefficients.items():
+        entries.setdefault(material, [None, [], None])[0] = coefficient
+    for (material, thickness), price in tables.prices.items():
+        entries.setdefault(material, [None, [], None])[1].append((repr(thickness), repr(price)))
+    for material, index in tables.mm_index.items():
+        entries.setdefault(material, [None, [], None])[2] = index
+    return {repr(material): _digest((coefficient, sorted(prices), mm))
+            for material, (coefficient, prices, mm) in entries.items()}
+
+
+def _mm_error_key(tables):
+    return repr(tables.mm_error) if tables.mm_error is not None else None
+
+
+def build_manifest(model, output_path, totals, styles, signatures=None, materials=None):
+    """
+    Describe a finished output: the signatures it was built from, what a
+    patch needs to know about the file, and the hash of the file.
+
+    Args:
+        model (CostModel): The input the output was built from.
+        output_path (str): The saved output, built by writer.write_output.
+        totals (list): 合計 of every data row, None for the first, see RowResults.row_totals.
+        styles (dict): Style ids of the output, see style_index.
+        signatures (list, optional): Row signatures already worked out by changed_rows.
+        materials (dict, optional): Material signatures already worked out by changed_rows.
+
+    Returns:
+        dict: The manifest.
+    """
+    base = model.base
+    with zipfile.ZipFile(output_path) as zf:
+        title = next(iter(xlsx.sheet_parts(zf)))
+    return {
+        'version': MANIFEST_VERSION,
+        'max_row': base.max_row,
+        'rows': signatures if signatures is not None else row_signatures(base, query_labels(base)),
+        'materials': materials if materials is not None else material_signatures(model.tables),
+        'mm_error': _mm_error_key(model.tables),
+        'title': title,
+        'totals': list(totals),
+        'styles': styles,
+        'output_sha256': file_digest(output_path),
+    }
+
+
+def read_manifest(output_path):
+    """
+    Load the manifest of an output, or None if it is missing, unreadable or stale.
+
+    A manifest is stale when its version differs or the output file is
+    missing or no longer the file it describes, e.g. after editing it in Excel.
+    """
+    path = manifest_path(output_path)
+    try:
+        with open(path, encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get('version') != MANIFEST_VERSION:
+            return None
+        if manifest.get('output_sha256') != file_digest(output_path):
+            return None
+        return manifest
+    except (OSError, ValueError):
+        return None
+
+
+def write_manifest(manifest, output_path):
+    """
+    Save a manifest next to its output. Failing to write it only costs a full rebuild next time.
+    """
+    path = manifest_path(output_path)
+    temp_path = f'{path}.tmp'
+    try:
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+        os.replace(temp_path, path)
+    except OSError:
+        pass
+
+
+def changed_rows(manifest, model):
+    """
+    Find the BOM rows whose output differs from the one the manifest describes.
+
+    Args:
+        manifest (dict): Manifest of the existing output.
+        model (CostModel): The newly loaded input.
+
+    Returns:
+        tuple: (rows, signatures, materials) – the changed base rows (None if
+               the layout changed and the output must be rebuilt), plus the new
+               row and material signatures.
+    """
+    base = model.base
+    signatures = row_signatures(base, query_labels(base))
+    materials = material_signatures(model.tables)
+    mm_error = _mm_error_key(model.tables)
+    if manifest['max_row'] != base.max_row or len(manifest['rows']) != len(signatures):
+        return None, signatures, materials
+
+    all_materials = manifest['mm_error'] != mm_error
+    changed_materials = {key for key in set(materials) | set(manifest['materials'])
+                         if materials.get(key) != manifest['materials'].get(key)}
+    rows = []
+    for index, (old, new) in enumerate(zip(manifest['rows'], signatures)):
+        base_row = index + BASE_FIRST_ROW
+        if old != new:
+            rows.append(base_row)
+        elif base_row > BASE_FIRST_ROW and (all_materials or repr(base.value(base_row, 4)) in changed_materials):
+            rows.append(base_row)
+    return rows, signatures, materials
+
+
+class OutputStyles:
+    """
+    The style ids of an existing output, looked up like NamedStyleRegistry.style_id
+    so the row builders of writer can be reused for a patch.
+
+    A style the output does not have yet raises KeyError: adding one would
+    mean rewriting the stylesheet, so the output is rebuilt instead.
+
+    Args:
+        styles (dict): Style digest -> style id, see style_index.
+    """
+
+    def __init__(self, styles):
+        self.styles = styles
+        self.ids = {}
+
+    def style_id(self, key, font, alignment, border, fill, number_format='General', protection=None):
+        style_id = self.ids.get(key)
+        if style_id is None:
+            spec = style.style_spec(font, alignment, border, fill, number_format, protection)
+            style_id = self.ids[key] = self.styles[_digest(spec)]
+        return style_id
+
+
+def style_index(registry):
+    """
+    Get the style ids of a built output by style digest, for OutputStyles.
+
+    Args:
+        registry (NamedStyleRegistry): The registry the output was written with.
+
+    Returns:
+        dict: Style digest -> style id.
+    """
+    return {_digest(spec): style_id for style_id, spec in registry.specs.items()}
+
+
+def patch_output(model, output_path, manifest, rows, metrics=None, progress=None):
+    """
+    Rewrite some BOM rows and the totals of an existing output.
+
+    Only the <row> elements of those rows and of the two total rows are
+    serialized again; they replace the old ones in the worksheet XML, and the
+    other parts of the package are copied as they are. The totals are summed
+    from the 合計 of the other rows kept in the manifest.
+
+    Args:
+        model (CostModel): The parsed input.
+        output_path (str): The output built from an earlier version of the input.
+        manifest (dict): Manifest of the output; its totals are updated in place.
+        rows (list): Base rows to rewrite.
+        metrics (RunMetrics, optional): Receives the patch.* timings and rows_patched.
+        progress (Progress, optional): Reports the patch phase row by row.
+
+    Returns:
+        bool: False if the output cannot be patched, because its sheet title
+              changed or a row needs a style it does not have; it is left as it was then.
+    """
+    metrics = metrics or instrument.RunMetrics()
+    base = model.base
+    total_row = base.max_row - BASE_FIRST_ROW
+    labels = query_labels(base)
+    label_list, _ = excel.get_labels_and_numbers(base)
+    if excel.get_sheet_title(label_list, excel.get_main_name(base)) != manifest['title']:
+        # The title is also kept in the workbook and document properties parts.
+        return False
+    first_row_styles, regular_styles = writer.data_column_styles()
+    styles = OutputStyles(manifest['styles'])
+    totals = manifest['totals']
+    row_writer = xlsx.RowWriter(Workbook(write_only=True).create_sheet())
+    patched = {}
+
+    if progress is not None:
+        progress.start('patch', len(rows))
+    with metrics.phase('patch.rows'):
+        try:
+            for base_row in rows:
+                row = base_row - BASE_FIRST_ROW + OUTPUT_FIRST_ROW
+                res = excel.calculate_row(base, model.tables, base_row) if base_row > BASE_FIRST_ROW else None
+                index = base_row - BASE_FIRST_ROW
+                column_styles = first_row_styles if row == OUTPUT_FIRST_ROW else regular_styles
+                cells = writer.data_row_cells(styles, column_styles, base, row,
+                                              labels[index] if index < len(labels) else None, res)
+                if row > OUTPUT_FIRST_ROW:
+                    totals[index] = cells[TOTAL_COLUMN - 1][0].cached
+                patched[row] = row_writer.row(row, cells).encode('utf-8')
+                metrics.count('rows_patched')
+                if progress is not None:
+                    progress.advance()
+
+            row_totals = excel.FormulaTotals()
+            for total in totals[1:]:
+                row_totals.add(total)
+            for row, cells in zip((total_row + 4, total_row + 5), writer.total_rows(styles, total_row, row_totals)):
+                patched[row] = row_writer.row(row, cells).encode('utf-8')
+        except KeyError:
+            return False
+
+    if progress is not None:
+        progress.start('save')
+    with metrics.phase('patch.save'):
+        temp_path = f'{output_path}.{uuid.uuid4().hex}.tmp'
+        try:
+            with zipfile.ZipFile(output_path) as source, \
+                    zipfile.ZipFile(temp_path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as target:
+                part = next(iter(xlsx.sheet_parts(source).values()))
+                for info in source.infolist():
+                    if info.filename == part:
+                        with source.open(info) as src, target.open(info.filename, 'w', force_zip64=True) as f:
+                            xlsx.replace_rows(src, f, patched)
+                    else:
+                        target.writestr(info, source.read(info.filename))
+            os.replace(temp_path, output_path)
+        except ValueError:
+            # Rows missing from the sheet: not an output written by writer.write_output.
+            return False
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+    return True
+
+
+def update_output(model, output_path, metrics=None, progress=None, exports=()):
+    """
+    Bring an output built from an earlier version of the input up to date by
+    patching only the rows that changed.
+
+    A row is rewritten when its own cells or query label changed, or when the
+    reference data of its material changed. The caller rebuilds the output
+    when this returns False: there is no valid manifest, the output was
+    changed since, the BOM has a different number of rows, or the output
+    cannot be patched (see patch_output). Export files need every row, so
+    the output is rebuilt whenever there are any.
+
+    Args:
+        model (CostModel): The newly loaded input.
+        output_path (str): The output to update.
+        metrics (RunMetrics, optional): Receives the diff and patch timings,
+            rows_patched and incremental_rebuilds.
+        progress (Progress, optional): Reports the patch phase row by row.
+        exports (list, optional): Open export files.
+
+    Returns:
+        bool: True if the output is up to date, False if it must be rebuilt.
+    """
+    metrics = metrics or instrument.RunMetrics()
+    with metrics.phase('diff'):
+        manifest = read_manifest(output_path)
+        rows = None
+        if manifest is not None:
+            rows, signatures, materials = changed_rows(manifest, model)
+    if rows is None or exports:
+        metrics.count('incremental_rebuilds')
+        return False
+    if not rows:
+        return True
+
+    with metrics.phase('patch'):
+        patched = patch_output(model, output_path, manifest, rows, metrics, progress)
+    if not patched:
+        metrics.count('incremental_rebuilds')
+        return False
+    with metrics.phase('diff'):
+        write_manifest(build_manifest(model, output_path, manifest['totals'], manifest['styles'], signatures,
+                                      materials), output_path)
+    return True
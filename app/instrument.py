@@ -0,0 +1,237 @@
+import cProfile
+import json
+import os
+import sys
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+import refcache
+
+LOG_FILENAME = 'runs.log'
+TOP_MEMORY_STATS = 30
+# Phase names shown in the GUI breakdown, in pipeline order.
+PHASE_LABELS = {
+    'load': '讀取',
+    'calculate_costs': '計算',
+    'copy_columns_with_style': '複製欄位',
+    'fill_query_no': '查詢編號',
+    'set_basic_styles': '樣式',
+    'calculate_and_write_output': '計算寫入',
+    'write_rows': '寫入',
+    'diff': '比對',
+    'patch': '更新',
+    'validate': '檢查',
+    'split': '分割',
+    'rollup': '組件小計',
+    'save': '存檔',
+    'export': '匯出',
+    'result_cache': '結果快取',
+    'scenarios': '情境',
+}
+
+
+def peak_rss_mb():
+    """
+    Get the peak resident memory of this process in MB.
+
+    Returns:
+        float: Peak memory, or None where the platform does not report it.
+    """
+    if sys.platform == 'win32':
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                        ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                        ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                        ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if not ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return None
+        return counters.PeakWorkingSetSize / (1024 * 1024)
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes on Linux.
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+class RunMetrics:
+    """
+    Wall time per phase, counters and memory of one run.
+
+    Phases with the same name add up. Sub-steps use dotted names such as
+    'load.base', so the top-level phases still sum to the run time.
+    """
+
+    def __init__(self, trace_memory=False):
+        """
+        Args:
+            trace_memory (bool): Record the Python heap peak of every phase with
+                tracemalloc. Makes the run noticeably slower.
+        """
+        self.trace_memory = trace_memory
+        self.phases = {}
+        self.heap_peaks = {}
+        self.counters = Counter()
+        self.rows = 0
+        self.files = []
+        self._peak_stack = []
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Time the enclosed block as phase `name`.
+        """
+        tracing = self.trace_memory and tracemalloc.is_tracing()
+        if tracing:
+            # reset_peak() also resets the enclosing phase's peak, so keep it on the stack.
+            if self._peak_stack:
+                self._peak_stack[-1] = max(self._peak_stack[-1], tracemalloc.get_traced_memory()[1])
+            self._peak_stack.append(0)
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+            if tracing:
+                peak = max(tracemalloc.get_traced_memory()[1], self._peak_stack.pop())
+                if self._peak_stack:
+                    self._peak_stack[-1] = max(self._peak_stack[-1], peak)
+                self.heap_peaks[name] = max(peak / (1024 * 1024), self.heap_peaks.get(name, 0))
+
+    def add_time(self, name, seconds):
+        """
+        Add seconds measured elsewhere to phase `name`.
+        """
+        self.phases[name] = self.phases.get(name, 0) + seconds
+
+    def count(self, name, n=1):
+        """
+        Increase counter `name` by n.
+        """
+        self.counters[name] += n
+
+    def as_dict(self):
+        """
+        Get the measurements as a JSON-serialisable dict.
+
+        Returns:
+            dict: seconds, rows, rows_per_second, phases, counters, peak_rss_mb,
+                  plus heap_peak_mb when memory was traced and files when profiles were written.
+        """
+        seconds = time.perf_counter() - self._start
+        result = {
+            'seconds': seconds,
+            'rows': self.rows,
+            'rows_per_second': self.rows / seconds if seconds else None,
+            'phases': dict(self.phases),
+            'counters': dict(self.counters),
+            'peak_rss_mb': peak_rss_mb(),
+        }
+        if self.heap_peaks:
+            result['heap_peak_mb'] = dict(self.heap_peaks)
+        if self.files:
+            result['files'] = list(self.files)
+        return result
+
+
+@contextmanager
+def profiling(profile_dir, metrics):
+    """
+    Capture a cProfile profile and a tracemalloc snapshot of the enclosed block.
+
+    Writes <profile_dir>/profile-<time>.prof (open with pstats or snakeviz) and
+    memory-<time>.txt with the lines that allocated the most memory. Does
+    nothing when profile_dir is None.
+
+    Args:
+        profile_dir (str): Directory for the capture files, or None.
+        metrics (RunMetrics): The paths of the written files are added to metrics.files.
+    """
+    if profile_dir is None:
+        yield
+        return
+
+    os.makedirs(profile_dir, exist_ok=True)
+    stamp = time.strftime('%Y%m%d-%H%M%S')
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        if started_tracing:
+            tracemalloc.stop()
+
+        profile_path = os.path.join(profile_dir, f'profile-{stamp}.prof')
+        profiler.dump_stats(profile_path)
+        memory_path = os.path.join(profile_dir, f'memory-{stamp}.txt')
+        with open(memory_path, 'w', encoding='utf-8') as f:
+            for stat in snapshot.statistics('lineno')[:TOP_MEMORY_STATS]:
+                f.write(f'{stat}\n')
+        metrics.files.extend([profile_path, memory_path])
+
+
+def default_log_path():
+    """
+    Get the run log path, next to the reference cache.
+    """
+    return os.path.join(refcache.default_cache_dir(), LOG_FILENAME)
+
+
+def write_log(record, path=None):
+    """
+    Append one run record to the log as a JSON line. Logging never fails a run.
+
+    Args:
+        record (dict): The run measurements, e.g. from RunMetrics.as_dict.
+        path (str, optional): Log file, defaults to default_log_path().
+    """
+    path = path or default_log_path()
+    line = json.dumps({'time': time.strftime('%Y-%m-%dT%H:%M:%S'), **record}, ensure_ascii=False)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+    except OSError:
+        pass
+
+
+def format_breakdown(result):
+    """
+    Summarise a run on one line for the status bar, e.g.
+    '共 6000 列，5.31 秒（1130 列/秒）：讀取 1.02、寫入 3.75、存檔 0.54 秒'.
+
+    Args:
+        result (dict): Output of RunMetrics.as_dict.
+
+    Returns:
+        str: The summary.
+    """
+    parts = [f'{PHASE_LABELS[name]} {seconds:.2f}'
+             for name, seconds in result['phases'].items()
+             if name in PHASE_LABELS and seconds >= 0.005]
+    text = f"共 {result['rows']} 列，{result['seconds']:.2f} 秒"
+    if result.get('rows_per_second'):
+        text += f"（{result['rows_per_second']:.0f} 列/秒）"
+    if parts:
+        text += '：' + '、'.join(parts) + ' 秒'
+    if result.get('peak_rss_mb'):
+        text += f"，記憶體高峰 {result['peak_rss_mb']:.0f} MB"
+    return text
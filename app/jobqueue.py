@@ -0,0 +1,301 @@
+import os
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import CancelledError
+from concurrent.futures.process import BrokenProcessPool
+
+import workerpool
+
+# Only the standard library and workerpool (which needs nothing else) are imported here,
+# so the GUI can create its queue before the calculation modules are loaded; the workers import them.
+
+DEFAULT_MAX_WORKERS = 4
+STATUS_LABELS = {
+    'queued': '等待中',
+    'running': '處理中',
+    'done': '完成',
+    'failed': '失敗',
+    'cancelled': '已取消',
+}
+ACTIVE = ('queued', 'running')
+
+
+def default_workers():
+    """
+    Get the number of worker processes: one per CPU, at most DEFAULT_MAX_WORKERS.
+    """
+    return max(1, min(os.cpu_count() or 1, DEFAULT_MAX_WORKERS))
+
+
+def run_job(input_path, output_dir):
+    """
+    Process one workbook in a worker process, see batch.process_file.
+
+    Large inputs are streamed in chunks, as the GUI does for a single file.
+    """
+    import batch
+    import stream
+    chunk_size = stream.DEFAULT_CHUNK_SIZE if os.path.getsize(input_path) >= stream.LARGE_INPUT_BYTES else None
+    return batch.process_file(input_path, output_dir, chunk_size=chunk_size, fast_reader=not chunk_size)
+
+
+class Job:
+    """
+    One input workbook in the queue and the outcome of its last attempt.
+    """
+
+    def __init__(self, job_id, input_path):
+        self.id = job_id
+        self.input_path = input_path
+        self.status = 'queued'
+        self.output_path = None
+        self.rows = None
+        self.seconds = None
+        self.error = None
+        self.attempts = 0
+        self.future = None
+
+    @property
+    def name(self):
+        return os.path.basename(self.input_path)
+
+
+class JobQueue:
+    """
+    Queue of input workbooks processed on a bounded process pool.
+
+    Each job runs in its own worker process, so the openpyxl work of several
+    files runs in parallel instead of sharing one interpreter. The queue is
+    not thread-safe: it is meant to be used from the Tk main loop only, which
+    calls poll to pick up finished jobs. Nothing runs in the caller's threads
+    besides moving finished files to their output names, as in batch.run_batch.
+
+    Args:
+        workers (int, optional): Size of the process pool, default_workers() by default.
+        submit_job (callable, optional): Function run in the workers for a job,
+            with (input_path, output_dir); returns what batch.process_file does.
+    """
+
+    def __init__(self, workers=None, submit_job=run_job):
+        self.workers = workers or default_workers()
+        self.submit_job = submit_job
+        self.jobs = OrderedDict()
+        self.output_dir = None
+        self.started = None
+        self.finished = None
+        self._pool = None
+        self._next_id = 1
+        self._taken = set()
+
+    def add(self, paths):
+        """
+        Add input workbooks as queued jobs; paths already waiting or running are skipped.
+
+        Returns:
+            list: The new jobs.
+        """
+        active = {os.path.abspath(job.input_path) for job in self.jobs.values() if job.status in ACTIVE}
+        added = []
+        for path in paths:
+            if os.path.abspath(path) in active:
+                continue
+            active.add(os.path.abspath(path))
+            job = Job(self._next_id, path)
+            self._next_id += 1
+            self.jobs[job.id] = job
+            added.append(job)
+        if self.output_dir is not None:
+            for job in added:
+                self._submit(job)
+        return added
+
+    def _submit(self, job):
+        job.status = 'queued'
+        job.error = None
+        job.attempts += 1
+        if self._pool is None:
+            self._pool = workerpool.WorkerPool(self.workers)
+        job.future = self._pool.submit(self.submit_job, job.input_path, self.output_dir)
+
+    def start(self, output_dir):
+        """
+        Submit every queued job, writing to output_dir. Jobs added while the
+        queue is busy are submitted right away.
+
+        Output names follow batch.run_batch: a name already used since the
+        queue was last idle gets ' (2)', ' (3)', ...; existing files are replaced.
+
+        Returns:
+            int: Number of jobs submitted.
+        """
+        if not self.busy():
+            self._taken = set()
+            self.started = time.perf_counter()
+            self.finished = None
+        self.output_dir = output_dir
+        pending = [job for job in self.jobs.values() if job.status == 'queued' and job.future is None]
+        for job in pending:
+            self._submit(job)
+        return len(pending)
+
+    def retry(self, job_ids):
+        """
+        Submit failed or cancelled jobs again, to the output folder of the last start.
+
+        Returns:
+            list: The jobs submitted.
+        """
+        jobs = [self.jobs[job_id] for job_id in job_ids
+                if job_id in self.jobs and self.jobs[job_id].status in ('failed', 'cancelled')]
+        if not jobs or self.output_dir is None:
+            return []
+        if not self.busy():
+            self.started = time.perf_counter()
+            self.finished = None
+        for job in jobs:
+            self._submit(job)
+        return jobs
+
+    def cancel(self, job_ids=None):
+        """
+        Cancel jobs that have not started yet; running jobs finish normally.
+
+        Args:
+            job_ids (list, optional): Jobs to cancel; all waiting jobs by default.
+
+        Returns:
+            list: The jobs cancelled.
+        """
+        cancelled = []
+        for job in list(self.jobs.values()):
+            if job_ids is not None and job.id not in job_ids:
+                continue
+            if job.status != 'queued' or (job.future is not None and not job.future.cancel()):
+                continue
+            job.status = 'cancelled'
+            job.future = None
+            cancelled.append(job)
+        return cancelled
+
+    def remove(self, job_ids):
+        """
+        Drop jobs from the queue, cancelling them first; running jobs are kept.
+
+        Returns:
+            list: The ids removed.
+        """
+        self.cancel(job_ids)
+        removed = [job_id for job_id in job_ids if job_id in self.jobs and self.jobs[job_id].status not in ACTIVE]
+        for job_id in removed:
+            del self.jobs[job_id]
+        return removed
+
+    def busy(self):
+        """
+        Tell whether a submitted job has not finished yet.
+        """
+        return any(job.status in ACTIVE and job.future is not None for job in self.jobs.values())
+
+    def poll(self):
+        """
+        Pick up jobs that started or finished since the last call.
+
+        Returns:
+            list: The jobs whose status changed.
+        """
+        changed = []
+        for job in self.jobs.values():
+            future = job.future
+            if future is None or job.status not in ACTIVE:
+                continue
+            if not future.done():
+                if future.running() and job.status == 'queued':
+                    job.status = 'running'
+                    changed.append(job)
+                continue
+            job.future = None
+            try:
+                result = future.result()
+            except CancelledError:
+                job.status = 'cancelled'
+            except BrokenProcessPool as e:
+                if self._pool is not None:
+                    self._pool.recover(future)
+                job.status = 'failed'
+                job.error = f'處理程序意外結束：{e}'
+            except Exception as e:
+                job.status = 'failed'
+                job.error = str(e) or type(e).__name__
+            else:
+                self._finish(job, result)
+            changed.append(job)
+        if changed and not self.busy():
+            self.finished = time.perf_counter()
+        return changed
+
+    def _finish(self, job, result):
+        # Imported on first use, when the calculation modules are loaded anyway.
+        import batch
+        import export
+        try:
+            output_path = batch.unique_output_path(self.output_dir, result['output_name'], self._taken)
+            os.replace(result['temp_path'], output_path)
+            for fmt, temp_export in result['export_paths'].items():
+                os.replace(temp_export, export.export_path(output_path, fmt))
+        except OSError as e:
+            job.status = 'failed'
+            job.error = str(e)
+            return
+        job.status = 'done'
+        job.output_path = output_path
+        job.rows = result['rows']
+        job.seconds = result['seconds']
+
+    def counts(self):
+        """
+        Count the jobs per status, e.g. {'done': 28, 'failed': 2}.
+        """
+        return Counter(job.status for job in self.jobs.values())
+
+    def elapsed(self):
+        """
+        Get the wall time from the queue last starting from idle until it
+        finished, or until now while it runs; None before the first start.
+        """
+        if self.started is None:
+            return None
+        return (self.finished or time.perf_counter()) - self.started
+
+    def shutdown(self):
+        """
+        Stop the pool: waiting jobs are dropped, running ones are not waited for.
+        """
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+def format_summary(queue):
+    """
+    Summarise the queue on one line, e.g. '完成 28、失敗 2、等待中 0，耗時 41.2 秒'.
+    """
+    counts = queue.counts()
+    parts = [f'{STATUS_LABELS[status]} {counts[status]}' for status in ('done', 'failed', 'running', 'queued', 'cancelled')
+             if counts[status] or status in ('done', 'queued')]
+    text = '、'.join(parts)
+    elapsed = queue.elapsed()
+    if elapsed is not None:
+        text += f'，耗時 {elapsed:.1f} 秒'
+    return text
+
+
+def format_job(job):
+    """
+    Get the values of a job's row in the queue list: 檔案, 狀態, 列數, 耗時, 輸出檔案 or error.
+    """
+    status = STATUS_LABELS[job.status]
+    if job.attempts > 1:
+        status += f'（第 {job.attempts} 次）'
+    detail = os.path.basename(job.output_path) if job.output_path and job.status == 'done' else (job.error or '')
+    return (job.name, status, '' if job.rows is None else job.rows,
+            '' if job.seconds is None else f'{job.seconds:.1f} 秒', detail)
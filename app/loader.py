@@ -0,0 +1,562 @@
+import os
+import threading
+import xml.etree.ElementTree as ET
+import zipfile
+from collections import OrderedDict
+
+import openpyxl
+
+import instrument
+import reference
+import xlsx
+from progress import Cancelled
+from reference import ReferenceTables, WEIGHT_SHEET, MATERIAL_SHEET, MM_SHEET
+
+BASE_SHEET = '標準成本結構表'
+BASE_MAX_COL = 9  # columns A–I are all the pipeline reads from 標準成本結構表
+# reference sheet -> function building its index from row tuples
+REFERENCE_INDEXERS = {
+    WEIGHT_SHEET: reference.index_weight_rows,
+    MATERIAL_SHEET: reference.index_material_rows,
+    MM_SHEET: reference.index_mm_rows,
+}
+
+
+def has_content(values):
+    """
+    Check whether a row holds any non-blank value.
+
+    Args:
+        values (iterable): Cell values of the row.
+
+    Returns:
+        bool: True if any value is not None or whitespace.
+    """
+    return any(v is not None and str(v).strip() != "" for v in values)
+
+
+class BaseSheet:
+    """
+    Values and styles of columns A–I of 標準成本結構表.
+
+    Rows are 1-based like worksheet rows. Styles are interned: each row keeps a
+    tuple of indexes into `styles`, None for cells without a style.
+    """
+
+    def __init__(self, rows, style_ids, styles, max_row):
+        self.rows = rows
+        self.style_ids = style_ids
+        self.styles = styles
+        self.max_row = max_row
+
+    def value(self, row, col):
+        """
+        Return the value at a 1-based row and column, or None outside the stored range.
+        """
+        if row > len(self.rows) or col > BASE_MAX_COL:
+            return None
+        return self.rows[row - 1][col - 1]
+
+    def row_values(self, row, start_col, end_col):
+        """
+        Return values of a row from start_col to end_col (inclusive).
+        """
+        return [self.value(row, col) for col in range(start_col, end_col + 1)]
+
+    def column_values(self, col, min_row=1):
+        """
+        Yield values of a column from min_row to the last stored row.
+        """
+        for values in self.rows[min_row - 1:]:
+            yield values[col - 1]
+
+    def style_id(self, row, col):
+        """
+        Return the index of a cell's style in `styles`, or None if the cell has no style.
+        """
+        if row > len(self.rows) or col > BASE_MAX_COL:
+            return None
+        return self.style_ids[row - 1][col - 1]
+
+    def style(self, row, col):
+        """
+        Return (font, fill, border, alignment, number_format, protection) of a cell,
+        or None if the cell has no style.
+        """
+        style_id = self.style_id(row, col)
+        return None if style_id is None else self.styles[style_id]
+
+
+class CostModel:
+    """
+    Everything the pipeline needs from an input workbook.
+
+    Attributes:
+        base (BaseSheet): Columns A–I of 標準成本結構表.
+        tables (ReferenceTables): Indexed reference sheets.
+    """
+
+    def __init__(self, base, tables):
+        self.base = base
+        self.tables = tables
+
+
+class RowReader:
+    """
+    Convert read-only worksheet rows to value and style id tuples of columns A–I.
+
+    Styles are interned by their style array, so `styles` only grows with the
+    number of distinct cell styles, not with the number of rows.
+    """
+
+    EMPTY = (None,) * BASE_MAX_COL
+
+    def __init__(self):
+        self.styles = []
+        self._style_index = {}
+        self._row_styles = {}
+
+    def read(self, cells):
+        """
+        Read one row.
+
+        Args:
+            cells (tuple): Cells of the row from ReadOnlyWorksheet.iter_rows().
+
+        Returns:
+            tuple: (values, style_ids, content), content being whether any
+                   cell of the row, not only A–I, holds a non-blank value.
+        """
+        empty = self.EMPTY
+        values = tuple(cell.value for cell in cells[:BASE_MAX_COL])
+        values += empty[len(values):]
+        ids = []
+        for cell in cells[:BASE_MAX_COL]:
+            if not getattr(cell, 'has_style', False):
+                ids.append(None)
+                continue
+            key = tuple(cell.style_array)
+            if key not in self._style_index:
+                self._style_index[key] = len(self.styles)
+                self.styles.append((cell.font, cell.fill, cell.border, cell.alignment,
+                                    cell.number_format, cell.protection))
+            ids.append(self._style_index[key])
+        ids = tuple(ids) + empty[len(ids):]
+        return values, self._row_styles.setdefault(ids, ids), has_content(cell.value for cell in cells)
+
+
+class FastRowReader(RowReader):
+    """
+    RowReader for the rows of a FastWorksheet, (value, style id) tuples instead of cells.
+
+    Looks the styles up in the workbook's stylesheet the way ReadOnlyCell
+    does, so the result is the same as reading the sheet with openpyxl.
+    """
+
+    def __init__(self, book):
+        super().__init__()
+        self.book = book
+
+    def read(self, cells):
+        empty = self.EMPTY
+        cell_styles = self.book.stylesheet.cell_styles
+        values = tuple(None if cell is None else cell[0] for cell in cells[:BASE_MAX_COL])
+        values += empty[len(values):]
+        ids = []
+        for cell in cells[:BASE_MAX_COL]:
+            if cell is None or not cell[1]:
+                ids.append(None)
+                continue
+            array = cell_styles[cell[1]]
+            key = tuple(array)
+            if key not in self._style_index:
+                stylesheet = self.book.stylesheet
+                self._style_index[key] = len(self.styles)
+                self.styles.append((stylesheet.fonts[array.fontId], stylesheet.fills[array.fillId],
+                                    stylesheet.borders[array.borderId], stylesheet.alignments[array.alignmentId],
+                                    self.book.number_format(cell[1]), stylesheet.protections[array.protectionId]))
+            ids.append(self._style_index[key])
+        ids = tuple(ids) + empty[len(ids):]
+        content = has_content(cell[0] for cell in cells if cell is not None)
+        return values, self._row_styles.setdefault(ids, ids), content
+
+
+def read_base_sheet(ws, progress=None):
+    """
+    Read columns A–I of a read-only 標準成本結構表 worksheet in one pass.
+
+    Args:
+        ws (ReadOnlyWorksheet | FastWorksheet): The 標準成本結構表 worksheet.
+        progress (Progress, optional): Advanced once per row read.
+
+    Returns:
+        BaseSheet: The parsed sheet.
+    """
+    reader = FastRowReader(ws.book) if isinstance(ws, xlsx.FastWorksheet) else RowReader()
+    rows = []
+    style_ids = []
+    max_row = 0
+    last_value_row = 0
+
+    for row_num, cells in enumerate(ws.iter_rows(), start=1):
+        values, ids, content = reader.read(cells)
+        rows.append(values)
+        style_ids.append(ids)
+        if content:
+            max_row = row_num
+        if values != RowReader.EMPTY:
+            last_value_row = row_num
+        if progress is not None:
+            progress.advance()
+
+    keep = max(max_row, last_value_row)
+    return BaseSheet(rows[:keep], style_ids[:keep], reader.styles, max_row)
+
+
+def read_base_values(ws, progress=None):
+    """
+    Read columns A–I of a read-only 標準成本結構表 worksheet like read_base_sheet,
+    but only their values: every cell reads as unstyled. For callers that
+    calculate costs without writing an output, such as costdiff.
+
+    Args:
+        ws (ReadOnlyWorksheet | FastWorksheet): The 標準成本結構表 worksheet.
+        progress (Progress, optional): Advanced once per row read.
+
+    Returns:
+        BaseSheet: The parsed sheet.
+    """
+    empty = RowReader.EMPTY
+    rows = []
+    max_row = 0
+    last_value_row = 0
+
+    for row_num, row in enumerate(ws.iter_rows(values_only=True), start=1):
+        values = tuple(row[:BASE_MAX_COL])
+        values += empty[len(values):]
+        rows.append(values)
+        if has_content(row):
+            max_row = row_num
+        if values != empty:
+            last_value_row = row_num
+        if progress is not None:
+            progress.advance()
+
+    keep = max(max_row, last_value_row)
+    return BaseSheet(rows[:keep], [empty] * keep, [], max_row)
+
+
+class BaseChunk(BaseSheet):
+    """
+    A block of consecutive 標準成本結構表 rows starting at `first_row`, with the
+    BaseSheet interface so calculate_row and the engines work on it unchanged.
+    Rows outside the block read as empty.
+    """
+
+    def __init__(self, first_row, rows, style_ids, styles):
+        super().__init__(rows, style_ids, styles, first_row + len(rows) - 1)
+        self.first_row = first_row
+
+    def value(self, row, col):
+        index = row - self.first_row
+        if not 0 <= index < len(self.rows) or col > BASE_MAX_COL:
+            return None
+        return self.rows[index][col - 1]
+
+    def column_values(self, col, min_row=1):
+        for values in self.rows[max(min_row - self.first_row, 0):]:
+            yield values[col - 1]
+
+    def style_id(self, row, col):
+        index = row - self.first_row
+        if not 0 <= index < len(self.rows) or col > BASE_MAX_COL:
+            return None
+        return self.style_ids[index][col - 1]
+
+
+class ChunkedBaseReader:
+    """
+    Stream 標準成本結構表 in BaseChunks of a fixed number of rows.
+
+    End of data is found in the same pass: blank rows are held back (run-length
+    encoded, so trailing formatted rows cost almost nothing) and only released
+    into a chunk when a row with content follows them. After chunks() is
+    exhausted, max_row is the last row with content, as in read_base_sheet.
+    """
+
+    def __init__(self, ws, chunk_size, min_row=5, progress=None):
+        """
+        Args:
+            ws (ReadOnlyWorksheet): The 標準成本結構表 worksheet.
+            chunk_size (int): Rows per chunk.
+            min_row (int): First row to put into chunks; earlier rows only count for max_row.
+            progress (Progress, optional): Advanced once per row read.
+        """
+        self.ws = ws
+        self.chunk_size = chunk_size
+        self.min_row = min_row
+        self.progress = progress
+        self.reader = RowReader()
+        self.max_row = 0
+        self.tail = []  # values of every row from min_row on that was held back as blank
+
+    def chunks(self):
+        """
+        Yield BaseChunks of up to chunk_size rows, in order, ending at max_row.
+        """
+        reader = self.reader
+        first_row = None
+        rows = []
+        style_ids = []
+        pending = []  # [values, style_ids, count] runs of blank rows
+        pending_start = None
+
+        for row_num, cells in enumerate(self.ws.iter_rows(), start=1):
+            if self.progress is not None:
+                self.progress.advance()
+            values, ids, content = reader.read(cells)
+            if content:
+                self.max_row = row_num
+            if row_num < self.min_row:
+                continue
+            if not content:
+                if pending and pending[-1][0] == values and pending[-1][1] == ids:
+                    pending[-1][2] += 1
+                else:
+                    pending.append([values, ids, 1])
+                if pending_start is None:
+                    pending_start = row_num
+                continue
+
+            if first_row is None:
+                first_row = pending_start or row_num
+            for blank_values, blank_ids, count in pending:
+                for _ in range(count):
+                    rows.append(blank_values)
+                    style_ids.append(blank_ids)
+                    if len(rows) >= self.chunk_size:
+                        yield BaseChunk(first_row, rows, style_ids, reader.styles)
+                        first_row += len(rows)
+                        rows, style_ids = [], []
+            pending = []
+            pending_start = None
+            rows.append(values)
+            style_ids.append(ids)
+            if len(rows) >= self.chunk_size:
+                yield BaseChunk(first_row, rows, style_ids, reader.styles)
+                first_row += len(rows)
+                rows, style_ids = [], []
+
+        if rows:
+            yield BaseChunk(first_row, rows, style_ids, reader.styles)
+        self.tail = [values for values, _, count in pending for _ in range(count) if values != RowReader.EMPTY]
+
+
+def peek_output_name(input_path):
+    """
+    Read just enough of 標準成本結構表 for the output file name.
+
+    Streams column A and B from row 5 and stops at the first parent label
+    (a column A value not starting with 。) once the main name (first column B
+    value) is known, so large workbooks are not parsed in full.
+
+    Args:
+        input_path (str): 輸入 Excel 檔案路徑
+
+    Returns:
+        tuple: (label, label_name), either None if the sheet has none.
+    """
+    wb = openpyxl.load_workbook(input_path, read_only=True)
+    try:
+        ws = wb[BASE_SHEET]
+        ws.reset_dimensions()
+        label = None
+        label_name = None
+        for a, b in ws.iter_rows(min_row=5, max_col=2, values_only=True):
+            if label is None and a is not None and not a.startswith('。'):
+                label = a
+            if label_name is None and b is not None:
+                label_name = b
+            if label is not None and label_name is not None:
+                break
+        return label, label_name
+    finally:
+        wb.close()
+
+
+def file_key(path):
+    """
+    Identify a file version by absolute path, modification time and size.
+    """
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_mtime_ns, stat.st_size
+
+
+class LoadedModels:
+    """
+    The most recently loaded CostModels, reused while their file is unchanged.
+
+    Lets the GUI load a workbook in the background as soon as it is selected
+    and hand the result to the run. Loads are serialised, so a run that starts
+    while the same file is still being preloaded waits for it instead of
+    loading twice.
+    """
+
+    def __init__(self, capacity=1):
+        self.capacity = capacity
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, input_path, cache=None, metrics=None, progress=None, fast_reader=False):
+        """
+        Return the CostModel of a workbook, loading it only if this version is not held.
+
+        Args:
+            input_path (str): 輸入 Excel 檔案路徑
+            cache (ReferenceCache, optional): See load_cost_model.
+            metrics (RunMetrics, optional): See load_cost_model; also counts model_cache_hits.
+            progress (Progress, optional): See load_cost_model.
+            fast_reader (bool): See load_cost_model.
+
+        Returns:
+            CostModel: The parsed input.
+        """
+        with self._lock:
+            key = file_key(input_path)
+            model = self._models.get(key)
+            if model is not None:
+                self._models.move_to_end(key)
+                if metrics is not None:
+                    metrics.count('model_cache_hits')
+                return model
+
+            model = load_cost_model(input_path, cache, metrics, progress, fast_reader)
+            # Another version of the same file will not be asked for again.
+            for old_key in [k for k in self._models if k[0] == key[0]]:
+                del self._models[old_key]
+            self._models[key] = model
+            while len(self._models) > self.capacity:
+                self._models.popitem(last=False)
+            return model
+
+
+def reference_digests(input_path):
+    """
+    Hash the reference sheets of a workbook for cache lookups.
+
+    Args:
+        input_path (str): 輸入 Excel 檔案路徑
+
+    Returns:
+        dict: Sheet name -> content digest; empty if the file cannot be scanned.
+    """
+    try:
+        return xlsx.sheet_digests(input_path, REFERENCE_INDEXERS)
+    except (zipfile.BadZipFile, KeyError, ET.ParseError, OSError):
+        return {}
+
+
+def read_reference_tables(sheets, digests, cache=None, metrics=None, progress=None):
+    """
+    Index the three reference sheets, reusing cached indexes where possible.
+
+    Args:
+        sheets (dict): Sheet name -> read-only worksheet, for every sheet in REFERENCE_INDEXERS.
+        digests (dict): Sheet name -> content digest from reference_digests; sheets
+            without a digest are always parsed and never cached.
+        cache (ReferenceCache, optional): Cache of parsed reference indexes.
+        metrics (RunMetrics, optional): Receives the reference cache hit counts.
+        progress (Progress, optional): Checked for cancellation between sheets.
+
+    Returns:
+        ReferenceTables: The indexed tables.
+    """
+    indexes = []
+    for name, build_index in REFERENCE_INDEXERS.items():
+        if progress is not None:
+            progress.check()
+        key = cache.make_key(name, digests[name]) if cache is not None and name in digests else None
+        index = cache.get(key) if key else None
+        if key and metrics is not None:
+            metrics.count('reference_cache_hits' if index is not None else 'reference_cache_misses')
+        if index is None:
+            ws = sheets[name]
+            ws.reset_dimensions()
+            index = build_index(ws.iter_rows(min_row=2, values_only=True))
+            if key:
+                cache.put(key, index)
+        indexes.append(index)
+
+    coefficients, prices, (mm_index, mm_error) = indexes
+    return ReferenceTables(coefficients, prices, mm_index, mm_error)
+
+
+def open_read_only(input_path):
+    """
+    Open a workbook with openpyxl in read-only mode.
+    """
+    return openpyxl.load_workbook(input_path, read_only=True)
+
+
+def load_cost_model(input_path, cache=None, metrics=None, progress=None, fast_reader=False, values_only=False,
+                    price_store=None):
+    """
+    Load the four required sheets of an input workbook into a CostModel.
+
+    The workbook is opened read-only, so cells are streamed once and no
+    worksheet objects are kept after loading. With a cache, reference sheets
+    whose content hash is already cached are not parsed at all.
+
+    Args:
+        input_path (str): 輸入 Excel 檔案路徑
+        cache (ReferenceCache, optional): Cache of parsed reference indexes.
+        metrics (RunMetrics, optional): Receives the load.open, load.base and
+            load.reference timings and the reference cache hit counts.
+        progress (Progress, optional): Reports the load phase; its row total is not known in advance.
+        fast_reader (bool): Read the sheets with xlsx.FastWorkbook instead of
+            openpyxl, giving the same model with much less work per cell. Files
+            it cannot read, or a missing lxml, fall back to openpyxl (counted as
+            fast_reader_fallbacks).
+        values_only (bool): Read 標準成本結構表 without styles, see read_base_values.
+        price_store (PriceStore, optional): Take the reference data from this
+            store (see pricestore.PriceStore.reference_tables) instead of the
+            workbook, which then only needs 標準成本結構表; cache is not used.
+
+    Returns:
+        CostModel: The parsed input.
+    """
+    metrics = metrics or instrument.RunMetrics()
+    if fast_reader:
+        try:
+            return _load_cost_model(input_path, xlsx.FastWorkbook, cache, metrics, progress, values_only, price_store)
+        except Cancelled:
+            raise
+        except Exception:
+            metrics.count('fast_reader_fallbacks')
+    return _load_cost_model(input_path, open_read_only, cache, metrics, progress, values_only, price_store)
+
+
+def _load_cost_model(input_path, open_workbook, cache, metrics, progress, values_only=False, price_store=None):
+    if progress is not None:
+        progress.start('load')
+    with metrics.phase('load.open'):
+        digests = reference_digests(input_path) if cache is not None and price_store is None else {}
+        wb = open_workbook(input_path)
+    try:
+        names = (BASE_SHEET,) if price_store is not None else (BASE_SHEET, *REFERENCE_INDEXERS)
+        sheets = {name: wb[name] for name in names}
+        with metrics.phase('load.base'):
+            base_ws = sheets[BASE_SHEET]
+            # ERP exports do not always write a reliable dimension record.
+            base_ws.reset_dimensions()
+            base = (read_base_values if values_only else read_base_sheet)(base_ws, progress)
+
+        with metrics.phase('load.reference'):
+            if price_store is not None:
+                tables = price_store.reference_tables(base, metrics)
+            else:
+                tables = read_reference_tables(sheets, digests, cache, metrics, progress)
+    finally:
+        wb.close()
+
+    return CostModel(base, tables)
@@ -1,57 +1,311 @@
-import openpyxl
 from openpyxl import Workbook
 import excel
+import export
+import incremental
+import instrument
 import style
+import loader
+import refcache
+import resultcache
+import stream
+import writer
+import xlsx
 import sys
 
-def main(input_path, output_path):
+ENGINES = ('python', 'pandas')
+# Options of main that change the output, with their defaults; part of the result cache key.
+RESULT_OPTIONS = {'write_only': True, 'engine': 'python', 'chunk_size': None, 'rollup': False}
+
+def calculate_costs(model, engine):
     """
-    Main function to read base workbook, generate new formatted sheet,
-    copy data and styles, and save as new Excel file.
+    Precompute the costs of all BOM rows with the chosen engine.
 
     Args:
-        input_path (str): 輸入 Excel 檔案路徑
+        model (CostModel): The parsed input workbook.
+        engine (str): 'python' calculates row by row while writing, so nothing is
+            precomputed; 'pandas' calculates every row at once with array operations.
+
+    Returns:
+        list: calculate_row results from row 6 on, or None for the 'python' engine.
+    """
+    if engine not in ENGINES:
+        raise ValueError(f"未知的計算引擎: {engine}")
+    if engine == 'python':
+        return None
+    # pandas is only imported when its engine is chosen.
+    import engine as pandas_engine
+    return pandas_engine.calculate_rows(model.base, model.tables, 6, model.base.max_row - 5)
+
+def write_cost_sheet(model, output_path, write_only=True, engine='python', metrics=None, progress=None, exports=(),
+                     rollup=False):
+    """
+    Generate the formatted cost sheet from a loaded input and save it.
+
+    Args:
+        model (CostModel): The parsed input workbook.
         output_path (str): 輸出 Excel 檔案路徑
+        write_only (bool): Stream rows through a write-only workbook with named
+            styles instead of building and styling the sheet cell by cell.
+        engine (str): Cost calculation engine, one of ENGINES.
+        metrics (RunMetrics, optional): Receives the timing of every step.
+        progress (Progress, optional): Reports each step row by row and stops
+            the run with progress.Cancelled when its token is cancelled.
+        exports (list, optional): Open export files (see export.open_exports)
+            that also receive the calculated rows and totals.
+        rollup (bool): Add a 組件小計 sheet with the cost subtotal of every
+            assembly of the BOM tree, see writer.write_rollup.
+
+    Returns:
+        tuple: What writer.write_output returns when write_only is set, None otherwise.
     """
-    wb_base = openpyxl.load_workbook(input_path)
-    base_sheet = wb_base['標準成本結構表']
-    weight_sheet = wb_base['鐵板重量計算']
-    material_sheet = wb_base['鐵板材料費單價']
-    mm_sheet = wb_base['鐵板米數計算']
+    metrics = metrics or instrument.RunMetrics()
+    if progress is not None and engine != 'python':
+        progress.start('calculate_costs')
+    with metrics.phase('calculate_costs'):
+        costs = calculate_costs(model, engine)
+    if write_only:
+        return writer.write_output(model, output_path, costs, metrics, progress, exports, rollup)
+
+    base = model.base
 
     new_wb = Workbook()
     output_sheet = new_wb.active
     excel.write_excel_header(output_sheet)
     excel.set_column_widths(output_sheet)
-    total_row = style.copy_columns_with_style(
-        ws_src=base_sheet,
-        ws_dest=output_sheet,
-        src_cols='A:H',
-        src_start_row=5,
-        dest_start_row=3,
-        dest_start_col=3
-    )
-    style.copy_columns_with_style(
-        ws_src=base_sheet,
-        ws_dest=output_sheet,
-        src_cols='I:I',
-        src_start_row=5,
-        dest_start_row=3,
-        dest_start_col=17
-    )
-    labels, label_nums = excel.get_labels_and_numbers(base_sheet)
-    label_name = excel.get_main_name(base_sheet)
-    excel.fill_query_no(output_sheet, labels, label_nums)
-    excel.set_basic_styles(output_sheet, total_row)
-
-    excel.calculate_and_write_output(base_sheet, output_sheet, weight_sheet, material_sheet, mm_sheet, total_row, 6, 4)
-    excel.total_result(output_sheet, total_row)
-
-    output_sheet.title = f'{labels[0]}{label_name[0:5]} (成本計算)'
-    new_wb.save(output_path)
+    if progress is not None:
+        progress.start('copy_columns_with_style', 2 * max(base.max_row - 4, 0))
+    with metrics.phase('copy_columns_with_style'):
+        total_row = style.copy_columns_with_style(
+            base=base,
+            ws_dest=output_sheet,
+            src_cols='A:H',
+            src_start_row=5,
+            dest_start_row=3,
+            dest_start_col=3,
+            progress=progress
+        )
+        style.copy_columns_with_style(
+            base=base,
+            ws_dest=output_sheet,
+            src_cols='I:I',
+            src_start_row=5,
+            dest_start_row=3,
+            dest_start_col=17,
+            progress=progress
+        )
+    with metrics.phase('fill_query_no'):
+        labels, label_nums = excel.get_labels_and_numbers(base)
+        label_name = excel.get_main_name(base)
+        excel.fill_query_no(output_sheet, labels, label_nums)
+    with metrics.phase('set_basic_styles'):
+        excel.set_basic_styles(output_sheet, total_row, progress)
+
+    with metrics.phase('calculate_and_write_output'):
+        excel.calculate_and_write_output(base, output_sheet, model.tables, total_row, 6, 4, costs, metrics, progress)
+        excel.total_result(output_sheet, total_row)
+        results = writer.RowResults(exports, keep_totals=rollup)
+        cached = {output_sheet: writer.fill_formula_values(output_sheet, total_row, results)}
+
+    output_sheet.title = excel.get_sheet_title(labels, label_name)
+    if rollup:
+        cached.update(writer.write_rollup(new_wb, model, output_sheet.title, results, metrics))
+    if progress is not None:
+        progress.start('save')
+    with metrics.phase('save'):
+        xlsx.save_workbook(new_wb, output_path, cached=cached)
+    with metrics.phase('export'):
+        results.finish()
+
+def main(input_path, output_path, write_only=True, use_cache=True, engine='python',
+         metrics=None, profile_dir=None, log=True, models=None, progress=None, chunk_size=None,
+         incremental_update=False, cache=None, export_formats=(), fast_reader=False, rollup=False,
+         price_store=None):
+    """
+    Main function to read base workbook, generate new formatted sheet,
+    copy data and styles, and save as new Excel file.
+
+    Args:
+        input_path (str): 輸入 Excel 檔案路徑
+        output_path (str): 輸出 Excel 檔案路徑
+        write_only (bool): See write_cost_sheet.
+        use_cache (bool): Reuse parsed reference sheets from the on-disk cache.
+        engine (str): Cost calculation engine, 'python' or 'pandas'.
+        metrics (RunMetrics, optional): Collects the measurements, e.g. one
+            created with trace_memory=True for per-phase heap peaks.
+        profile_dir (str, optional): Write a cProfile profile and a tracemalloc
+            snapshot of the run to this directory.
+        log (bool): Append the measurements to the run log (instrument.default_log_path()),
+            failed runs included.
+        models (LoadedModels, optional): Reuse the model of an unchanged input
+            loaded earlier, e.g. preloaded by the GUI when the file was selected.
+        progress (Progress, optional): Receives phase and row progress and
+            carries the cancel token; a cancelled run raises progress.Cancelled
+            and leaves no output file.
+        chunk_size (int, optional): Read, calculate and write 標準成本結構表 in
+            chunks of this many rows (see stream.stream_cost_sheet), keeping memory
+            flat for very large BOMs. write_only, models and incremental_update do not apply then.
+        incremental_update (bool): Keep a manifest next to the output and, when the
+            output already exists, only rewrite the rows that changed since it was
+            built (see incremental.update_output). Falls back to a full build.
+            Off by default; only outputs built with write_only are patched.
+        cache (ReferenceCache, optional): Reference cache to use when use_cache is
+            set, e.g. a MemoryReferenceCache kept by a long-running process;
+            the default on-disk cache otherwise.
+        export_formats (list, optional): Also save the calculated rows and totals
+            next to the output in these formats, out of export.EXPORT_FORMATS.
+        fast_reader (bool): Read the input with the lxml reader, see loader.load_cost_model.
+        rollup (bool): Add a 組件小計 sheet, see write_cost_sheet. The output is
+            then always built in full: incremental_update does not apply, and
+            neither does rollup with chunk_size.
+        price_store (PriceStore, optional): Take the reference data from this
+            shared store instead of the input's reference sheets, see
+            loader.load_cost_model. models is not used then, and chunk_size is not supported.
+
+    Returns:
+        dict: Timings of the run, see RunMetrics.as_dict.
+    """
+    metrics = metrics or instrument.RunMetrics()
+    record = {'input': input_path, 'output': output_path, 'write_only': write_only, 'engine': engine}
+    if chunk_size:
+        record['chunk_size'] = chunk_size
+    elif incremental_update:
+        record['incremental'] = True
+    if export_formats:
+        record['exports'] = list(export_formats)
+    if fast_reader:
+        record['fast_reader'] = True
+    if rollup:
+        record['rollup'] = True
+    if price_store is not None:
+        record['price_store'] = price_store.path
+        record['price_snapshot'] = price_store.snapshot
+    # The 組件小計 sheet is not patched, so its outputs are always built in full;
+    # a patch relies on the rows as writer.write_output serializes them.
+    incremental_update = incremental_update and write_only and not rollup
+    tables = None
+    exports = []
+    try:
+        with instrument.profiling(profile_dir, metrics):
+            cache = (cache or refcache.ReferenceCache()) if use_cache else None
+            exports = export.open_exports(output_path, export_formats)
+            if chunk_size and price_store is not None:
+                raise ValueError("分段串流模式不支援價格資料庫")
+            if chunk_size:
+                if engine not in ENGINES:
+                    raise ValueError(f"未知的計算引擎: {engine}")
+                tables = stream.stream_cost_sheet(input_path, output_path, cache, chunk_size, engine,
+                                                  metrics, progress, exports)
+            else:
+                with metrics.phase('load'):
+                    if models is not None and price_store is None:
+                        model = models.load(input_path, cache, metrics, progress, fast_reader)
+                    else:
+                        model = loader.load_cost_model(input_path, cache, metrics, progress, fast_reader,
+                                                       price_store=price_store)
+                tables = model.tables
+                # A reused model still holds the lookup counts of its previous run.
+                tables.lookups.clear()
+                metrics.rows = max(model.base.max_row - 4, 0)
+                if not (incremental_update and incremental.update_output(model, output_path, metrics, progress,
+                                                                         exports)):
+                    built = write_cost_sheet(model, output_path, write_only, engine, metrics, progress, exports,
+                                             rollup)
+                    if incremental_update:
+                        results, registry = built
+                        with metrics.phase('diff'):
+                            manifest = incremental.build_manifest(model, output_path, results.row_totals,
+                                                                  incremental.style_index(registry))
+                            incremental.write_manifest(manifest, output_path)
+            if progress is not None:
+                progress.finish()
+    except Exception as e:
+        export.abort_exports(exports)
+        if log:
+            if tables is not None:
+                metrics.counters.update(tables.lookups)
+            instrument.write_log({**record, **metrics.as_dict(), 'error': str(e)})
+        raise
+
+    metrics.counters.update(tables.lookups)
+    result = metrics.as_dict()
+    if log:
+        instrument.write_log({**record, **result, 'error': None})
+    return result
+
+def result_key(result_cache, input_path, options):
+    """
+    Build the result cache key of a run of main, from the options in
+    RESULT_OPTIONS and the digest of the price snapshot when price_store is used.
+
+    Args:
+        result_cache (ResultCache): The cache the key is for.
+        input_path (str): 輸入 Excel 檔案路徑
+        options (dict): Arguments of main.
+
+    Returns:
+        str: The key, or None if the input or the price snapshot cannot be read.
+    """
+    key_options = {name: options.get(name, default) for name, default in RESULT_OPTIONS.items()}
+    try:
+        if options.get('price_store') is not None:
+            key_options['price_store'] = options['price_store'].digest()
+        return result_cache.make_key(input_path, key_options)
+    except Exception:
+        # main reports the unreadable input or the missing price snapshot.
+        return None
+
+def cached_main(input_path, output_path, result_cache=None, **options):
+    """
+    Run main, or copy the output of an identical earlier run from the result cache.
+
+    Runs are identical when the input bytes, the code version and the options
+    in RESULT_OPTIONS are, see resultcache.ResultCache, and so are the
+    contents of the price snapshot when price_store is used. A hit is a file copy
+    instead of a full run; with incremental_update the manifest saved with the
+    output is restored too, so a later changed input is still patched. Runs
+    with export_formats bypass the cache, which only keeps the Excel output.
+
+    Args:
+        input_path (str): 輸入 Excel 檔案路徑
+        output_path (str): 輸出 Excel 檔案路徑
+        result_cache (ResultCache, optional): Defaults to the on-disk cache next to the reference cache.
+        **options: Other arguments of main.
+
+    Returns:
+        dict: Timings of the run, see RunMetrics.as_dict; a hit counts result_cache_hits.
+    """
+    if options.get('export_formats'):
+        return main(input_path, output_path, **options)
+    result_cache = result_cache or resultcache.ResultCache()
+    metrics = options['metrics'] = options.get('metrics') or instrument.RunMetrics()
+    progress = options.get('progress')
+    if progress is not None:
+        progress.start('result_cache')
+    with metrics.phase('result_cache'):
+        key = result_key(result_cache, input_path, options)
+        hit = result_cache.fetch(key, output_path) if key is not None else None
+
+    if hit is None:
+        result = main(input_path, output_path, **options)
+        if key is not None:
+            manifest = incremental.read_manifest(output_path) if options.get('incremental_update') else None
+            result_cache.put(key, output_path, result['rows'], manifest)
+        return result
+
+    if hit['manifest'] is not None and options.get('incremental_update'):
+        incremental.write_manifest(hit['manifest'], output_path)
+    metrics.rows = hit['rows']
+    metrics.count('result_cache_hits')
+    if progress is not None:
+        progress.finish()
+    result = metrics.as_dict()
+    if options.get('log', True):
+        instrument.write_log({'input': input_path, 'output': output_path, 'result_cache': True,
+                              **result, 'error': None})
+    return result
 
 if __name__ == "__main__":
     if len(sys.argv) == 3:
-        main(sys.argv[1], sys.argv[2])
+        cached_main(sys.argv[1], sys.argv[2])
     else:
         print("用法: python main.py <輸入檔案路徑> <輸出檔案路徑>")
@@ -0,0 +1,312 @@
+import argparse
+import hashlib
+import os
+import pickle
+import sqlite3
+import sys
+import time
+from contextlib import closing
+
+import loader
+import refcache
+from reference import ReferenceTables, to_number
+from writer import BASE_FIRST_ROW
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS snapshots ('
+    'id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, source TEXT, created REAL NOT NULL, '
+    'digest TEXT NOT NULL, mm_error TEXT)',
+    # Value columns have no declared type, so ints, floats and text keep their
+    # type and compare the way the dict lookups of ReferenceTables do.
+    'CREATE TABLE IF NOT EXISTS coefficients ('
+    'snapshot INTEGER NOT NULL, material NOT NULL, coefficient, PRIMARY KEY (snapshot, material))',
+    'CREATE TABLE IF NOT EXISTS prices ('
+    'snapshot INTEGER NOT NULL, material NOT NULL, thickness NOT NULL, price, '
+    'PRIMARY KEY (snapshot, material, thickness))',
+    'CREATE TABLE IF NOT EXISTS mm ('
+    'snapshot INTEGER NOT NULL, material NOT NULL, thickness REAL NOT NULL, position INTEGER NOT NULL, mm, '
+    'PRIMARY KEY (snapshot, material, thickness, position))',
+)
+# The 米數 at or above a thickness: the first row of the smallest listed
+# thickness, found with one seek of the mm primary key per BOM key.
+NEAREST_MM = (
+    'SELECT w.material, m.thickness, m.mm FROM wanted w JOIN mm m ON m.rowid = ('
+    'SELECT rowid FROM mm WHERE snapshot = ? AND material = w.material AND thickness >= w.thickness '
+    'ORDER BY thickness, position LIMIT 1)'
+)
+
+
+def default_store_path():
+    """
+    Get the default price store file, next to the reference cache.
+    """
+    return os.path.join(refcache.default_cache_dir(), 'prices.sqlite3')
+
+
+def tables_digest(tables):
+    """
+    Hash the contents of ReferenceTables, to recognise an import that changes nothing.
+    """
+    mm_error = None if tables.mm_error is None else str(tables.mm_error)
+    data = (tables.coefficients, tables.prices, tables.mm_index, mm_error)
+    return hashlib.sha256(pickle.dumps(data, protocol=4)).hexdigest()
+
+
+def bom_keys(base):
+    """
+    Get the reference keys a BOM looks up: the (material, thickness) of every
+    row calculate_row would calculate.
+
+    Rows with an empty column D–G or a thickness that does not convert are
+    skipped; calculate_row handles them without a lookup.
+
+    Args:
+        base (BaseSheet): The parsed 標準成本結構表 sheet.
+
+    Returns:
+        set: (material, thickness) pairs.
+    """
+    keys = set()
+    for row in range(BASE_FIRST_ROW + 1, base.max_row + 1):
+        values = base.row_values(row, 4, 7)
+        if None in values or '' in values:
+            continue
+        thickness = to_number(values[1])
+        if thickness is not None:
+            keys.add((values[0], thickness))
+    return keys
+
+
+class PriceStore:
+    """
+    Shared SQLite store of the three reference sheets, kept as numbered
+    snapshots, so input workbooks only need 標準成本結構表.
+
+    Each import of 鐵板重量計算, 鐵板材料費單價 and 鐵板米數計算 becomes a new
+    snapshot; runs use the latest one unless a snapshot is chosen by id or
+    name. Unlike the caches, the store is the source of the reference data:
+    a missing snapshot fails the run.
+
+    Args:
+        path (str, optional): Database file, default_store_path() by default.
+        snapshot (int | str, optional): Snapshot id or name to use; None for the latest.
+    """
+
+    def __init__(self, path=None, snapshot=None):
+        self.path = path or default_store_path()
+        self.snapshot = snapshot
+
+    def _connect(self):
+        folder = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(folder, exist_ok=True)
+        # A connection per call keeps the store usable from worker threads and processes.
+        conn = sqlite3.connect(self.path, timeout=30)
+        for statement in SCHEMA:
+            conn.execute(statement)
+        return conn
+
+    def _resolve(self, conn):
+        # The row of the chosen snapshot: (id, name, digest, mm_error).
+        if self.snapshot is None:
+            row = conn.execute('SELECT id, name, digest, mm_error FROM snapshots ORDER BY id DESC LIMIT 1').fetchone()
+            if row is None:
+                raise Exception("價格資料庫中沒有任何價格版本，請先匯入參照表")
+            return row
+        column = 'id' if isinstance(self.snapshot, int) else 'name'
+        row = conn.execute(f'SELECT id, name, digest, mm_error FROM snapshots WHERE {column} = ? '
+                           'ORDER BY id DESC LIMIT 1', (self.snapshot,)).fetchone()
+        if row is None:
+            raise Exception(f"價格資料庫中找不到價格版本：{self.snapshot}")
+        return row
+
+    def import_tables(self, tables, name=None, source=None):
+        """
+        Store ReferenceTables as a new snapshot.
+
+        An import identical to the latest snapshot adds nothing and returns it.
+
+        Args:
+            tables (ReferenceTables): Indexed reference sheets.
+            name (str, optional): Name of the snapshot, e.g. '2026Q4'.
+            source (str, optional): Where the tables come from, e.g. the workbook path.
+
+        Returns:
+            tuple: (snapshot id, created) where created is False for an unchanged import.
+        """
+        digest = tables_digest(tables)
+        mm_error = None if tables.mm_error is None else str(tables.mm_error)
+        with closing(self._connect()) as conn, conn:
+            latest = conn.execute('SELECT id, digest FROM snapshots ORDER BY id DESC LIMIT 1').fetchone()
+            if latest is not None and latest[1] == digest and name is None:
+                return latest[0], False
+            snapshot = conn.execute('INSERT INTO snapshots (name, source, created, digest, mm_error) '
+                                    'VALUES (?, ?, ?, ?, ?)',
+                                    (name, source, time.time(), digest, mm_error)).lastrowid
+            # Blank materials and thicknesses are never looked up.
+            conn.executemany('INSERT INTO coefficients VALUES (?, ?, ?)',
+                             ((snapshot, material, coefficient)
+                              for material, coefficient in tables.coefficients.items() if material is not None))
+            conn.executemany('INSERT INTO prices VALUES (?, ?, ?, ?)',
+                             ((snapshot, material, thickness, price)
+                              for (material, thickness), price in tables.prices.items()
+                              if material is not None and thickness is not None))
+            conn.executemany('INSERT INTO mm VALUES (?, ?, ?, ?, ?)',
+                             ((snapshot, material, thickness, position, value)
+                              for material, (thicknesses, values) in tables.mm_index.items() if material is not None
+                              for position, (thickness, value) in enumerate(zip(thicknesses, values))))
+            return snapshot, True
+
+    def import_workbook(self, input_path, name=None):
+        """
+        Import the three reference sheets of a workbook as a new snapshot, see import_tables.
+
+        Returns:
+            tuple: (snapshot id, created).
+        """
+        wb = loader.open_read_only(input_path)
+        try:
+            missing = [sheet for sheet in loader.REFERENCE_INDEXERS if sheet not in wb.sheetnames]
+            if missing:
+                raise Exception(f"缺少工作表：{'、'.join(missing)}")
+            tables = loader.read_reference_tables({sheet: wb[sheet] for sheet in loader.REFERENCE_INDEXERS}, {})
+        finally:
+            wb.close()
+        return self.import_tables(tables, name, os.path.abspath(input_path))
+
+    def snapshots(self):
+        """
+        List the snapshots, oldest first.
+
+        Returns:
+            list: Dicts with id, name, source, created, coefficients, prices and mm (row counts).
+        """
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                'SELECT s.id, s.name, s.source, s.created, '
+                '(SELECT COUNT(*) FROM coefficients WHERE snapshot = s.id), '
+                '(SELECT COUNT(*) FROM prices WHERE snapshot = s.id), '
+                '(SELECT COUNT(*) FROM mm WHERE snapshot = s.id) '
+                'FROM snapshots s ORDER BY s.id').fetchall()
+        keys = ('id', 'name', 'source', 'created', 'coefficients', 'prices', 'mm')
+        return [dict(zip(keys, row)) for row in rows]
+
+    def digest(self):
+        """
+        Get the content digest of the chosen snapshot, e.g. for result cache keys.
+        """
+        with closing(self._connect()) as conn:
+            return self._resolve(conn)[2]
+
+    def reference_tables(self, base=None, metrics=None):
+        """
+        Get ReferenceTables from the chosen snapshot.
+
+        With a BOM, only its keys (see bom_keys) are fetched, in three batched
+        queries through a temporary table: the coefficients of its materials,
+        the prices of its (material, thickness) pairs and, for each pair, the
+        米數 of the nearest listed thickness at or above it. The tables then
+        hold exactly the entries the BOM's lookups can reach, so every lookup
+        gives what the full tables would.
+
+        Args:
+            base (BaseSheet, optional): The parsed 標準成本結構表 sheet; None loads the whole snapshot.
+            metrics (RunMetrics, optional): Counts the keys queried as price_store_keys.
+
+        Returns:
+            ReferenceTables: The tables.
+        """
+        with closing(self._connect()) as conn:
+            snapshot, _, _, mm_error = self._resolve(conn)
+            if base is None:
+                coefficients = conn.execute('SELECT material, coefficient FROM coefficients WHERE snapshot = ?',
+                                            (snapshot,)).fetchall()
+                prices = conn.execute('SELECT material, thickness, price FROM prices WHERE snapshot = ?',
+                                      (snapshot,)).fetchall()
+                mm = conn.execute('SELECT material, thickness, mm FROM mm WHERE snapshot = ? '
+                                  'ORDER BY material, thickness, position', (snapshot,)).fetchall()
+            else:
+                keys = bom_keys(base)
+                if metrics is not None:
+                    metrics.count('price_store_keys', len(keys))
+                conn.execute('CREATE TEMP TABLE wanted (material, thickness, PRIMARY KEY (material, thickness))')
+                conn.executemany('INSERT INTO wanted VALUES (?, ?)', keys)
+                coefficients = conn.execute(
+                    'SELECT material, coefficient FROM coefficients WHERE snapshot = ? '
+                    'AND material IN (SELECT material FROM wanted)', (snapshot,)).fetchall()
+                prices = conn.execute(
+                    'SELECT p.material, p.thickness, p.price FROM wanted w JOIN prices p '
+                    'ON p.snapshot = ? AND p.material = w.material AND p.thickness = w.thickness',
+                    (snapshot,)).fetchall()
+                mm = sorted(set(conn.execute(NEAREST_MM, (snapshot,)).fetchall()), key=lambda r: (repr(r[0]), r[1]))
+
+        mm_index = {}
+        for material, thickness, value in mm:
+            thicknesses, values = mm_index.setdefault(material, ([], []))
+            if thicknesses and thicknesses[-1] == thickness:
+                continue  # ties: the first row of a thickness is the one looked up
+            thicknesses.append(thickness)
+            values.append(value)
+        return ReferenceTables(dict(coefficients),
+                               {(material, thickness): price for material, thickness, price in prices},
+                               mm_index, None if mm_error is None else Exception(mm_error))
+
+
+def parse_snapshot(value):
+    """
+    Read a snapshot given on the command line: digits are an id, anything else a name.
+    """
+    if value is None:
+        return None
+    return int(value) if value.isdigit() else value
+
+
+def add_arguments(parser):
+    """
+    Add the --price-store and --price-version options to a command line parser.
+    """
+    parser.add_argument('--price-store', nargs='?', const='', default=None, metavar='資料庫檔案',
+                        help='由共用的價格資料庫取得參照資料，輸入檔只需標準成本結構表（可指定資料庫檔案）')
+    parser.add_argument('--price-version', default=None, metavar='版本',
+                        help='使用的價格版本編號或名稱（預設為最新版本，並隱含 --price-store）')
+
+
+def from_arguments(args):
+    """
+    Get the PriceStore the options of add_arguments ask for, or None.
+    """
+    if args.price_store is None and args.price_version is None:
+        return None
+    return PriceStore(args.price_store or None, parse_snapshot(args.price_version))
+
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description='共用的鐵板參照資料庫：匯入參照表並保留各次匯入的價格版本')
+    parser.add_argument('--store', default=None, help='價格資料庫檔案（預設位於參照表快取資料夾）')
+    commands = parser.add_subparsers(dest='command', required=True)
+    add = commands.add_parser('import', help='匯入 Excel 檔中的鐵板重量計算、鐵板材料費單價與鐵板米數計算')
+    add.add_argument('input', help='含三個參照表的 Excel 檔案')
+    add.add_argument('--name', default=None, help='價格版本名稱，例如 2026Q4')
+    commands.add_parser('list', help='列出所有價格版本')
+    args = parser.parse_args(argv)
+
+    store = PriceStore(args.store)
+    if args.command == 'import':
+        snapshot, created = store.import_workbook(args.input, args.name)
+        if created:
+            print(f'已匯入為價格版本 {snapshot}')
+        else:
+            print(f'參照表與最新的價格版本 {snapshot} 相同，未新增版本')
+        return 0
+
+    snapshots = store.snapshots()
+    if not snapshots:
+        print('價格資料庫中沒有任何價格版本')
+    for item in snapshots:
+        created = time.strftime('%Y-%m-%d %H:%M', time.localtime(item['created']))
+        print(f"{item['id']}\t{item['name'] or ''}\t{created}\t係數 {item['coefficients']} 筆、"
+              f"單價 {item['prices']} 筆、米數 {item['mm']} 筆\t{item['source'] or ''}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(cli())
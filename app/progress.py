@@ -0,0 +1,169 @@
+import threading
+import time
+
+BATCH_SIZE = 200  # rows between cancel checks
+REPORT_INTERVAL = 0.1  # seconds between progress callbacks within a phase
+
+
+class Cancelled(Exception):
+    """
+    Raised inside a run when its CancelToken has been cancelled.
+    """
+
+
+class CancelToken:
+    """
+    Thread-safe flag another thread sets to stop a running job.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def check(self):
+        """
+        Raise Cancelled if the token has been cancelled.
+        """
+        if self._event.is_set():
+            raise Cancelled('已取消執行')
+
+
+class ProgressUpdate:
+    """
+    One progress report: `done` of `total` rows of a phase after `seconds`.
+    total is None for phases whose size is not known in advance.
+    """
+
+    def __init__(self, phase, done, total, seconds):
+        self.phase = phase
+        self.done = done
+        self.total = total
+        self.seconds = seconds
+
+    @property
+    def fraction(self):
+        """
+        Share of the phase completed, or None if the total is unknown.
+        """
+        if not self.total:
+            return None
+        return min(self.done / self.total, 1.0)
+
+    @property
+    def rate(self):
+        """
+        Rows per second so far in this phase.
+        """
+        return self.done / self.seconds if self.seconds > 0 else None
+
+    @property
+    def eta(self):
+        """
+        Estimated seconds until the phase finishes, or None if unknown.
+        """
+        if not self.total or not self.rate:
+            return None
+        return max(self.total - self.done, 0) / self.rate
+
+
+class Progress:
+    """
+    Row-level progress and cancellation passed through the pipeline.
+
+    Phases call start() with their row count and advance() once per row.
+    Every BATCH_SIZE rows the cancel token is checked, and the callback is
+    invoked at most every REPORT_INTERVAL seconds, so a slow listener such as
+    a GUI does not slow the worker down.
+    """
+
+    def __init__(self, callback=None, cancel_token=None, batch_size=BATCH_SIZE, interval=REPORT_INTERVAL):
+        """
+        Args:
+            callback (callable, optional): Called with a ProgressUpdate, on the worker thread.
+            cancel_token (CancelToken, optional): Stops the run with Cancelled when cancelled.
+            batch_size (int): Rows between cancel checks.
+            interval (float): Minimum seconds between callbacks within a phase.
+        """
+        self.callback = callback
+        self.cancel_token = cancel_token
+        self.batch_size = batch_size
+        self.interval = interval
+        self.phase = None
+        self.total = None
+        self.done = 0
+        self._next_check = batch_size
+        self._started = time.perf_counter()
+        self._reported = 0
+
+    def check(self):
+        """
+        Raise Cancelled if the run has been cancelled.
+        """
+        if self.cancel_token is not None:
+            self.cancel_token.check()
+
+    def start(self, phase, total=None):
+        """
+        Begin a phase of `total` rows and report it.
+        """
+        self.check()
+        self.phase = phase
+        self.total = total
+        self.done = 0
+        self._next_check = self.batch_size
+        self._started = time.perf_counter()
+        self._report()
+
+    def advance(self, n=1):
+        """
+        Mark n more rows of the current phase as done.
+        """
+        self.done += n
+        if self.done < self._next_check:
+            return
+        self._next_check = self.done + self.batch_size
+        self.check()
+        if time.perf_counter() - self._reported >= self.interval:
+            self._report()
+
+    def finish(self):
+        """
+        Report the current phase as complete.
+        """
+        if self.total is not None:
+            self.done = self.total
+        self._report()
+
+    def _report(self):
+        self._reported = time.perf_counter()
+        if self.callback is not None:
+            self.callback(ProgressUpdate(self.phase, self.done, self.total, self._reported - self._started))
+
+
+def format_update(update, labels=None):
+    """
+    Describe a progress update for the status bar, e.g.
+    '計算寫入 45%（2700/6000 列，1200 列/秒，剩餘約 2 秒）'.
+
+    Args:
+        update (ProgressUpdate): The update.
+        labels (dict, optional): Phase name -> display name.
+
+    Returns:
+        str: The description.
+    """
+    name = (labels or {}).get(update.phase, update.phase)
+    if update.fraction is None:
+        return f'{name}（{update.done} 列）' if update.done else f'{name}...'
+    text = f'{name} {update.fraction * 100:.0f}%（{update.done}/{update.total} 列'
+    if update.rate:
+        text += f'，{update.rate:.0f} 列/秒'
+    if update.eta is not None:
+        text += f'，剩餘約 {update.eta:.0f} 秒'
+    return text + '）'
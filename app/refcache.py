@@ -0,0 +1,149 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import closing
+
+CACHE_VERSION = 1  # bump when the pickled index layout changes
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_MEMORY_ENTRIES = 32
+
+
+def default_cache_dir():
+    """
+    Get the cache directory, ERP_COST_CACHE_DIR if set, else a per-user folder.
+
+    Returns:
+        str: Directory path.
+    """
+    if os.environ.get('ERP_COST_CACHE_DIR'):
+        return os.environ['ERP_COST_CACHE_DIR']
+    base = os.environ.get('LOCALAPPDATA') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'erp-cost')
+
+
+class ReferenceCache:
+    """
+    On-disk cache of parsed reference-sheet indexes, keyed by sheet content hash.
+
+    Entries live in a SQLite file with a total size cap; the least recently
+    used entries are evicted first. The cache never fails a run: any database
+    or unpickling error is treated as a miss.
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.path = os.path.join(self.cache_dir, 'reference.sqlite3')
+        self.max_bytes = max_bytes
+
+    def _connect(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # A connection per call keeps the cache usable from worker threads and processes.
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute('CREATE TABLE IF NOT EXISTS entries ('
+                     'key TEXT PRIMARY KEY, data BLOB NOT NULL, '
+                     'size INTEGER NOT NULL, last_used REAL NOT NULL)')
+        return conn
+
+    @staticmethod
+    def make_key(sheet_name, digest):
+        """
+        Build the cache key of a reference sheet from its name and content digest.
+        """
+        return f'{CACHE_VERSION}:{sheet_name}:{digest}'
+
+    def get(self, key):
+        """
+        Return the cached value for a key, or None on a miss.
+        """
+        try:
+            with closing(self._connect()) as conn, conn:
+                row = conn.execute('SELECT data FROM entries WHERE key = ?', (key,)).fetchone()
+                if row is None:
+                    return None
+                try:
+                    value = pickle.loads(row[0])
+                except Exception:
+                    conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+                    return None
+                conn.execute('UPDATE entries SET last_used = ? WHERE key = ?', (time.time(), key))
+                return value
+        except (sqlite3.Error, OSError):
+            return None
+
+    def put(self, key, value):
+        """
+        Store a value and evict least recently used entries above the size cap.
+        """
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_bytes:
+            return
+        try:
+            with closing(self._connect()) as conn, conn:
+                conn.execute('INSERT OR REPLACE INTO entries (key, data, size, last_used) VALUES (?, ?, ?, ?)',
+                             (key, data, len(data), time.time()))
+                total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+                if total > self.max_bytes:
+                    rows = conn.execute('SELECT key, size FROM entries ORDER BY last_used').fetchall()
+                    for old_key, size in rows:
+                        if total <= self.max_bytes:
+                            break
+                        conn.execute('DELETE FROM entries WHERE key = ?', (old_key,))
+                        total -= size
+        except (sqlite3.Error, OSError):
+            pass
+
+    def clear(self):
+        """
+        Remove all entries.
+        """
+        try:
+            with closing(self._connect()) as conn, conn:
+                conn.execute('DELETE FROM entries')
+        except (sqlite3.Error, OSError):
+            pass
+
+
+class MemoryReferenceCache(ReferenceCache):
+    """
+    ReferenceCache that also keeps recently used indexes in memory.
+
+    For long-running processes such as the HTTP service workers: a hit
+    needs neither a database query nor unpickling. The cached indexes are
+    shared between runs, which only ever read them.
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=DEFAULT_MAX_BYTES, max_entries=DEFAULT_MEMORY_ENTRIES):
+        super().__init__(cache_dir, max_bytes)
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remember(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                return value
+        value = super().get(key)
+        if value is not None:
+            self._remember(key, value)
+        return value
+
+    def put(self, key, value):
+        self._remember(key, value)
+        super().put(key, value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        super().clear()
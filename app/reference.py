@@ -0,0 +1,186 @@
+from bisect import bisect_left
+from collections import Counter
+import re
+
+WEIGHT_SHEET = '鐵板重量計算'
+MATERIAL_SHEET = '鐵板材料費單價'
+MM_SHEET = '鐵板米數計算'
+
+
+def parse_thickness(thickness_str):
+    if thickness_str is None:
+        return None
+
+    if not isinstance(thickness_str, str):
+        raise TypeError(f"請將鐵板米數計算-厚度: {thickness_str} 更改為格式如 '5T' 的字串")
+
+    thickness_str = thickness_str.strip()
+
+    match_range = re.match(r".*-(\d+(?:\.\d+)?)T", thickness_str)
+    if match_range:
+        thickness_str = f"{match_range.group(1)}T"
+
+    match = re.match(r"([\d\.]+)", thickness_str)
+    if match:
+        return float(match.group(1))
+
+    return None
+
+
+def to_number(value):
+    """
+    Convert a 厚度/長/寬 value: strings containing '.' become floats, others ints.
+
+    Returns:
+        int | float: The number, or None if it does not convert.
+    """
+    try:
+        val_str = str(value).strip()
+        return float(val_str) if '.' in val_str else int(val_str)
+    except Exception:
+        return None
+
+
+def _value(row, col):
+    """
+    Return the value of a 1-based column from a row tuple, or None if the row is shorter.
+    """
+    return row[col - 1] if len(row) >= col else None
+
+
+def index_weight_rows(rows):
+    """
+    Index 鐵板重量計算 rows (material in B, coefficient in F) by material.
+
+    Args:
+        rows (iterable): Row tuples, header row already skipped.
+
+    Returns:
+        dict: material -> coefficient, keeping the first row of each material.
+    """
+    coefficients = {}
+    for row in rows:
+        coefficients.setdefault(_value(row, 2), _value(row, 6))
+    return coefficients
+
+
+def index_material_rows(rows):
+    """
+    Index 鐵板材料費單價 rows (material in C, thickness in D, price in E) by (material, thickness).
+
+    Args:
+        rows (iterable): Row tuples, header row already skipped.
+
+    Returns:
+        dict: (material, thickness) -> price, keeping the first matching row.
+    """
+    prices = {}
+    for row in rows:
+        prices.setdefault((_value(row, 3), _value(row, 4)), _value(row, 5))
+    return prices
+
+
+def index_mm_rows(rows):
+    """
+    Index 鐵板米數計算 rows (material in A, thickness string in B, 米數 in F) by material
+    and parsed thickness.
+
+    Args:
+        rows (iterable): Row tuples, header row already skipped.
+
+    Returns:
+        tuple: (index, error). index maps material -> (sorted thicknesses, matching 米數
+               values), ties kept in sheet order. error is the exception raised by a
+               malformed thickness, or None.
+    """
+    mm_index = {}
+    mm_error = None
+    entries = {}
+    try:
+        for order, row in enumerate(rows):
+            thickness = parse_thickness(_value(row, 2))
+            if thickness is not None:
+                entries.setdefault(_value(row, 1), []).append((thickness, order, _value(row, 6)))
+    except Exception as e:
+        # Surface a malformed thickness when a row is looked up, as the scan used to.
+        mm_error = e
+    for material, items in entries.items():
+        items.sort(key=lambda x: (x[0], x[1]))
+        mm_index[material] = ([t for t, _, _ in items], [v for _, _, v in items])
+    return mm_index, mm_error
+
+
+class ReferenceTables:
+    """
+    Hash and sorted indexes over the three reference sheets, built once per run.
+
+    Each index keeps the first matching row of its sheet, which is the row the
+    former linear scans returned. `lookups` counts hits and misses per lookup,
+    e.g. lookups['coefficient_hits'].
+    """
+
+    def __init__(self, coefficients, prices, mm_index, mm_error=None):
+        """
+        Args:
+            coefficients (dict): From index_weight_rows.
+            prices (dict): From index_material_rows.
+            mm_index (dict): Index from index_mm_rows.
+            mm_error (Exception, optional): Error from index_mm_rows.
+        """
+        self.coefficients = coefficients
+        self.prices = prices
+        self.mm_index = mm_index
+        self.mm_error = mm_error
+        self.lookups = Counter()
+
+    @classmethod
+    def from_rows(cls, weight_rows, material_rows, mm_rows):
+        """
+        Build the indexes from row tuples (header row already skipped).
+
+        Args:
+            weight_rows (iterable): Rows of 鐵板重量計算.
+            material_rows (iterable): Rows of 鐵板材料費單價.
+            mm_rows (iterable): Rows of 鐵板米數計算.
+
+        Returns:
+            ReferenceTables: The indexed tables.
+        """
+        return cls(index_weight_rows(weight_rows), index_material_rows(material_rows),
+                   *index_mm_rows(mm_rows))
+
+    def coefficient(self, material):
+        """
+        Return the weight coefficient of a material.
+        """
+        if material not in self.coefficients:
+            self.lookups['coefficient_misses'] += 1
+            raise Exception("找不到鐵板重量係數")
+        self.lookups['coefficient_hits'] += 1
+        return self.coefficients[material]
+
+    def material_price(self, material, thickness):
+        """
+        Return the unit price of a material at an exact thickness.
+        """
+        key = (material, thickness)
+        if key not in self.prices:
+            self.lookups['material_price_misses'] += 1
+            raise Exception("找不到鐵板材料費單價")
+        self.lookups['material_price_hits'] += 1
+        return self.prices[key]
+
+    def mm_by_thickness(self, material, thickness):
+        """
+        Return the 米數 of the smallest listed thickness that is >= the given thickness.
+        """
+        if self.mm_error is not None:
+            self.lookups['mm_misses'] += 1
+            raise self.mm_error
+        thicknesses, values = self.mm_index.get(material, ((), ()))
+        pos = bisect_left(thicknesses, thickness)
+        if pos == len(thicknesses):
+            self.lookups['mm_misses'] += 1
+            raise Exception("找不到鐵板米數厚度相關資料")
+        self.lookups['mm_hits'] += 1
+        return values[pos]
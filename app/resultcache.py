@@ -0,0 +1,192 @@
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import time
+import uuid
+from contextlib import closing
+from functools import lru_cache
+
+import openpyxl
+
+import refcache
+
+RESULT_CACHE_VERSION = 1  # bump when the key or the stored entry layout changes
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+BLOCK_SIZE = 1024 * 1024
+
+
+@lru_cache(maxsize=None)
+def code_version():
+    """
+    Get a digest of the code that builds the outputs, so results of another
+    version are never reused.
+
+    Hashes the source files next to this module and the openpyxl version. A
+    frozen build (PyInstaller) has no source files, so the executable's size
+    and modification time stand in for them.
+
+    Returns:
+        str: Hex digest.
+    """
+    digest = hashlib.sha256(f'{RESULT_CACHE_VERSION}:{openpyxl.__version__}'.encode('utf-8'))
+    folder = os.path.dirname(os.path.abspath(__file__))
+    sources = sorted(name for name in os.listdir(folder) if name.endswith('.py')) if os.path.isdir(folder) else []
+    for name in sources:
+        with open(os.path.join(folder, name), 'rb') as f:
+            digest.update(name.encode('utf-8'))
+            digest.update(b'\0')
+            digest.update(f.read())
+    if not sources:
+        stat = os.stat(sys.executable)
+        digest.update(f'{sys.executable}:{stat.st_size}:{stat.st_mtime_ns}'.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _copy(source, target):
+    # Copy a file and return the sha256 and size of the bytes copied.
+    digest = hashlib.sha256()
+    size = 0
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        for block in iter(lambda: src.read(BLOCK_SIZE), b''):
+            digest.update(block)
+            size += len(block)
+            dst.write(block)
+    return digest.hexdigest(), size
+
+
+class ResultCache:
+    """
+    On-disk cache of finished output files, keyed by the hash of the input
+    bytes, the code version and the options that shape the output.
+
+    Outputs are stored as files in a results folder next to the reference
+    cache, indexed in a SQLite file with their size, hash and last use. The
+    total size is capped and the least recently used outputs are evicted
+    first. A stored file whose hash no longer matches is dropped instead of
+    used. Like ReferenceCache, the cache never fails a run: any database or
+    file error is treated as a miss.
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir or refcache.default_cache_dir()
+        self.folder = os.path.join(self.cache_dir, 'results')
+        self.path = os.path.join(self.cache_dir, 'results.sqlite3')
+        self.max_bytes = max_bytes
+
+    def _connect(self):
+        os.makedirs(self.folder, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute('CREATE TABLE IF NOT EXISTS results ('
+                     'key TEXT PRIMARY KEY, sha256 TEXT NOT NULL, size INTEGER NOT NULL, '
+                     'rows INTEGER NOT NULL, manifest TEXT, last_used REAL NOT NULL)')
+        return conn
+
+    def _file(self, key):
+        return os.path.join(self.folder, f'{key}.xlsx')
+
+    def _remove(self, conn, key):
+        conn.execute('DELETE FROM results WHERE key = ?', (key,))
+        try:
+            os.remove(self._file(key))
+        except OSError:
+            pass
+
+    def make_key(self, input_path, options=None):
+        """
+        Build the cache key of a run.
+
+        Args:
+            input_path (str): 輸入 Excel 檔案路徑; its bytes are hashed.
+            options (dict, optional): Run options that change the output, e.g. the engine.
+
+        Returns:
+            str: Hex digest.
+        """
+        digest = hashlib.sha256(code_version().encode('utf-8'))
+        digest.update(json.dumps(options or {}, sort_keys=True).encode('utf-8'))
+        with open(input_path, 'rb') as f:
+            for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def fetch(self, key, output_path):
+        """
+        Copy the cached output of a key to output_path.
+
+        The copy is checked against the stored hash before it replaces
+        output_path, so a damaged entry never overwrites anything.
+
+        Returns:
+            dict: rows and manifest (the incremental manifest saved with the
+                  output, or None) on a hit, None on a miss.
+        """
+        temp_path = f'{output_path}.{uuid.uuid4().hex}.tmp'
+        try:
+            with closing(self._connect()) as conn, conn:
+                row = conn.execute('SELECT sha256, size, rows, manifest FROM results WHERE key = ?',
+                                   (key,)).fetchone()
+                if row is None:
+                    return None
+                sha256, size, rows, manifest = row
+                try:
+                    copied = _copy(self._file(key), temp_path)
+                except FileNotFoundError:
+                    copied = None
+                if copied != (sha256, size):
+                    self._remove(conn, key)
+                    return None
+                os.replace(temp_path, output_path)
+                conn.execute('UPDATE results SET last_used = ? WHERE key = ?', (time.time(), key))
+                return {'rows': rows, 'manifest': json.loads(manifest) if manifest else None}
+        except (sqlite3.Error, OSError, ValueError):
+            return None
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def put(self, key, output_path, rows, manifest=None):
+        """
+        Store a finished output and evict least recently used entries above the size cap.
+
+        Args:
+            key (str): From make_key.
+            output_path (str): The output just built.
+            rows (int): Rows of the run, reported again on a hit.
+            manifest (dict, optional): Incremental manifest of the output, restored with it.
+        """
+        temp_path = os.path.join(self.folder, f'.{uuid.uuid4().hex}.tmp')
+        try:
+            with closing(self._connect()) as conn, conn:
+                sha256, size = _copy(output_path, temp_path)
+                if size > self.max_bytes:
+                    return
+                os.replace(temp_path, self._file(key))
+                conn.execute('INSERT OR REPLACE INTO results (key, sha256, size, rows, manifest, last_used) '
+                             'VALUES (?, ?, ?, ?, ?, ?)',
+                             (key, sha256, size, rows, json.dumps(manifest) if manifest else None, time.time()))
+                total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+                if total > self.max_bytes:
+                    entries = conn.execute('SELECT key, size FROM results ORDER BY last_used').fetchall()
+                    for old_key, old_size in entries:
+                        if total <= self.max_bytes:
+                            break
+                        self._remove(conn, old_key)
+                        total -= old_size
+        except (sqlite3.Error, OSError):
+            pass
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def clear(self):
+        """
+        Remove all entries and their files.
+        """
+        try:
+            with closing(self._connect()) as conn, conn:
+                for (key,) in conn.execute('SELECT key FROM results').fetchall():
+                    self._remove(conn, key)
+        except (sqlite3.Error, OSError):
+            pass
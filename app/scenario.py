@@ -0,0 +1,415 @@
+import argparse
+import csv
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
+from openpyxl.utils import get_column_letter
+
+import engine
+import excel
+import instrument
+import loader
+import refcache
+from costdiff import format_delta, format_number
+from writer import BASE_FIRST_ROW
+
+# Title of a column in the scenario table -> override field.
+SCENARIO_COLUMNS = {
+    '情境': 'name',
+    '材質': 'material',
+    '厚度': 'thickness',
+    '單價': 'price',
+    '單價漲幅%': 'price_pct',
+    '重量係數': 'coefficient',
+    '重量係數漲幅%': 'coefficient_pct',
+}
+PERCENT_FIELDS = ('price_pct', 'coefficient_pct')
+ALL_MATERIALS = '*'
+BASELINE = '基準'
+REPORT_SHEET = '情境比較'
+REPORT_HEADERS = ['情境', '調整內容', '鐵板材料費合計', '總合計', '含其它製程費用', '與基準差額', '差額比例']
+REPORT_WIDTHS = [16, 60, 16, 16, 16, 14, 10]
+# Rows x scenarios evaluated per block; bounds the memory of the matrices.
+BLOCK_CELLS = 2_000_000
+
+
+def _number(value):
+    # A number of the scenario table: blanks are None, text may end in '%'.
+    if value is None or (isinstance(value, str) and not value.strip()):
+        return None
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    return float(str(value).strip().rstrip('%').strip())
+
+
+def _table_rows(path):
+    # Yield the rows of a scenario table as lists of (value, is_percent_format).
+    if os.path.splitext(path)[1].lower() == '.csv':
+        with open(path, newline='', encoding='utf-8-sig') as f:
+            for row in csv.reader(f):
+                yield [(value, False) for value in row]
+        return
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        for row in wb.worksheets[0].iter_rows():
+            yield [(cell.value, '%' in (getattr(cell, 'number_format', None) or '')) for cell in row]
+    finally:
+        wb.close()
+
+
+def read_scenarios(path):
+    """
+    Read a scenario table (.xlsx, first sheet, or .csv, UTF-8).
+
+    The first row holds the titles of SCENARIO_COLUMNS; 情境 and 材質 are
+    required, the others optional. Every other row is one override of a
+    scenario: the 材質 (* or blank for all) and 厚度 (blank for all) it
+    applies to, and a new 單價 and/or 單價漲幅% (e.g. 8 for +8%), a new
+    重量係數 and/or 重量係數漲幅%. A scenario can have several rows; they
+    apply in order, a new value before the increase of the same row.
+
+    Args:
+        path (str): Scenario table path.
+
+    Returns:
+        list: (name, overrides) per scenario in order of appearance; overrides
+              are dicts with the fields of SCENARIO_COLUMNS except name.
+    """
+    rows = iter(_table_rows(path))
+    header = next(rows, None)
+    if header is None:
+        raise ValueError("情境表是空的")
+    fields = {}
+    for col, (title, _) in enumerate(header):
+        title = str(title).strip() if title is not None else ''
+        if title in SCENARIO_COLUMNS:
+            fields[col] = SCENARIO_COLUMNS[title]
+    for title in ('情境', '材質'):
+        if SCENARIO_COLUMNS[title] not in fields.values():
+            raise ValueError(f"情境表缺少「{title}」欄")
+
+    scenarios = {}
+    for number, row in enumerate(rows, start=2):
+        values = {field: row[col] if col < len(row) else (None, False) for col, field in fields.items()}
+        if all(value is None or str(value).strip() == '' for value, _ in values.values()):
+            continue
+        name = values.pop('name')[0]
+        name = str(name).strip() if name is not None else ''
+        if not name:
+            raise ValueError(f"情境表第 {number} 列沒有情境名稱")
+        if name == BASELINE:
+            raise ValueError(f"情境名稱「{BASELINE}」保留給原始資料，請改用其它名稱")
+        material = values.pop('material')[0]
+        material = str(material).strip() if material is not None else ''
+        override = {'material': None if material in ('', ALL_MATERIALS) else material}
+        for field, (value, percent_format) in values.items():
+            try:
+                number_value = _number(value)
+            except ValueError:
+                title = next(title for title, name in SCENARIO_COLUMNS.items() if name == field)
+                raise ValueError(f"情境表第 {number} 列的「{title}」不是數值：{value}")
+            # 8% typed into a percent cell is stored as 0.08.
+            if field in PERCENT_FIELDS and percent_format and number_value is not None:
+                number_value *= 100
+            override[field] = number_value
+        for field in ('thickness', 'price', 'price_pct', 'coefficient', 'coefficient_pct'):
+            override.setdefault(field, None)
+        if all(override[field] is None for field in ('price', 'price_pct', 'coefficient', 'coefficient_pct')):
+            raise ValueError(f"情境表第 {number} 列沒有要調整的單價或重量係數")
+        scenarios.setdefault(name, []).append(override)
+    if not scenarios:
+        raise ValueError("情境表沒有任何情境")
+    return list(scenarios.items())
+
+
+def _plain(value):
+    return int(value) if float(value).is_integer() else value
+
+
+def describe_override(override):
+    """
+    Describe one override, e.g. 'SS400 厚度 5：單價 +8%' or '全部材質：重量係數 = 7.9e-06'.
+    """
+    target = override['material'] or '全部材質'
+    if override['thickness'] is not None:
+        target += f" 厚度 {_plain(override['thickness'])}"
+    changes = []
+    for label, value_field, pct_field in (('單價', 'price', 'price_pct'),
+                                          ('重量係數', 'coefficient', 'coefficient_pct')):
+        if override[value_field] is not None:
+            changes.append(f'{label} = {_plain(override[value_field])}')
+        if override[pct_field] is not None:
+            changes.append(f"{label} {'+' if override[pct_field] >= 0 else ''}{_plain(override[pct_field])}%")
+    return f"{target}：{'、'.join(changes)}"
+
+
+def prepare_rows(model):
+    """
+    Calculate the BOM once with the pandas engine and keep what the scenarios need.
+
+    Raises the same error a normal run does when a row cannot be calculated.
+
+    Args:
+        model (CostModel): The parsed input workbook.
+
+    Returns:
+        dict: Per row from row 6 on: key (index into keys, -1 for rows not
+              calculated), volume (厚度 x 長 x 寬), iron_mm, quantity and
+              purchase (as formula operands, 0 where Excel gives #VALUE!);
+              keys ((material, thickness) of the calculated rows), prices and
+              coefficients (their reference values), costs (calculate_row
+              results) and error (True when some 合計 is #VALUE!).
+    """
+    base, tables = model.base, model.tables
+    count = max(base.max_row - BASE_FIRST_ROW, 0)
+    first_row = BASE_FIRST_ROW + 1
+    costs = engine.calculate_rows(base, tables, first_row, count)
+
+    calculated = [pos for pos, res in enumerate(costs) if res is not None]
+    df = pd.DataFrame([base.row_values(first_row + pos, 4, 7) for pos in calculated],
+                      columns=['material', 'thickness', 'length', 'width'], dtype=object)
+    for col in ('thickness', 'length', 'width'):
+        df[col] = engine.coerce_dimensions(df[col])[0]
+
+    keys = {}
+    key = np.full(count, -1, dtype=np.int64)
+    volume = np.zeros(count)
+    key[calculated] = [keys.setdefault(k, len(keys)) for k in zip(df['material'], df['thickness'])]
+    volume[calculated] = (df['thickness'] * df['length'] * df['width']).to_numpy()
+
+    iron_mm = np.zeros(count)
+    quantity = np.zeros(count)
+    purchase = np.zeros(count)
+    error = False
+    for pos in range(count):
+        res = costs[pos]
+        if res is not None:
+            iron_mm[pos] = res[3]
+        q = excel.formula_operand(base.value(first_row + pos, 8))
+        p = excel.formula_operand(base.value(first_row + pos, 9))
+        if q is None or p is None:
+            error = True
+        quantity[pos] = q or 0
+        purchase[pos] = p or 0
+
+    keys = list(keys)
+    return {
+        'key': key, 'volume': volume, 'iron_mm': iron_mm, 'quantity': quantity, 'purchase': purchase,
+        'keys': keys,
+        'prices': np.array([float(tables.prices[k]) for k in keys]),
+        'coefficients': np.array([float(tables.coefficients[material]) for material, _ in keys]),
+        'costs': costs, 'error': error,
+    }
+
+
+def scenario_tables(rows, scenarios):
+    """
+    Build the price and coefficient of every (material, thickness) in every scenario.
+
+    Args:
+        rows (dict): From prepare_rows.
+        scenarios (list): From read_scenarios.
+
+    Returns:
+        tuple: (prices, coefficients, unmatched): keys x (1 + scenarios)
+               matrices whose column 0 is the baseline, and per scenario the
+               overrides that match no calculated row.
+    """
+    materials = np.array([material for material, _ in rows['keys']], dtype=object)
+    thicknesses = np.array([thickness for _, thickness in rows['keys']], dtype=float)
+    prices = np.repeat(rows['prices'][:, None], len(scenarios) + 1, axis=1)
+    coefficients = np.repeat(rows['coefficients'][:, None], len(scenarios) + 1, axis=1)
+    unmatched = []
+    for col, (_, overrides) in enumerate(scenarios, start=1):
+        missing = []
+        for override in overrides:
+            mask = np.ones(len(materials), dtype=bool)
+            if override['material'] is not None:
+                mask &= np.array([str(m).strip() == override['material'] for m in materials], dtype=bool)
+            if override['thickness'] is not None:
+                mask &= thicknesses == override['thickness']
+            if not mask.any():
+                missing.append(override)
+                continue
+            for table, value_field, pct_field in ((prices, 'price', 'price_pct'),
+                                                  (coefficients, 'coefficient', 'coefficient_pct')):
+                if override[value_field] is not None:
+                    table[mask, col] = override[value_field]
+                if override[pct_field] is not None:
+                    table[mask, col] *= 1 + override[pct_field] / 100
+        unmatched.append(missing)
+    return prices, coefficients, unmatched
+
+
+def sweep(rows, prices, coefficients, block_cells=BLOCK_CELLS):
+    """
+    Evaluate 鐵板材料費/片, 每片小計 and 合計 of every row in every scenario as
+    matrix operations, and the total_result totals of each scenario.
+
+    Weight and 米數 are not recalculated: a scenario only changes the price
+    and weight coefficient of a row. Rows are evaluated in blocks and summed in
+    row order, so column 0 gives exactly the totals of a normal run.
+
+    Args:
+        rows (dict): From prepare_rows.
+        prices (ndarray): keys x scenarios, from scenario_tables.
+        coefficients (ndarray): keys x scenarios, from scenario_tables.
+        block_cells (int): Rows x scenarios per block.
+
+    Returns:
+        dict: material_cost (sum of 鐵板材料費/片 x 累計用量), sum and
+              with_process per scenario; sum and with_process are None where
+              Excel gives #VALUE!.
+    """
+    scenarios = prices.shape[1]
+    count = len(rows['key'])
+    block = max(1, block_cells // max(scenarios, 1))
+    running = np.zeros(scenarios)
+    material_cost = np.zeros(scenarios)
+    for start in range(0, count, block):
+        part = slice(start, min(start + block, count))
+        key = rows['key'][part]
+        calculated = (key >= 0)[:, None]
+        weight = rows['volume'][part, None] * coefficients[key]
+        iron = engine.round2((weight * prices[key]).ravel()).reshape(weight.shape)
+        iron = np.where(calculated, iron, 0.0)
+        quantity = rows['quantity'][part, None]
+        subtotal = rows['iron_mm'][part, None] + iron + rows['purchase'][part, None]
+        # Sum one row after the other, in the order the formulas are added up.
+        running = np.add.accumulate(np.vstack([running[None], subtotal * quantity]), axis=0)[-1]
+        material_cost += (iron * quantity).sum(axis=0)
+
+    if rows['error']:
+        return {'material_cost': material_cost.tolist(), 'sum': [None] * scenarios,
+                'with_process': [None] * scenarios}
+    sums = [excel.excel_round(float(value)) for value in running]
+    return {'material_cost': material_cost.tolist(), 'sum': sums,
+            'with_process': [value * 1.05 * 1.3 for value in sums]}
+
+
+def run_scenarios(input_path, scenarios, use_cache=True, metrics=None, block_cells=BLOCK_CELLS):
+    """
+    Cost an input workbook under every scenario of a scenario table.
+
+    Args:
+        input_path (str): 輸入 Excel 檔案路徑
+        scenarios (list): From read_scenarios.
+        use_cache (bool): Reuse parsed reference sheets from the on-disk cache.
+        metrics (RunMetrics, optional): Receives the load, calculate_costs and scenarios timings.
+        block_cells (int): See sweep.
+
+    Returns:
+        list: One dict per scenario, the baseline first: name, description,
+              material_cost, sum, with_process, delta and ratio (change of the
+              total against the baseline), unmatched (overrides that match no row).
+    """
+    metrics = metrics or instrument.RunMetrics()
+    with metrics.phase('load'):
+        cache = refcache.ReferenceCache() if use_cache else None
+        model = loader.load_cost_model(input_path, cache, metrics, fast_reader=True, values_only=True)
+    with metrics.phase('calculate_costs'):
+        rows = prepare_rows(model)
+    with metrics.phase('scenarios'):
+        prices, coefficients, unmatched = scenario_tables(rows, scenarios)
+        totals = sweep(rows, prices, coefficients, block_cells)
+    metrics.rows = len(rows['key'])
+    metrics.count('scenarios', len(scenarios))
+
+    names = [(BASELINE, '原始單價與重量係數', [])]
+    names += [(name, '；'.join(describe_override(o) for o in overrides), missing)
+              for (name, overrides), missing in zip(scenarios, unmatched)]
+    baseline = totals['sum'][0]
+    results = []
+    for col, (name, description, missing) in enumerate(names):
+        total = totals['sum'][col]
+        delta = None if total is None else total - baseline
+        results.append({
+            'name': name,
+            'description': description,
+            'material_cost': totals['material_cost'][col],
+            'sum': total,
+            'with_process': totals['with_process'][col],
+            'delta': delta,
+            'ratio': delta / baseline if delta is not None and baseline else None,
+            'unmatched': [describe_override(o) for o in missing],
+        })
+    return results
+
+
+def write_comparison(results, output_path, input_path=None):
+    """
+    Save the results as one 情境比較 sheet, a line per scenario with the baseline first.
+
+    Args:
+        results (list): From run_scenarios.
+        output_path (str): Output file path.
+        input_path (str, optional): Shown under the table.
+    """
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(REPORT_SHEET)
+    for col, width in enumerate(REPORT_WIDTHS, start=1):
+        ws.column_dimensions[get_column_letter(col)].width = width
+    ws.freeze_panes = 'A2'
+    bold = Font(bold=True)
+
+    def cell(value, number_format='0.00', font=None):
+        result = WriteOnlyCell(ws, value=excel.FORMULA_ERROR if value is None else value)
+        if value is not None:
+            result.number_format = number_format
+        if font is not None:
+            result.font = font
+        return result
+
+    ws.append([cell(title, font=bold) for title in REPORT_HEADERS])
+    for result in results:
+        description = result['description']
+        if result['unmatched']:
+            description += f"（無對應列：{'；'.join(result['unmatched'])}）"
+        ws.append([cell(result['name'], font=bold), description,
+                   cell(result['material_cost']), cell(result['sum']), cell(result['with_process']),
+                   cell(result['delta']),
+                   cell(result['ratio'], '0.00%') if result['ratio'] is not None else None])
+    if input_path:
+        ws.append([])
+        ws.append([cell('輸入', font=bold), input_path])
+    wb.save(output_path)
+
+
+def format_result(result):
+    """
+    Describe one scenario on one line, e.g. 'SS400 漲價：總合計 12,345.00（+321.00） 含其它製程費用 16,850.93'.
+    """
+    text = f"{result['name']}：總合計 {format_number(excel.FORMULA_ERROR if result['sum'] is None else result['sum'])}"
+    if result['name'] != BASELINE:
+        text += f"（{format_delta(result['delta'])}）"
+    text += f" 含其它製程費用 {format_number(excel.FORMULA_ERROR if result['with_process'] is None else result['with_process'])}"
+    if result['unmatched']:
+        text += f"，無對應列：{'；'.join(result['unmatched'])}"
+    return text
+
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description='以多組材料單價或重量係數的假設情境試算成本，輸出一張情境比較表')
+    parser.add_argument('input', help='輸入 Excel 檔案')
+    parser.add_argument('scenarios', help='情境表（.xlsx 或 UTF-8 .csv）')
+    parser.add_argument('-o', '--output', default=None, help='情境比較 Excel 檔的路徑（預設為輸入檔名加上「_情境比較」）')
+    parser.add_argument('--no-cache', action='store_true', help='不使用參照表快取，每次重新解析')
+    args = parser.parse_args(argv)
+
+    output = args.output or f'{os.path.splitext(args.input)[0]}_{REPORT_SHEET}.xlsx'
+    metrics = instrument.RunMetrics()
+    results = run_scenarios(args.input, read_scenarios(args.scenarios), not args.no_cache, metrics)
+    write_comparison(results, output, args.input)
+    for result in results:
+        print(format_result(result))
+    print(f"{len(results) - 1} 個情境已寫入 {output}，{instrument.format_breakdown(metrics.as_dict())}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(cli())
@@ -0,0 +1,395 @@
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from concurrent.futures import TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlsplit
+
+import excel
+import loader
+import main
+import refcache
+import stream
+import workerpool
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+MAX_UPLOAD_BYTES = 100 * 1024 * 1024
+REQUEST_TIMEOUT = 300  # seconds a request waits for its job before answering 504
+LATENCY_WINDOW = 1000  # requests the /metrics percentiles cover
+PERCENTILES = (50, 90, 95, 99)
+XLSX_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+# Per worker process, set up by warm_worker.
+_worker_cache = None
+
+
+def warm_worker(warm_path=None):
+    """
+    Process pool initializer: set up the in-memory reference cache of this worker.
+
+    The modules of the pipeline (openpyxl included) are imported with this
+    module, so the first request does not pay for them.
+
+    Args:
+        warm_path (str, optional): A representative input whose reference
+            sheets are indexed right away, so the first request hits the cache.
+    """
+    global _worker_cache
+    # Forked workers inherit the server's SIGTERM handler; the pool shuts them down.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    _worker_cache = refcache.MemoryReferenceCache()
+    if warm_path:
+        try:
+            loader.load_cost_model(warm_path, _worker_cache)
+        except Exception as e:
+            print(f'預熱檔案讀取失敗: {e}')
+
+
+def run_job(input_path, output_path):
+    """
+    Calculate one uploaded workbook in a worker process.
+
+    Returns:
+        tuple: (output_name, result, started) – the output file name, the
+               main.main measurements and the time.time() the job started.
+    """
+    started = time.time()
+    chunk_size = stream.DEFAULT_CHUNK_SIZE if os.path.getsize(input_path) >= stream.LARGE_INPUT_BYTES else None
+    result = main.main(input_path, output_path, log=False, chunk_size=chunk_size, cache=_worker_cache)
+    output_name = excel.format_output_filename(*loader.peek_output_name(input_path))
+    return output_name, result, started
+
+
+def percentiles(values, points=PERCENTILES):
+    """
+    Nearest-rank percentiles of a list of numbers.
+
+    Returns:
+        dict: 'p50' -> value, ...; None values when the list is empty.
+    """
+    ordered = sorted(values)
+    result = {}
+    for point in points:
+        if not ordered:
+            result[f'p{point}'] = None
+            continue
+        rank = max(int(-(-point * len(ordered) // 100)), 1)  # ceil
+        result[f'p{point}'] = ordered[rank - 1]
+    return result
+
+
+class ServiceMetrics:
+    """
+    Request counts and latencies of the service, shared by the handler threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.requests = Counter()  # status code -> count
+        self.rejected = Counter()  # reason -> count
+        self.in_flight = 0
+        self.rows = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)  # whole request, successful /cost only
+        self.queue_waits = deque(maxlen=LATENCY_WINDOW)  # submitted -> started in a worker
+        self.job_seconds = deque(maxlen=LATENCY_WINDOW)  # main.main time in the worker
+
+    def begin(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def end(self, status, latency=None, queue_wait=None, result=None):
+        with self._lock:
+            self.in_flight -= 1
+            self.requests[status] += 1
+            if latency is not None:
+                self.latencies.append(latency)
+            if queue_wait is not None:
+                self.queue_waits.append(queue_wait)
+            if result is not None:
+                self.job_seconds.append(result['seconds'])
+                self.rows += result['rows']
+
+    def reject(self, status, reason):
+        with self._lock:
+            self.requests[status] += 1
+            self.rejected[reason] += 1
+
+    def snapshot(self):
+        """
+        Get the /metrics response.
+        """
+        with self._lock:
+            return {
+                'uptime_seconds': time.time() - self.started,
+                'requests': {str(status): count for status, count in sorted(self.requests.items())},
+                'rejected': dict(self.rejected),
+                'in_flight': self.in_flight,
+                'rows': self.rows,
+                'latency_seconds': percentiles(self.latencies),
+                'queue_wait_seconds': percentiles(self.queue_waits),
+                'job_seconds': percentiles(self.job_seconds),
+                'window': len(self.latencies),
+            }
+
+
+class CostService:
+    """
+    Runs uploaded workbooks through main.main on a warm process pool.
+
+    At most `max_pending` requests are admitted at a time, running or
+    waiting for a worker; more are answered 503 right away, so a burst does
+    not pile up uploads on disk or in the pool. Uploads above
+    max_upload_bytes get 413 and are never written to disk. When a worker
+    process dies, its request gets 500 and the pool is replaced by a fresh,
+    warmed one, see workerpool.WorkerPool.
+    """
+
+    def __init__(self, workers=None, max_pending=None, max_upload_bytes=MAX_UPLOAD_BYTES,
+                 request_timeout=REQUEST_TIMEOUT, warm_path=None):
+        """
+        Args:
+            workers (int, optional): Worker processes, defaults to the CPU count.
+            max_pending (int, optional): Requests admitted at once, defaults to twice the workers.
+            max_upload_bytes (int): Largest accepted upload.
+            request_timeout (float): Seconds a request waits for its job.
+            warm_path (str, optional): See warm_worker.
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending or self.workers * 2
+        self.max_upload_bytes = max_upload_bytes
+        self.request_timeout = request_timeout
+        self.metrics = ServiceMetrics()
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self.temp_dir = tempfile.mkdtemp(prefix='erp-cost-')
+        self.pool = workerpool.WorkerPool(self.workers, warm_worker, (warm_path,), warm=True)
+
+    def warm_up(self):
+        """
+        Start every worker process now instead of on the first requests.
+        """
+        return self.pool.warm_up()
+
+    def close(self):
+        self.pool.shutdown(wait=True, cancel_futures=True)
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def calculate(self, handler, output_format):
+        """
+        Handle POST /cost: read the upload, run it and send the xlsx or a JSON summary.
+        """
+        start = time.perf_counter()
+
+        def reject(status, reason, message, headers=None, length=0):
+            # The body is read and dropped so the client gets to see the answer;
+            # nothing of it is kept, and the connection is not reused.
+            self.metrics.reject(status, reason)
+            while length > 0:
+                block = handler.rfile.read(min(length, 1024 * 1024))
+                if not block:
+                    break
+                length -= len(block)
+            handler.close_connection = True
+            handler.send_json(status, {'error': message}, headers)
+
+        length = handler.headers.get('Content-Length')
+        if length is None or not length.isdigit():
+            return reject(411, 'no_length', '需要 Content-Length')
+        length = int(length)
+        if length > self.max_upload_bytes:
+            return reject(413, 'too_large', f'檔案過大，上限為 {self.max_upload_bytes} 位元組', length=length)
+        if output_format not in ('xlsx', 'json'):
+            return reject(400, 'bad_format', f'未知的輸出格式: {output_format}', length=length)
+        if not self._slots.acquire(blocking=False):
+            return reject(503, 'busy', '服務忙碌中，請稍後再試', {'Retry-After': '1'}, length)
+
+        self.metrics.begin()
+        job_id = uuid.uuid4().hex
+        input_path = os.path.join(self.temp_dir, f'{job_id}-in.xlsx')
+        output_path = os.path.join(self.temp_dir, f'{job_id}-out.xlsx')
+        status = 500
+        latency = queue_wait = result = None
+        running = future = None
+        try:
+            if not self._save_upload(handler, input_path, length):
+                status = 400
+                return handler.send_json(400, {'error': '上傳的內容不完整或不是 xlsx 檔案'})
+            submitted = time.time()
+            try:
+                future = self.pool.submit(run_job, input_path, output_path)
+                output_name, result, started = future.result(timeout=self.request_timeout)
+            except BrokenProcessPool:
+                if future is None:
+                    status = 503
+                    return handler.send_json(503, {'error': '處理程序無法啟動，請稍後再試'}, {'Retry-After': '1'})
+                # The worker died (killed, out of memory); the next requests get a fresh pool.
+                self.pool.recover(future)
+                status = 500
+                return handler.send_json(500, {'error': '處理程序意外結束'})
+            except TimeoutError:
+                status = 504
+                if not future.cancel():
+                    # A running job cannot be stopped: it keeps its slot and files until it ends.
+                    running = future
+                return handler.send_json(504, {'error': '處理逾時'})
+            except Exception as e:
+                # Missing sheets, bad values and other errors of the input itself.
+                status = 422
+                return handler.send_json(422, {'error': str(e) or type(e).__name__})
+            queue_wait = max(started - submitted, 0)
+
+            status = 200
+            if output_format == 'json':
+                handler.send_json(200, {'output_name': output_name, **result})
+            else:
+                with open(output_path, 'rb') as f:
+                    body = f.read()
+                handler.send_body(200, body, XLSX_TYPE, {
+                    'Content-Disposition': f"attachment; filename=\"cost.xlsx\"; filename*=UTF-8''{quote(output_name)}",
+                    'X-Rows': str(result['rows']),
+                    'X-Seconds': f"{result['seconds']:.3f}",
+                })
+            latency = time.perf_counter() - start
+        finally:
+            self.metrics.end(status, latency, queue_wait, result if status == 200 else None)
+            if running is None:
+                self._release(input_path, output_path)
+            else:
+                running.add_done_callback(lambda future: self._release(input_path, output_path))
+
+    def _release(self, *paths):
+        # Free the slot of a request whose job is done or was never started, and remove its files.
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+        self._slots.release()
+
+    @staticmethod
+    def _save_upload(handler, path, length):
+        """
+        Stream the request body to a file. Returns False if it is short or not a zip file.
+        """
+        remaining = length
+        with open(path, 'wb') as f:
+            while remaining > 0:
+                block = handler.rfile.read(min(remaining, 1024 * 1024))
+                if not block:
+                    break
+                f.write(block)
+                remaining -= len(block)
+        if remaining:
+            handler.close_connection = True
+            return False
+        with open(path, 'rb') as f:
+            return f.read(4) == b'PK\x03\x04'
+
+
+class CostRequestHandler(BaseHTTPRequestHandler):
+    """
+    Routes:
+        POST /cost[?format=xlsx|json]  body: the input workbook
+        GET  /metrics                  request counts and latency percentiles
+        GET  /health
+    """
+
+    server_version = 'ERPCost/1.0'
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path == '/metrics':
+            self.send_json(200, self.server.service.metrics.snapshot())
+        elif path == '/health':
+            self.send_json(200, {'status': 'ok', 'workers': self.server.service.workers})
+        else:
+            self.send_json(404, {'error': f'找不到路徑: {path}'})
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path != '/cost':
+            self.close_connection = True
+            return self.send_json(404, {'error': f'找不到路徑: {url.path}'})
+        output_format = parse_qs(url.query).get('format', ['xlsx'])[0]
+        self.server.service.calculate(self, output_format)
+
+    def send_body(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status, data, headers=None):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_body(status, body, 'application/json; charset=utf-8', headers)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def make_server(service, host=DEFAULT_HOST, port=DEFAULT_PORT, verbose=False):
+    """
+    Create the HTTP server of a CostService; call serve_forever() on it.
+    """
+    server = ThreadingHTTPServer((host, port), CostRequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    server.verbose = verbose
+    return server
+
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description='本機 HTTP 成本計算服務')
+    parser.add_argument('--host', default=DEFAULT_HOST, help=f'監聽位址（預設 {DEFAULT_HOST}，僅限本機）')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help=f'監聽埠號（預設 {DEFAULT_PORT}）')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='處理程序數（預設為 CPU 核心數）')
+    parser.add_argument('--max-pending', type=int, default=None, help='同時受理的請求數上限（預設為程序數的兩倍），超過回應 503')
+    parser.add_argument('--max-upload-mb', type=float, default=MAX_UPLOAD_BYTES / (1024 * 1024),
+                        help='上傳檔案大小上限（MB），超過回應 413')
+    parser.add_argument('--timeout', type=float, default=REQUEST_TIMEOUT, help='單一請求等待處理的秒數上限')
+    parser.add_argument('--warm', default=None, help='啟動時先讀取此檔案的參照表，預熱各處理程序的快取')
+    parser.add_argument('-v', '--verbose', action='store_true', help='記錄每個請求')
+    args = parser.parse_args(argv)
+
+    # Stop on SIGTERM (e.g. a service manager) the same way as on Ctrl+C.
+    signal.signal(signal.SIGTERM, _interrupt)
+    service = CostService(args.workers, args.max_pending, int(args.max_upload_mb * 1024 * 1024),
+                          args.timeout, args.warm)
+    try:
+        started = service.warm_up()
+        server = make_server(service, args.host, args.port, args.verbose)
+        print(f'成本計算服務已啟動：http://{args.host}:{server.server_port}（{started} 個處理程序）')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print('停止服務')
+        finally:
+            server.server_close()
+    finally:
+        service.close()
+    return 0
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(cli())
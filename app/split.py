@@ -0,0 +1,263 @@
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+from openpyxl import Workbook
+
+import batch
+import excel
+import instrument
+import loader
+import refcache
+import style
+import writer
+import xlsx
+from loader import BaseSheet, CostModel
+from writer import BASE_FIRST_ROW
+
+SPLIT_MODES = ('sheet', 'file')
+
+
+def is_parent_label(value):
+    """
+    Check whether a column A value is a parent label, as extract_parent_and_counts does.
+    """
+    return value is not None and not value.startswith('。')
+
+
+def product_segments(base):
+    """
+    Find the rows of each parent product in 標準成本結構表.
+
+    A product runs from its parent row to the row before the next parent,
+    without trailing blank rows. Rows above the first parent go with it.
+
+    Args:
+        base (BaseSheet): The parsed 標準成本結構表 sheet.
+
+    Returns:
+        list: (first_row, last_row) of each product, in sheet order; the whole
+              sheet as one product when it has no parent label.
+    """
+    starts = [row for row in range(BASE_FIRST_ROW, base.max_row + 1) if is_parent_label(base.value(row, 1))]
+    if not starts:
+        return [(BASE_FIRST_ROW, base.max_row)]
+    starts[0] = BASE_FIRST_ROW
+    segments = []
+    for first_row, next_row in zip(starts, starts[1:] + [base.max_row + 1]):
+        last_row = next_row - 1
+        while last_row > first_row and not loader.has_content(base.row_values(last_row, 1, loader.BASE_MAX_COL)):
+            last_row -= 1
+        segments.append((first_row, last_row))
+    return segments
+
+
+def segment_model(model, first_row, last_row):
+    """
+    Get the input of one product: a CostModel whose 標準成本結構表 holds only
+    its rows, moved up to start at row 5, so it builds like a whole input.
+    """
+    base = model.base
+    header = BASE_FIRST_ROW - 1
+    rows = base.rows[:header] + base.rows[first_row - 1:last_row]
+    style_ids = base.style_ids[:header] + base.style_ids[first_row - 1:last_row]
+    return CostModel(BaseSheet(rows, style_ids, base.styles, last_row - first_row + BASE_FIRST_ROW), model.tables)
+
+
+def build_segment_file(model, output_dir):
+    """
+    Build the output file of one product in a temporary file in output_dir.
+
+    Runs in a worker process. The caller moves the file to its final name.
+
+    Returns:
+        dict: output_name, temp_path and rows of the product.
+    """
+    temp_path = os.path.join(output_dir, f'.split-{uuid.uuid4().hex}.xlsx')
+    try:
+        writer.write_output(model, temp_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return {
+        'output_name': excel.get_output_filename(model.base),
+        'temp_path': temp_path,
+        'rows': max(model.base.max_row - 4, 0),
+    }
+
+
+def build_segment_sheet(model):
+    """
+    Build the sheet of one product without saving a workbook.
+
+    Runs in a worker process, so the rows of all products are calculated and
+    serialized to XML in parallel; merge_sheets puts the sheets together.
+
+    Returns:
+        dict: title, sheet_path (the rows, see xlsx.SheetData, a temporary
+              file), styles (the NamedStyleRegistry specs of its style ids),
+              total_row (its number of BOM rows) and rows of the product.
+    """
+    wb = Workbook(write_only=True)
+    registry = style.NamedStyleRegistry(wb)
+    data = writer.write_sheet(wb, registry, model)
+    return {
+        'title': data.ws.title,
+        'sheet_path': data.path,
+        'styles': registry.specs,
+        'total_row': model.base.max_row - BASE_FIRST_ROW,
+        'rows': max(model.base.max_row - 4, 0),
+    }
+
+
+def merge_sheets(sheets, output_path):
+    """
+    Save the sheets built by build_segment_sheet as one workbook, in order.
+
+    The workbook is made of sheets of the same titles with all the styles of
+    the sheets, and saved with the rows of each sheet copied into the package
+    with their style ids renumbered, see xlsx.save_workbook.
+
+    Args:
+        sheets (list): Results of build_segment_sheet.
+        output_path (str): 輸出 Excel 檔案路徑
+    """
+    wb = Workbook(write_only=True)
+    registry = style.NamedStyleRegistry(wb)
+    rows = []
+    for sheet in sheets:
+        ws = wb.create_sheet(sheet['title'])
+        writer.prepare_sheet(ws, sheet['total_row'])
+        data = xlsx.SheetData(ws, sheet['sheet_path'])
+        # Identical styles of different products share one id.
+        data.style_map = {style_id: registry.style_id(spec, *spec) for style_id, spec in sheet['styles'].items()}
+        rows.append(data)
+    xlsx.save_workbook(wb, output_path, rows)
+
+
+def _remove_sheet_files(sheets):
+    for sheet in sheets:
+        if sheet is not None and os.path.exists(sheet['sheet_path']):
+            os.remove(sheet['sheet_path'])
+
+
+def split_cost_sheets(input_path, output, mode='sheet', workers=None, use_cache=True, metrics=None,
+                      progress=None):
+    """
+    Build a separate cost sheet, with its own totals, for each parent product of an input.
+
+    The products are built in worker processes, one product per task, so the
+    time taken follows the number of cores rather than the total number of rows.
+
+    Args:
+        input_path (str): 輸入 Excel 檔案路徑
+        output (str): 'sheet': the output file, with one sheet per product;
+            'file': the output folder, with one file per product, named like
+            main outputs (' (2)', ' (3)' added to repeated names).
+        mode (str): One of SPLIT_MODES.
+        workers (int, optional): Number of worker processes, defaults to the CPU count;
+            1 builds everything in this process.
+        use_cache (bool): See main.main.
+        metrics (RunMetrics, optional): Receives the load, split and save timings and the products.
+        progress (Progress, optional): Reports the load phase, then the split phase product by product.
+
+    Returns:
+        list: Output file paths, one per product in 'file' mode, the output file in 'sheet' mode.
+    """
+    if mode not in SPLIT_MODES:
+        raise ValueError(f"未知的分割方式: {mode}")
+    metrics = metrics or instrument.RunMetrics()
+    cache = refcache.ReferenceCache() if use_cache else None
+    with metrics.phase('load'):
+        model = loader.load_cost_model(input_path, cache, metrics, progress)
+    metrics.rows = max(model.base.max_row - 4, 0)
+    segments = product_segments(model.base)
+    metrics.count('products', len(segments))
+    if mode == 'file':
+        os.makedirs(output, exist_ok=True)
+
+    results = [None] * len(segments)
+    if progress is not None:
+        progress.start('split', len(segments))
+    try:
+        with metrics.phase('split'):
+            tasks = [segment_model(model, *segment) for segment in segments]
+            build = build_segment_sheet if mode == 'sheet' else build_segment_file
+            args = () if mode == 'sheet' else (output,)
+            if workers == 1:
+                for index, task in enumerate(tasks):
+                    results[index] = build(task, *args)
+                    if progress is not None:
+                        progress.advance()
+            else:
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    # The largest products first, so no worker is left with a big one at the end.
+                    order = sorted(range(len(tasks)), key=lambda i: segments[i][0] - segments[i][1])
+                    futures = {index: executor.submit(build, tasks[index], *args) for index in order}
+                    try:
+                        for index in order:
+                            results[index] = futures[index].result()
+                            if progress is not None:
+                                progress.advance()
+                    except BaseException:
+                        # Collect what the other workers built, for the cleanup below.
+                        for index in order:
+                            if results[index] is None and not futures[index].cancel():
+                                try:
+                                    results[index] = futures[index].result()
+                                except Exception:
+                                    pass
+                        raise
+
+        if progress is not None:
+            progress.start('save')
+        with metrics.phase('save'):
+            if mode == 'sheet':
+                merge_sheets(results, output)
+                return [output]
+            taken = set()
+            outputs = []
+            for result in results:
+                output_path = batch.unique_output_path(output, result['output_name'], taken)
+                os.replace(result['temp_path'], output_path)
+                result['temp_path'] = None
+                outputs.append(output_path)
+            return outputs
+    finally:
+        if mode == 'sheet':
+            _remove_sheet_files(results)
+        else:
+            for result in results:
+                if result is not None and result['temp_path'] and os.path.exists(result['temp_path']):
+                    os.remove(result['temp_path'])
+
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description='依母件分割成本計算結果，各母件各自計算總合計，並以多個程序同時產生')
+    parser.add_argument('input', help='輸入 Excel 檔案')
+    parser.add_argument('output', help='輸出檔案（--by sheet）或輸出資料夾（--by file）')
+    parser.add_argument('--by', choices=SPLIT_MODES, default='sheet',
+                        help='sheet：每個母件一個工作表；file：每個母件一個檔案')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='同時處理的程序數（預設為 CPU 核心數）')
+    parser.add_argument('--no-cache', action='store_true', help='不使用參照表快取，每次重新解析')
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    metrics = instrument.RunMetrics()
+    outputs = split_cost_sheets(args.input, args.output, args.by, args.workers, not args.no_cache, metrics)
+    result = metrics.as_dict()
+    print(f"{result['counters'].get('products', 0)} 個母件，{result['rows']} 列，"
+          f"耗時 {time.perf_counter() - start:.2f} 秒")
+    for path in outputs:
+        print(f'  {path}')
+    return 0
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(cli())
@@ -0,0 +1,181 @@
+from collections import deque
+
+import openpyxl
+from openpyxl import Workbook
+
+import excel
+import instrument
+import loader
+import style
+import writer
+import xlsx
+from writer import BASE_FIRST_ROW, OUTPUT_FIRST_ROW
+
+DEFAULT_CHUNK_SIZE = 5000
+# Inputs at least this large are processed in chunks instead of being loaded whole.
+LARGE_INPUT_BYTES = 20 * 1024 * 1024
+
+
+class QueryLabelFeed:
+    """
+    Parent labels of the output rows, produced while column A is read.
+
+    Matches excel.extract_parent_and_counts: every non-empty column A value
+    from row 5 on gets the label of the closest parent at or above it, and
+    values above the first parent get none, so the labels shift up against
+    the rows by one for each such value.
+    """
+
+    def __init__(self):
+        self.labels = deque()
+        self.parent = None
+        self.first_parent = None
+
+    def feed(self, value):
+        if value is None:
+            return
+        if not value.startswith('。'):
+            self.parent = value
+            if self.first_parent is None:
+                self.first_parent = value
+        if self.parent is not None:
+            self.labels.append(self.parent)
+
+
+def chunk_costs(chunk, tables, engine):
+    """
+    Calculate the costs of the rows of a chunk that get costs (row 6 on).
+
+    Returns:
+        dict: Row number -> calculate_row result.
+    """
+    first = max(chunk.first_row, BASE_FIRST_ROW + 1)
+    count = chunk.max_row - first + 1
+    if count <= 0:
+        return {}
+    if engine == 'pandas':
+        import engine as pandas_engine
+        results = pandas_engine.calculate_rows(chunk, tables, first, count)
+    else:
+        results = [excel.calculate_row(chunk, tables, i) for i in range(first, first + count)]
+    return dict(zip(range(first, first + count), results))
+
+
+def stream_cost_sheet(input_path, output_path, cache=None, chunk_size=DEFAULT_CHUNK_SIZE, engine='python',
+                      metrics=None, progress=None, exports=()):
+    """
+    Build the cost sheet reading, calculating and writing 標準成本結構表 chunk by chunk.
+
+    Gives the same output as main.write_cost_sheet, but only one chunk of
+    input rows is held at a time, plus the few rows that wait for their
+    query label, so memory does not grow with the size of the BOM. The last
+    row with data, the total rows, the sheet title and the query labels are
+    all worked out in the same single pass.
+
+    Args:
+        input_path (str): 輸入 Excel 檔案路徑
+        output_path (str): 輸出 Excel 檔案路徑
+        cache (ReferenceCache, optional): Cache of parsed reference indexes.
+        chunk_size (int): Rows of 標準成本結構表 per chunk.
+        engine (str): Cost calculation engine, 'python' or 'pandas' (per chunk).
+        metrics (RunMetrics, optional): Receives the load, write_rows and save timings and row counts.
+        progress (Progress, optional): Reports the load, write_rows and save phases;
+            the write_rows total is the dimension the workbook declares.
+        exports (list, optional): Open export files that also receive the rows and totals.
+
+    Returns:
+        ReferenceTables: The reference tables used, with their lookup counts.
+    """
+    metrics = metrics or instrument.RunMetrics()
+    if progress is not None:
+        progress.start('load')
+    with metrics.phase('load'):
+        digests = loader.reference_digests(input_path) if cache is not None else {}
+        wb = openpyxl.load_workbook(input_path, read_only=True)
+    try:
+        sheets = {name: wb[name] for name in (loader.BASE_SHEET, *loader.REFERENCE_INDEXERS)}
+        with metrics.phase('load'):
+            tables = loader.read_reference_tables(sheets, digests, cache, metrics, progress)
+
+        base_ws = sheets[loader.BASE_SHEET]
+        declared_rows = base_ws.max_row
+        # ERP exports do not always write a reliable dimension record.
+        base_ws.reset_dimensions()
+
+        out_wb = Workbook(write_only=True)
+        ws = out_wb.create_sheet()
+        excel.set_column_widths(ws)
+        for cell_range in excel.get_header_merges():
+            ws.merged_cells.add(cell_range)
+        registry = style.NamedStyleRegistry(out_wb)
+        first_row_styles, regular_styles = writer.data_column_styles()
+        results = writer.RowResults(exports)
+        data = xlsx.SheetData(ws)
+
+        reader = loader.ChunkedBaseReader(base_ws, chunk_size, min_row=BASE_FIRST_ROW, progress=progress)
+        feed = QueryLabelFeed()
+        waiting = deque()  # (chunk, base row, res) of rows whose query label is not known yet
+        label_name = None
+
+        def emit(chunk, base_row, res, query_label):
+            row = base_row - BASE_FIRST_ROW + OUTPUT_FIRST_ROW
+            column_styles = first_row_styles if row == OUTPUT_FIRST_ROW else regular_styles
+            data.append(writer.data_row_cells(registry, column_styles, chunk, row, query_label, res, results))
+
+        if progress is not None:
+            progress.start('write_rows', declared_rows if declared_rows and declared_rows > 1 else None)
+        with metrics.phase('write_rows'):
+            try:
+                for cells in writer.header_rows(registry):
+                    data.append(cells)
+
+                for chunk in reader.chunks():
+                    with metrics.phase('write_rows.calculate'):
+                        costs = chunk_costs(chunk, tables, engine)
+                    for base_row in range(chunk.first_row, chunk.max_row + 1):
+                        feed.feed(chunk.value(base_row, 1))
+                        if label_name is None:
+                            label_name = chunk.value(base_row, 2)
+                        res = costs.get(base_row)
+                        if base_row > BASE_FIRST_ROW:
+                            metrics.count('rows_skipped' if res is None else 'rows_calculated')
+                        waiting.append((chunk, base_row, res))
+                    while waiting and feed.labels:
+                        emit(*waiting.popleft(), feed.labels.popleft())
+
+                # Rows after the last row with data still count for labels and the main name.
+                for values in reader.tail:
+                    feed.feed(values[0])
+                    if label_name is None:
+                        label_name = values[1]
+                while waiting:
+                    emit(*waiting.popleft(), feed.labels.popleft() if feed.labels else None)
+
+                total_row = reader.max_row - BASE_FIRST_ROW
+                for cells in writer.total_rows(registry, total_row, results.totals):
+                    data.append(cells)
+                ws.merged_cells.add(f'P{total_row + 4}:R{total_row + 4}')
+                ws.merged_cells.add(f'P{total_row + 5}:R{total_row + 5}')
+                labels = [feed.first_parent] if feed.first_parent is not None else []
+                ws.title = excel.get_sheet_title(labels, label_name if label_name is not None else '')
+            except BaseException:
+                data.discard()
+                results.abort()
+                raise
+        metrics.rows = max(reader.max_row - 4, 0)
+    finally:
+        wb.close()
+
+    if progress is not None:
+        progress.start('save')
+    try:
+        with metrics.phase('save'):
+            xlsx.save_workbook(out_wb, output_path, [data])
+        with metrics.phase('export'):
+            results.finish()
+    except BaseException:
+        results.abort()
+        raise
+    finally:
+        data.discard()
+    return tables
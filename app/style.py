@@ -1,27 +1,21 @@
-from openpyxl.styles import Alignment, Font, Border, Side, PatternFill
+from openpyxl.styles import Alignment, Font, Border, Side, PatternFill, NamedStyle, Protection
+from openpyxl.cell import Cell
 from openpyxl.utils import column_index_from_string
-from copy import copy
 
-def get_real_max_row(sheet):
-    max_row = sheet.max_row
-    for row in range(max_row, 0, -1):
-        if any(cell.value is not None and str(cell.value).strip() != "" for cell in sheet[row]):
-            return row
-    return 0
-
-def copy_columns_with_style(ws_src, ws_dest, src_cols='A:G', src_start_row=1,
-                             dest_start_row=1, dest_start_col=1):
+def copy_columns_with_style(base, ws_dest, src_cols='A:G', src_start_row=1,
+                             dest_start_row=1, dest_start_col=1, progress=None):
     """
-    Copy a range of columns from source worksheet to destination worksheet
+    Copy a range of columns from the parsed source sheet to destination worksheet
     including values and styles.
 
     Args:
-        ws_src (Worksheet): Source worksheet.
+        base (BaseSheet): Parsed source sheet.
         ws_dest (Worksheet): Destination worksheet.
         src_cols (str): Column range in A1 notation, e.g., 'A:G'.
         src_start_row (int): Starting row in source worksheet.
         dest_start_row (int): Starting row in destination worksheet.
         dest_start_col (int): Starting column index in destination worksheet.
+        progress (Progress, optional): Advanced once per copied row.
 
     Returns:
         int: Number of rows copied.
@@ -29,26 +23,29 @@ def copy_columns_with_style(ws_src, ws_dest, src_cols='A:G', src_start_row=1,
     col_start_letter, col_end_letter = src_cols.split(":")
     col_start_idx = column_index_from_string(col_start_letter)
     col_end_idx = column_index_from_string(col_end_letter)
-    max_row = get_real_max_row(ws_src)
+    max_row = base.max_row
 
     for i, row in enumerate(range(src_start_row, max_row + 1)):
         for j, col in enumerate(range(col_start_idx, col_end_idx + 1)):
-            src_cell = ws_src.cell(row=row, column=col)
             dest_cell = ws_dest.cell(row=dest_start_row + i,
                                      column=dest_start_col + j)
 
-            dest_cell.value = src_cell.value
+            dest_cell.value = base.value(row, col)
 
-            if src_cell.has_style:
-                dest_cell.font = copy(src_cell.font)
-                dest_cell.fill = copy(src_cell.fill)
-                dest_cell.border = copy(src_cell.border)
-                dest_cell.alignment = copy(src_cell.alignment)
-                dest_cell.number_format = copy(src_cell.number_format)
-                dest_cell.protection = copy(src_cell.protection)
+            src_style = base.style(row, col)
+            if src_style is not None:
+                font, fill, border, alignment, number_format, protection = src_style
+                dest_cell.font = font
+                dest_cell.fill = fill
+                dest_cell.border = border
+                dest_cell.alignment = alignment
+                dest_cell.number_format = number_format
+                dest_cell.protection = protection
 
             if isinstance(dest_cell.value, float):
                 dest_cell.number_format = '0.00'
+        if progress is not None:
+            progress.advance()
 
     return max_row - src_start_row
 
@@ -77,7 +74,25 @@ def apply_style(cell, font=None, alignment=None, border=None, fill=None, format=
     if format:
         cell.number_format = format
 
-def set_style_in_range(ws, cell_range, font=None, alignment=None, border=None, fill=None, format=None):
+def get_range_style(font=None, alignment=None, border=None, fill=None):
+    """
+    Fill in the default styles set_style_in_range uses for missing arguments.
+
+    Returns:
+        tuple: (font, alignment, border, fill)
+    """
+    if font is None:
+        font = Font(color="0000FF", size=9)
+    if alignment is None:
+        alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
+    if border is None:
+        thin = Side(style='thin')
+        border = Border(left=thin, right=thin, top=thin, bottom=thin)
+    if fill is None:
+        fill = PatternFill(fill_type='solid', start_color='DDEBF7', end_color='DDEBF7')
+    return font, alignment, border, fill
+
+def set_style_in_range(ws, cell_range, font=None, alignment=None, border=None, fill=None, format=None, progress=None):
     """
     Apply styles to a cell range.
 
@@ -88,20 +103,122 @@ def set_style_in_range(ws, cell_range, font=None, alignment=None, border=None, f
         alignment (Alignment, optional): Alignment to apply.
         border (Border, optional): Border style to apply.
         fill (PatternFill, optional): Background fill to apply.
+        progress (Progress, optional): Advanced once per styled row.
 
     Returns:
         None
     """
-    if font is None:
-        font = Font(color="0000FF", size=9)
-    if alignment is None:
-        alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
-    if border is None:
-        thin = Side(style='thin')
-        border = Border(left=thin, right=thin, top=thin, bottom=thin)
-    if fill is None:
-        fill = PatternFill(fill_type='solid', start_color='DDEBF7', end_color='DDEBF7')        
+    font, alignment, border, fill = get_range_style(font, alignment, border, fill)
 
     for row in ws[cell_range]:
         for cell in row:
-            apply_style(cell, font, alignment, border, fill, format)
\ No newline at end of file
+            apply_style(cell, font, alignment, border, fill, format)
+        if progress is not None:
+            progress.advance()
+
+def resolve_range_styles(style_ranges, column_styles=None):
+    """
+    Work out the style each column ends up with when set_style_in_range is
+    applied to every (start column, end column, arguments) entry in order.
+
+    Args:
+        style_ranges (list): (start_col, end_col, kwargs) tuples, e.g. ('K', 'N', {'fill': fill}).
+        column_styles (dict, optional): Styles to start from, as returned by this function.
+
+    Returns:
+        dict: Column index -> (font, alignment, border, fill, format). format is None
+              when no range sets a number format for the column.
+    """
+    column_styles = dict(column_styles or {})
+    for start, end, kwargs in style_ranges:
+        kwargs = dict(kwargs)
+        format = kwargs.pop('format', None)
+        font, alignment, border, fill = get_range_style(**kwargs)
+        for col in range(column_index_from_string(start), column_index_from_string(end) + 1):
+            previous = column_styles.get(col)
+            column_format = format or (previous[4] if previous else None)
+            column_styles[col] = (font, alignment, border, fill, column_format)
+    return column_styles
+
+def style_spec(font, alignment, border, fill, number_format=None, protection=None):
+    """
+    Describe a cell style by value as a named style holds it, so styles that
+    only differ in a left-out default compare equal.
+
+    Returns:
+        tuple: (font, alignment, border, fill, number_format, protection), the arguments of NamedStyleRegistry.get.
+    """
+    return (font, alignment, border, fill, number_format or 'General',
+            Protection() if protection is None else protection)
+
+
+class NamedStyleRegistry:
+    """
+    Register each distinct cell style of a workbook once as a NamedStyle.
+
+    Callers look styles up by a cheap hashable key; the style objects are only
+    compared the first time a key is seen, and identical styles share a name.
+    specs keeps the arguments of every style id handed out by style_id, so
+    another workbook can register the same styles.
+    """
+
+    def __init__(self, wb, prefix='成本計算'):
+        self.wb = wb
+        self.prefix = prefix
+        self.names = {}
+        self.ids = {}
+        self.specs = {}
+        self._by_style = {}
+
+    def get(self, key, font, alignment, border, fill, number_format='General', protection=None):
+        """
+        Get the name of the named style for a key, registering it on first use.
+
+        Args:
+            key (hashable): Identifies the style combination for the caller.
+            font (Font): Font style.
+            alignment (Alignment): Cell alignment.
+            border (Border): Border style.
+            fill (PatternFill): Cell background fill.
+            number_format (str, optional): Number format.
+            protection (Protection, optional): Cell protection.
+
+        Returns:
+            str: The named style name to assign to cell.style.
+        """
+        name = self.names.get(key)
+        if name is not None:
+            return name
+
+        number_format = number_format or 'General'
+        style_key = (font, alignment, border, fill, number_format, protection)
+        name = self._by_style.get(style_key)
+        if name is None:
+            name = f'{self.prefix} {len(self._by_style) + 1}'
+            named_style = NamedStyle(name=name, font=font, alignment=alignment, border=border,
+                                     fill=fill, number_format=number_format)
+            if protection is not None:
+                named_style.protection = protection
+            self.wb.add_named_style(named_style)
+            self._by_style[style_key] = name
+        self.names[key] = name
+        return name
+
+    def style_id(self, key, font, alignment, border, fill, number_format='General', protection=None):
+        """
+        Get the workbook style id of a key, as cells of rows written by
+        xlsx.RowWriter refer to it; see get for the arguments.
+
+        Assigning a name to cell.style searches the workbook's named styles
+        for every cell; the id is worked out once per key instead.
+
+        Returns:
+            int: Index of the cell style in the workbook's stylesheet.
+        """
+        style_id = self.ids.get(key)
+        if style_id is None:
+            cell = Cell(self.wb.worksheets[0])
+            cell.style = self.get(key, font, alignment, border, fill, number_format, protection)
+            style_id = self.ids[key] = cell.style_id
+            self.specs[style_id] = style_spec(font, alignment, border, fill, number_format, protection)
+        return style_id
@@ -0,0 +1,218 @@
+import argparse
+import json
+import sys
+from bisect import bisect_left
+
+import openpyxl
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
+from openpyxl.utils import get_column_letter
+
+import instrument
+import loader
+import pricestore
+import refcache
+from reference import to_number
+
+REPORT_SHEET = '錯誤報告'
+REPORT_HEADERS = ['列號', '欄位', '錯誤類型', '內容', '說明']
+REPORT_WIDTHS = [8, 8, 16, 24, 60]
+# Columns D–G of 標準成本結構表 as calculate_row reads them.
+DIMENSION_COLUMNS = (('E', '厚度'), ('F', '長'), ('G', '寬'))
+PROBLEM_LABELS = {
+    'missing_sheet': '缺少工作表',
+    'convert': '數值轉換失敗',
+    'missing_coefficient': '找不到重量係數',
+    'missing_price': '找不到材料費單價',
+    'no_mm_thickness': '找不到米數厚度',
+    'mm_table': '米數表格式錯誤',
+    'invalid_reference': '參照值無法計算',
+}
+
+
+def _problem(row, column, code, value, message):
+    return {'row': row, 'column': column, 'code': code, 'value': value, 'message': message}
+
+
+def validate_row(values, tables, i):
+    """
+    Check one BOM row the way calculate_row would calculate it, without stopping at the first problem.
+
+    Args:
+        values (tuple): Values of columns D–G (材質, 厚度, 長, 寬).
+        tables (ReferenceTables): Indexed reference sheets.
+        i (int): Row number, for the messages.
+
+    Returns:
+        list: Problems found, empty when the row calculates. Rows with an
+              empty column in D–G are not calculated, so they have none.
+    """
+    if None in values or '' in values:
+        return []
+
+    material = values[0]
+    problems = []
+    numbers = []
+    for (column, name), value in zip(DIMENSION_COLUMNS, values[1:]):
+        number = to_number(value)
+        if number is None:
+            problems.append(_problem(i, column, 'convert', value, f'{name}「{value}」無法轉換為數值'))
+        numbers.append(number)
+    thickness = numbers[0]
+
+    coefficient = tables.coefficients.get(material)
+    if material not in tables.coefficients:
+        problems.append(_problem(i, 'D', 'missing_coefficient', material,
+                                 f'鐵板重量計算中找不到材質「{material}」的重量係數'))
+    price = None
+    if thickness is not None:
+        if (material, thickness) not in tables.prices:
+            problems.append(_problem(i, 'E', 'missing_price', thickness,
+                                     f'鐵板材料費單價中找不到材質「{material}」厚度 {thickness} 的單價'))
+        else:
+            price = tables.prices[(material, thickness)]
+
+    mm = None
+    if tables.mm_error is not None:
+        problems.append(_problem(i, 'E', 'mm_table', None, f'鐵板米數計算的厚度格式錯誤：{tables.mm_error}'))
+    elif thickness is not None:
+        thicknesses, mm_values = tables.mm_index.get(material, ((), ()))
+        pos = bisect_left(thicknesses, thickness)
+        if pos == len(thicknesses):
+            problems.append(_problem(i, 'E', 'no_mm_thickness', thickness,
+                                     f'鐵板米數計算中找不到材質「{material}」厚度 {thickness} 以上的米數'))
+        else:
+            mm = mm_values[pos]
+
+    if problems:
+        return problems
+    # Everything was found; the reference values themselves may still not calculate.
+    try:
+        weight = numbers[0] * numbers[1] * numbers[2] * float(coefficient)
+        round(weight * price, 2)
+        round((numbers[1] + numbers[2]) * mm * 2 / 1000, 2)
+    except Exception as e:
+        problems.append(_problem(i, 'D', 'invalid_reference', material,
+                                 f'材質「{material}」的參照值無法計算（係數 {coefficient!r}、單價 {price!r}、米數 {mm!r}）：{e}'))
+    return problems
+
+
+def validate_workbook(input_path, cache=None, metrics=None, progress=None, price_store=None):
+    """
+    Check every BOM row of an input workbook and return all problems at once.
+
+    Only cell values are read, and no output is built, so this takes a
+    fraction of a full run. The reference indexes come from the cache when
+    their sheets are unchanged.
+
+    Args:
+        input_path (str): 輸入 Excel 檔案路徑
+        cache (ReferenceCache, optional): Cache of parsed reference indexes.
+        metrics (RunMetrics, optional): Receives the load and validate timings and the rows checked.
+        progress (Progress, optional): Reports the validate phase row by row.
+        price_store (PriceStore, optional): Check against the reference data of
+            this store; the workbook then only needs 標準成本結構表.
+
+    Returns:
+        list: Problems in row order, each a dict with row, column (letter in
+              標準成本結構表), code (see PROBLEM_LABELS), value and message.
+    """
+    metrics = metrics or instrument.RunMetrics()
+    with metrics.phase('load'):
+        digests = loader.reference_digests(input_path) if cache is not None and price_store is None else {}
+        wb = openpyxl.load_workbook(input_path, read_only=True)
+    try:
+        required = (loader.BASE_SHEET,) if price_store is not None else (loader.BASE_SHEET, *loader.REFERENCE_INDEXERS)
+        missing = [name for name in required if name not in wb.sheetnames]
+        if missing:
+            return [_problem(None, None, 'missing_sheet', name, f'缺少工作表「{name}」') for name in missing]
+        with metrics.phase('load'):
+            if price_store is not None:
+                tables = price_store.reference_tables()
+            else:
+                sheets = {name: wb[name] for name in loader.REFERENCE_INDEXERS}
+                tables = loader.read_reference_tables(sheets, digests, cache, metrics, progress)
+
+        base_ws = wb[loader.BASE_SHEET]
+        base_ws.reset_dimensions()
+        problems = []
+        if progress is not None:
+            progress.start('validate')
+        with metrics.phase('validate'):
+            # Row 5 is the product itself; costs start at row 6.
+            for i, row in enumerate(base_ws.iter_rows(min_row=6, min_col=4, max_col=7, values_only=True), start=6):
+                values = tuple(row) + (None,) * (4 - len(row))
+                problems.extend(validate_row(values, tables, i))
+                metrics.rows += 1
+                if progress is not None:
+                    progress.advance()
+    finally:
+        wb.close()
+    metrics.count('problems', len(problems))
+    return problems
+
+
+def format_problem(problem):
+    """
+    Describe a problem in one line, e.g. '第 12 列 F 欄：長「abc」無法轉換為數值'.
+    """
+    if problem['row'] is None:
+        return problem['message']
+    return f"第 {problem['row']} 列 {problem['column']} 欄：{problem['message']}"
+
+
+def write_report(problems, output_path):
+    """
+    Save the problems as an 錯誤報告 sheet in a new workbook.
+
+    Args:
+        problems (list): From validate_workbook.
+        output_path (str): Report file path.
+    """
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(REPORT_SHEET)
+    for col, width in enumerate(REPORT_WIDTHS, start=1):
+        ws.column_dimensions[get_column_letter(col)].width = width
+    ws.freeze_panes = 'A2'
+    bold = Font(bold=True)
+    header = []
+    for title in REPORT_HEADERS:
+        cell = WriteOnlyCell(ws, value=title)
+        cell.font = bold
+        header.append(cell)
+    ws.append(header)
+    for problem in problems:
+        value = problem['value']
+        ws.append([problem['row'], problem['column'], PROBLEM_LABELS.get(problem['code'], problem['code']),
+                   value if value is None or isinstance(value, (int, float, str)) else str(value),
+                   problem['message']])
+    wb.save(output_path)
+
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description='只檢查輸入檔，一次列出所有無法計算的列，不產生成本計算結果')
+    parser.add_argument('input', help='輸入 Excel 檔案')
+    parser.add_argument('--report', default=None, help='另存錯誤報告 Excel 檔的路徑')
+    parser.add_argument('--json', action='store_true', help='以 JSON 輸出錯誤清單')
+    parser.add_argument('--no-cache', action='store_true', help='不使用參照表快取，每次重新解析')
+    pricestore.add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    metrics = instrument.RunMetrics()
+    problems = validate_workbook(args.input, None if args.no_cache else refcache.ReferenceCache(), metrics,
+                                 price_store=pricestore.from_arguments(args))
+    if args.report:
+        write_report(problems, args.report)
+    if args.json:
+        print(json.dumps(problems, ensure_ascii=False, indent=2, default=str))
+    else:
+        for problem in problems:
+            print(format_problem(problem))
+        result = metrics.as_dict()
+        print(f"檢查 {result['rows']} 列，發現 {len(problems)} 個問題，耗時 {result['seconds']:.2f} 秒")
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(cli())
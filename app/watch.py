@@ -0,0 +1,469 @@
+import argparse
+import ctypes
+import ctypes.util
+import hashlib
+import json
+import multiprocessing
+import os
+import select
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import batch
+import instrument
+import workerpool
+
+STATE_FILENAME = '.watch-state.json'
+STATUS_FILENAME = 'watch-status.json'
+SETTLE_SECONDS = 3.0  # a file must keep the same size and mtime this long before it is processed
+POLL_INTERVAL = 2.0
+RESCAN_INTERVAL = 60.0  # full rescans between inotify events, in case one was missed
+LATENCY_WINDOW = 100  # jobs the latency figures in the status file cover
+
+
+def file_digest(path):
+    """
+    Hash a file's bytes, to skip inputs that were saved again without changes.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def scan_inputs(folder):
+    """
+    List the input workbooks of a folder with their modification time and size.
+
+    Returns:
+        dict: Absolute path -> (mtime_ns, size), without Excel lock files (~$*.xlsx)
+              and hidden files.
+    """
+    found = {}
+    try:
+        entries = list(os.scandir(folder))
+    except OSError:
+        return found
+    for entry in entries:
+        name = entry.name
+        if not name.lower().endswith('.xlsx') or name.startswith(('~$', '.')):
+            continue
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue  # removed while scanning
+        found[os.path.abspath(entry.path)] = (stat.st_mtime_ns, stat.st_size)
+    return found
+
+
+def is_readable(path):
+    """
+    Check that a file can be opened, i.e. the ERP export no longer holds it locked.
+    """
+    try:
+        with open(path, 'rb') as f:
+            f.read(1)
+        return True
+    except OSError:
+        return False
+
+
+class PollingWaiter:
+    """
+    Waits a fixed interval between scans of the watched folder.
+    """
+
+    name = 'polling'
+
+    def __init__(self, interval=POLL_INTERVAL):
+        self.interval = interval
+
+    def wait(self, timeout, stop):
+        stop.wait(min(timeout, self.interval))
+
+    def close(self):
+        pass
+
+
+class InotifyWaiter:
+    """
+    Sleeps until the kernel reports a change in the watched folder (Linux only).
+
+    Events only wake the watcher up; what changed is always worked out by
+    rescanning the folder, so a missed or coalesced event costs nothing but
+    latency.
+    """
+
+    name = 'inotify'
+    # IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    MASK = 0x2 | 0x4 | 0x8 | 0x80 | 0x100
+
+    def __init__(self, folder):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 失敗')
+        if libc.inotify_add_watch(self.fd, os.fsencode(folder), self.MASK) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f'無法監看資料夾: {folder}')
+
+    def wait(self, timeout, stop):
+        # stop is checked at least once a second, so a shutdown request is not held up.
+        deadline = time.monotonic() + min(timeout, RESCAN_INTERVAL)
+        while not stop.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            ready, _, _ = select.select([self.fd], [], [], min(remaining, 1.0))
+            if ready:
+                try:
+                    while os.read(self.fd, 64 * 1024):
+                        pass
+                except BlockingIOError:
+                    pass
+                return
+
+    def close(self):
+        os.close(self.fd)
+
+
+def make_waiter(folder, poll=False, poll_interval=POLL_INTERVAL):
+    """
+    Get an InotifyWaiter where the platform supports it, else a PollingWaiter.
+
+    Args:
+        folder (str): The watched folder.
+        poll (bool): Always poll, e.g. for network shares whose changes made by
+            other machines inotify does not see.
+        poll_interval (float): Seconds between scans when polling.
+    """
+    if not poll and sys.platform.startswith('linux'):
+        try:
+            return InotifyWaiter(folder)
+        except (OSError, AttributeError) as e:
+            print(f'無法使用 inotify，改為定時掃描: {e}')
+    return PollingWaiter(poll_interval)
+
+
+class Job:
+    """
+    One input waiting to be processed, or being processed.
+    """
+
+    def __init__(self, path, key, digest, detected):
+        self.path = path
+        self.key = key
+        self.digest = digest
+        self.detected = detected  # time.time() when the change was first seen
+        self.alone = False  # no other job ran in the pool at the same time
+        self.isolate = False  # run with no other job, after a worker died with others running
+
+
+class FolderWatcher:
+    """
+    Processes the ERP exports dropped into a folder as they arrive.
+
+    New and modified .xlsx files are picked up once their size and mtime have
+    not changed for `settle` seconds, so half-written exports are not read.
+    Jobs are queued and run on a pool of `workers` processes (batch.process_file),
+    and the outputs are moved into output_dir. An input whose content is the
+    same as at its last successful run is skipped, across restarts too: the
+    processed inputs are kept in a state file in output_dir. So is the version
+    of an input that failed, which is not retried until it changes.
+
+    An input that kills its worker process fails like any other: the pool is
+    replaced and the watcher goes on. When other jobs were running in the
+    same pool, it is not known which input was at fault, so each of them runs
+    again on its own first.
+
+    A status file (STATUS_FILENAME in output_dir by default) is rewritten as
+    the watcher runs, with the queue depth, job latency and error counts.
+    """
+
+    def __init__(self, source, output_dir, workers=None, settle=SETTLE_SECONDS, poll=False,
+                 poll_interval=POLL_INTERVAL, status_path=None, use_cache=True, chunk_size=None):
+        """
+        Args:
+            source (str): 監看資料夾
+            output_dir (str): 輸出資料夾，不可與監看資料夾相同
+            workers (int, optional): Worker processes, defaults to the CPU count.
+            settle (float): Seconds a file must stay unchanged before it is processed.
+            poll (bool): See make_waiter.
+            poll_interval (float): See make_waiter.
+            status_path (str, optional): Status file path.
+            use_cache (bool): See main.main.
+            chunk_size (int, optional): See main.main.
+        """
+        self.source = os.path.abspath(source)
+        self.output_dir = os.path.abspath(output_dir)
+        if os.path.normcase(self.source) == os.path.normcase(self.output_dir):
+            raise Exception('輸出資料夾不可與監看資料夾相同')
+        self.workers = workers or os.cpu_count() or 1
+        self.settle = settle
+        self.poll = poll
+        self.poll_interval = poll_interval
+        self.status_path = status_path or os.path.join(self.output_dir, STATUS_FILENAME)
+        self.state_path = os.path.join(self.output_dir, STATE_FILENAME)
+        self.use_cache = use_cache
+        self.chunk_size = chunk_size
+
+        self.state = self._read_state()  # input path -> {mtime_ns, size, sha256, output, failed}
+        self.pending = {}  # path -> (key, unchanged since, first detected)
+        self.queued = deque()
+        self.running = {}  # future -> Job
+        # path -> key of the version that failed, not retried until it changes
+        self.failed = {path: tuple(entry['failed']) for path, entry in self.state.items() if entry.get('failed')}
+        self.pool = None
+        self.processed = 0
+        self.skipped = 0
+        self.errors = 0
+        self.last_error = None
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.started = time.time()
+        self.waiter_name = None
+
+    def _read_state(self):
+        try:
+            with open(self.state_path, encoding='utf-8') as f:
+                state = json.load(f)
+            return state if isinstance(state, dict) else {}
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def _write_json(path, data):
+        temp_path = f'{path}.tmp'
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+            os.replace(temp_path, path)
+        except OSError as e:
+            print(f'無法寫入 {path}: {e}')
+
+    def _is_done(self, path, key):
+        entry = self.state.get(path)
+        return entry is not None and (entry.get('mtime_ns'), entry.get('size')) == tuple(key)
+
+    def _busy_keys(self):
+        return {job.path: job.key for job in (*self.queued, *self.running.values())}
+
+    def scan(self):
+        """
+        Rescan the folder: track changed files until they settle, then queue them.
+
+        Returns:
+            float: Seconds until the next pending file may settle, or None if none is pending.
+        """
+        now = time.time()
+        found = scan_inputs(self.source)
+        busy = self._busy_keys()
+        for path in list(self.pending):
+            if path not in found:
+                del self.pending[path]
+
+        next_check = None
+        for path, key in found.items():
+            if self._is_done(path, key) or self.failed.get(path) == key or busy.get(path) == key:
+                self.pending.pop(path, None)
+                continue
+            key_now, since, detected = self.pending.get(path, (None, now, now))
+            if key_now != key:
+                # New, or still being written: restart the settle time.
+                self.pending[path] = (key, now, detected)
+                since = now
+            wait_left = self.settle - (now - since)
+            if wait_left > 0 or path in busy or not is_readable(path):
+                wait_left = max(wait_left, 0.5)
+                next_check = wait_left if next_check is None else min(next_check, wait_left)
+                continue
+
+            del self.pending[path]
+            try:
+                digest = file_digest(path)
+            except OSError:
+                continue
+            entry = self.state.get(path)
+            if entry is not None and entry.get('sha256') == digest:
+                # Saved again with the same content.
+                entry['mtime_ns'], entry['size'] = key
+                self.skipped += 1
+                self._write_json(self.state_path, self.state)
+                continue
+            self.queued.append(Job(path, key, digest, detected))
+        return next_check
+
+    def submit(self):
+        """
+        Start queued jobs while fewer than `workers` are running; a job to
+        isolate starts only when none is running, and holds the others back.
+        """
+        while self.queued and len(self.running) < self.workers:
+            if any(job.isolate for job in self.running.values()) or (self.queued[0].isolate and self.running):
+                break
+            job = self.queued.popleft()
+            for other in self.running.values():
+                other.alone = False
+            job.alone = not self.running
+            future = self.pool.submit(batch.process_file, job.path, self.output_dir, True,
+                                      self.use_cache, self.chunk_size)
+            self.running[future] = job
+
+    def collect(self, timeout=0):
+        """
+        Move the outputs of finished jobs into place and record their results.
+        """
+        if not self.running:
+            return
+        done, _ = wait(list(self.running), timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            job = self.running.pop(future)
+            latency = time.time() - job.detected
+            record = {'input': job.path, 'watch': True, 'latency_seconds': latency}
+            try:
+                result = future.result()
+            except BrokenProcessPool:
+                self.pool.recover(future)
+                if job.alone:
+                    self._fail(job, record, '處理程序意外結束')
+                else:
+                    job.isolate = True
+                    self.queued.appendleft(job)
+                continue
+            except Exception as e:
+                self._fail(job, record, str(e) or type(e).__name__)
+                continue
+
+            # Keep the output name of this input; only avoid names other inputs already use.
+            taken = {entry['output'] for path, entry in self.state.items()
+                     if path != job.path and entry.get('output')}
+            output_path = batch.unique_output_path(self.output_dir, result['output_name'], taken)
+            try:
+                os.replace(result['temp_path'], output_path)
+            except OSError as e:
+                # E.g. the output is open in Excel; the input is retried once it changes again.
+                if os.path.exists(result['temp_path']):
+                    os.remove(result['temp_path'])
+                self._fail(job, record, str(e))
+                continue
+            self.state[job.path] = {'mtime_ns': job.key[0], 'size': job.key[1], 'sha256': job.digest,
+                                    'output': os.path.basename(output_path)}
+            self._write_json(self.state_path, self.state)
+            self.failed.pop(job.path, None)
+            self.processed += 1
+            self.latencies.append(latency)
+            print(f"完成 {os.path.basename(job.path)} -> {os.path.basename(output_path)}"
+                  f"（{result['rows']} 列，{result['seconds']:.2f} 秒，延遲 {latency:.1f} 秒）")
+            instrument.write_log({**record, 'output': output_path, 'rows': result['rows'],
+                                  'seconds': result['seconds'], 'error': None})
+
+    def _fail(self, job, record, error):
+        self.errors += 1
+        self.failed[job.path] = job.key
+        self.state.setdefault(job.path, {})['failed'] = list(job.key)
+        self._write_json(self.state_path, self.state)
+        self.last_error = {'input': job.path, 'error': error, 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+        print(f'失敗 {os.path.basename(job.path)}: {error}')
+        instrument.write_log({**record, 'output': None, 'error': error})
+
+    def status(self):
+        """
+        Get the status written to the status file.
+        """
+        now = time.time()
+        waiting = [job.detected for job in self.queued] + [detected for _, _, detected in self.pending.values()]
+        latencies = list(self.latencies)
+        return {
+            'updated': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+            'source': self.source,
+            'output_dir': self.output_dir,
+            'watcher': self.waiter_name,
+            'workers': self.workers,
+            'pending': len(self.pending),
+            'queued': len(self.queued),
+            'running': len(self.running),
+            'queue_depth': len(self.queued) + len(self.running),
+            'oldest_waiting_seconds': now - min(waiting) if waiting else 0,
+            'processed': self.processed,
+            'skipped': self.skipped,
+            'errors': self.errors,
+            'last_error': self.last_error,
+            'latency_seconds': {
+                'last': latencies[-1] if latencies else None,
+                'average': sum(latencies) / len(latencies) if latencies else None,
+                'max': max(latencies) if latencies else None,
+            },
+        }
+
+    def run(self, stop=None, once=False):
+        """
+        Watch the folder until `stop` is set (or Ctrl+C), then finish the running jobs.
+
+        Args:
+            stop (threading.Event, optional): Set from another thread to stop the watcher.
+            once (bool): Process the files already in the folder, then return.
+        """
+        stop = stop or threading.Event()
+        os.makedirs(self.output_dir, exist_ok=True)
+        waiter = make_waiter(self.source, self.poll, self.poll_interval)
+        self.waiter_name = waiter.name
+        print(f'監看 {self.source}（{waiter.name}），輸出至 {self.output_dir}')
+        self.pool = workerpool.WorkerPool(self.workers)
+        try:
+            try:
+                while not stop.is_set():
+                    next_check = self.scan()
+                    self.submit()
+                    self.collect()
+                    self._write_json(self.status_path, self.status())
+                    if once and not (self.pending or self.queued or self.running):
+                        break
+                    if self.running:
+                        self.collect(min(next_check or POLL_INTERVAL, POLL_INTERVAL))
+                    else:
+                        waiter.wait(next_check if next_check is not None else RESCAN_INTERVAL, stop)
+            except KeyboardInterrupt:
+                print('停止監看，等待執行中的工作完成...')
+            self.queued.clear()
+            while self.running:
+                self.collect(None)
+        finally:
+            self.pool.shutdown()
+            waiter.close()
+            self._write_json(self.status_path, self.status())
+
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description='監看資料夾，自動處理新產生或更新的 ERP 成本結構表')
+    parser.add_argument('source', help='監看的資料夾（ERP 匯出位置）')
+    parser.add_argument('output_dir', help='輸出資料夾')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='同時處理的程序數（預設為 CPU 核心數）')
+    parser.add_argument('--settle', type=float, default=SETTLE_SECONDS,
+                        help='檔案大小與修改時間需維持不變的秒數，避免讀到寫入中的檔案')
+    parser.add_argument('--poll', action='store_true', help='不使用 inotify，改為定時掃描（適用網路磁碟）')
+    parser.add_argument('--poll-interval', type=float, default=POLL_INTERVAL, help='定時掃描的間隔秒數')
+    parser.add_argument('--status', default=None, help=f'狀態檔路徑（預設為輸出資料夾中的 {STATUS_FILENAME}）')
+    parser.add_argument('--no-cache', action='store_true', help='不使用參照表快取，每次重新解析')
+    parser.add_argument('--chunk-size', type=int, default=None,
+                        help='以固定列數分段讀取、計算並寫出，記憶體用量不隨檔案大小增加（適用超大 BOM）')
+    parser.add_argument('--once', action='store_true', help='處理完資料夾中現有的檔案後即結束')
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.source):
+        print(f'找不到監看資料夾: {args.source}')
+        return 1
+    watcher = FolderWatcher(args.source, args.output_dir, args.workers, args.settle, args.poll,
+                            args.poll_interval, args.status, not args.no_cache, args.chunk_size)
+    watcher.run(once=args.once)
+    return 1 if watcher.errors and args.once else 0
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(cli())
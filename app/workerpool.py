@@ -0,0 +1,105 @@
+import os
+import threading
+import time
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# Only the standard library is imported here, so jobqueue can use it before
+# the calculation modules are loaded.
+
+
+def ping():
+    """
+    Does nothing; submitted once per worker to start the processes.
+    """
+    time.sleep(0.1)
+    return os.getpid()
+
+
+class WorkerPool:
+    """
+    A process pool that is replaced by a fresh one when a worker process dies.
+
+    When a worker is killed (out of memory, a crash in a C extension),
+    ProcessPoolExecutor breaks for good: its pending jobs fail with
+    BrokenProcessPool, and so does every later submit. submit starts a new
+    pool then and submits again, and recover drops the pool a failed job ran
+    on, so the next job does not wait for that. Safe to share between threads.
+
+    Args:
+        workers (int): Worker processes.
+        initializer (callable, optional): Run in every worker process of every pool.
+        initargs (tuple): Arguments of initializer.
+        warm (bool): Start the worker processes of a replacement pool right away,
+            so the job after a crash does not pay for starting them.
+    """
+
+    def __init__(self, workers, initializer=None, initargs=(), warm=False):
+        self.workers = workers
+        self.initializer = initializer
+        self.initargs = initargs
+        self.warm = warm
+        self.restarts = 0
+        self._executor = None
+        self._lock = threading.Lock()
+        self._owners = weakref.WeakKeyDictionary()  # future -> the executor it was submitted to
+
+    def _current(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=self.initializer,
+                                                     initargs=self.initargs)
+                if self.restarts and self.warm:
+                    for _ in range(self.workers):
+                        self._executor.submit(ping)
+            return self._executor
+
+    def _replace(self, executor):
+        # Only the broken pool is dropped: another thread may have replaced it already.
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+                self.restarts += 1
+                executor.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, fn, *args):
+        """
+        Submit a job, to a new pool if the current one is broken.
+
+        Returns:
+            Future: The job's future.
+        """
+        executor = self._current()
+        try:
+            future = executor.submit(fn, *args)
+        except BrokenProcessPool:
+            self._replace(executor)
+            executor = self._current()
+            future = executor.submit(fn, *args)
+        self._owners[future] = executor
+        return future
+
+    def recover(self, future):
+        """
+        Replace the pool of a future that failed with BrokenProcessPool.
+        """
+        executor = self._owners.pop(future, None)
+        if executor is not None:
+            self._replace(executor)
+
+    def warm_up(self):
+        """
+        Start every worker process now instead of on the first jobs.
+
+        Returns:
+            int: Number of worker processes that answered.
+        """
+        futures = [self.submit(ping) for _ in range(self.workers)]
+        return len({future.result() for future in futures})
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait, cancel_futures=cancel_futures)
@@ -0,0 +1,423 @@
+from openpyxl import Workbook
+
+import excel
+import instrument
+import style
+import xlsx
+
+BASE_FIRST_ROW = 5
+OUTPUT_FIRST_ROW = 3
+COLUMN_COUNT = len(excel.HEADER_TITLES)
+# output column -> 標準成本結構表 column (A:H -> C:J, I -> Q)
+COPIED_COLUMNS = {**{dest: dest - 2 for dest in range(3, 11)}, 17: 9}
+COST_COLUMNS = range(11, 15)  # K:N
+FORMULA_COLUMNS = (18, 19)  # R:S
+# Columns the FORMULA_COLUMNS calculate from: J, M, N, O, P, Q as row_formula_values takes them.
+FORMULA_INPUT_COLUMNS = (10, 13, 14, 15, 16, 17)
+TOTAL_COLUMN = 19
+
+
+def header_rows(registry):
+    """
+    Yield the two header rows.
+
+    Args:
+        registry (NamedStyleRegistry): Named styles of the workbook.
+
+    Yields:
+        list: (value, style id) of each cell of one row, see xlsx.RowWriter.
+    """
+    font, alignment, border, fill = excel.get_header_style()
+    header_cells = {(row, col): (value, number_format)
+                    for row, col, value, number_format in excel.get_header_cells()}
+    for row in (1, 2):
+        cells = []
+        for col in range(1, COLUMN_COUNT + 1):
+            if (row, col) not in header_cells:
+                cells.append(None)
+                continue
+            value, number_format = header_cells[(row, col)]
+            style_id = registry.style_id(('header', number_format), font, alignment, border, fill, number_format)
+            cells.append((value, style_id))
+        yield cells
+
+
+def data_column_styles():
+    """
+    Get the resolved column styles of the first data row and of the other data rows.
+
+    Returns:
+        tuple: (first_row_styles, regular_styles), see style.resolve_range_styles.
+    """
+    regular_styles = style.resolve_range_styles(excel.BASIC_STYLE_RANGES)
+    first_row_styles = style.resolve_range_styles(excel.FIRST_ROW_STYLE_RANGES, regular_styles)
+    return first_row_styles, regular_styles
+
+
+def data_row_values(column_styles, base, row, query_label, res):
+    """
+    Work out the values, number formats and source styles of one BOM row of the output.
+
+    Args:
+        column_styles (dict): Resolved styles of the row, from data_column_styles.
+        base (BaseSheet): Sheet or chunk holding the source row.
+        row (int): Output row number.
+        query_label (str): Parent label for the 查詢編號 columns, None to leave them empty.
+        res (list): calculate_row result of the source row; not used for the first row.
+
+    Returns:
+        tuple: (values, formats, source_styles) lists with one entry per output
+               column; source_styles holds the style ids of copied cells in base.
+               The formulas are CachedFormula strings carrying their values.
+    """
+    base_row = row - OUTPUT_FIRST_ROW + BASE_FIRST_ROW
+    values = [None] * COLUMN_COUNT
+    formats = [None] * COLUMN_COUNT
+    source_styles = [None] * COLUMN_COUNT
+
+    if query_label is not None:
+        values[0] = query_label
+        values[1] = row - 2
+
+    for col, src_col in COPIED_COLUMNS.items():
+        value = base.value(base_row, src_col)
+        values[col - 1] = value
+        style_id = base.style_id(base_row, src_col)
+        if style_id is not None:
+            source_styles[col - 1] = style_id
+            formats[col - 1] = base.styles[style_id][4]
+        if isinstance(value, float):
+            formats[col - 1] = '0.00'
+
+    for col in range(1, COLUMN_COUNT + 1):
+        column_format = column_styles[col][4]
+        if column_format:
+            formats[col - 1] = column_format
+
+    if row > OUTPUT_FIRST_ROW:
+        for j, col in enumerate(COST_COLUMNS):
+            if res is None:
+                values[col - 1] = ""
+            else:
+                values[col - 1] = res[j]
+                formats[col - 1] = '0.00'
+        cached = excel.row_formula_values(*(values[col - 1] for col in FORMULA_INPUT_COLUMNS))
+        for col, formula, value in zip(FORMULA_COLUMNS, excel.row_formulas(row), cached):
+            values[col - 1] = xlsx.CachedFormula(formula, value)
+            formats[col - 1] = '0.00'
+
+    return values, formats, source_styles
+
+
+def data_row_cells(registry, column_styles, base, row, query_label, res, results=None):
+    """
+    Build the cells of one BOM row of the output.
+
+    Args:
+        registry (NamedStyleRegistry): Named styles of the workbook.
+        column_styles (dict): Resolved styles of the row, from data_column_styles.
+        base (BaseSheet): Sheet or chunk holding the source row.
+        row (int): Output row number.
+        query_label (str): Parent label for the 查詢編號 columns, None to leave them empty.
+        res (list): calculate_row result of the source row; not used for the first row.
+        results (RowResults, optional): Receives the values of the row.
+
+    Returns:
+        list: (value, style id) of each cell, see xlsx.RowWriter.
+    """
+    values, formats, source_styles = data_row_values(column_styles, base, row, query_label, res)
+    if results is not None:
+        results.add(row, values)
+    cells = []
+    for col in range(1, COLUMN_COUNT + 1):
+        font, alignment, border, fill, _ = column_styles[col]
+        style_id = source_styles[col - 1]
+        protection = None if style_id is None else base.styles[style_id][5]
+        key = (row == OUTPUT_FIRST_ROW, col, formats[col - 1], style_id)
+        cells.append((values[col - 1], registry.style_id(key, font, alignment, border, fill, formats[col - 1],
+                                                          protection)))
+    return cells
+
+
+def data_rows(registry, model, total_row, query_labels, costs=None, metrics=None, progress=None, results=None):
+    """
+    Yield the BOM rows with copied columns, query numbers, costs and formulas,
+    computed one row at a time.
+
+    Args:
+        registry (NamedStyleRegistry): Named styles of the workbook.
+        model (CostModel): The parsed input.
+        total_row (int): Number of BOM rows.
+        query_labels (list): Parent label of each output row, starting at row 3.
+        costs (list, optional): Precomputed calculate_row results from row 6 on.
+        metrics (RunMetrics, optional): Receives rows_calculated/rows_skipped.
+        progress (Progress, optional): Advanced once per row.
+        results (RowResults, optional): Receives the values of every row.
+
+    Yields:
+        list: Cells of one row, see data_row_cells.
+    """
+    base = model.base
+    first_row_styles, regular_styles = data_column_styles()
+
+    for row in range(OUTPUT_FIRST_ROW, total_row + OUTPUT_FIRST_ROW + 1):
+        base_row = row - OUTPUT_FIRST_ROW + BASE_FIRST_ROW
+        res = None
+        if row > OUTPUT_FIRST_ROW:
+            if costs is None:
+                res = excel.calculate_row(base, model.tables, base_row)
+            else:
+                res = costs[base_row - BASE_FIRST_ROW - 1]
+            if metrics is not None:
+                metrics.count('rows_skipped' if res is None else 'rows_calculated')
+
+        index = row - OUTPUT_FIRST_ROW
+        query_label = query_labels[index] if index < len(query_labels) else None
+        column_styles = first_row_styles if row == OUTPUT_FIRST_ROW else regular_styles
+        cells = data_row_cells(registry, column_styles, base, row, query_label, res, results)
+        if progress is not None:
+            progress.advance()
+        yield cells
+
+
+def total_rows(registry, total_row, totals=None):
+    """
+    Yield the 總合計 and 含其它製程費用 rows below the data.
+
+    Args:
+        registry (NamedStyleRegistry): Named styles of the workbook.
+        total_row (int): Number of BOM rows.
+        totals (FormulaTotals, optional): 合計 values of the data rows, read
+            once the data rows are written; the totals are saved without a value otherwise.
+
+    Yields:
+        list: Cells of one row, see data_row_cells.
+    """
+    column_styles = style.resolve_range_styles(excel.TOTAL_STYLE_RANGES)
+    labels = ('總合計', '含其它製程費用')
+    cached = totals.values() if totals is not None else (None, None)
+    formulas = [xlsx.CachedFormula(formula, value) for formula, value in zip(excel.total_formulas(total_row), cached)]
+    for label, formula in zip(labels, formulas):
+        cells = [None] * COLUMN_COUNT
+        for col, (font, alignment, border, fill, _) in column_styles.items():
+            value = None
+            number_format = None
+            if col == 16:
+                value = label
+            elif col == TOTAL_COLUMN:
+                value = formula
+                number_format = '0.00'
+            style_id = registry.style_id(('total', col, number_format), font, alignment, border, fill, number_format)
+            cells[col - 1] = (value, style_id)
+        yield cells
+
+
+class RowResults:
+    """
+    Collects the values of the output rows as they are written: the running
+    totals for the total rows and the rows for the export files.
+
+    Args:
+        exports (list): Open export files, see export.open_exports.
+        keep_totals (bool): Also keep the 合計 of every row in row_totals, e.g.
+            for the 組件小計 sheet; the first row has none and keeps None.
+    """
+
+    def __init__(self, exports=(), keep_totals=False):
+        self.totals = excel.FormulaTotals()
+        self.exports = list(exports)
+        self.row_totals = [] if keep_totals else None
+
+    def add(self, row, values):
+        """
+        Take the values of one output row, formulas as CachedFormula strings.
+        """
+        total = values[TOTAL_COLUMN - 1].cached if row > OUTPUT_FIRST_ROW else None
+        if row > OUTPUT_FIRST_ROW:
+            self.totals.add(total)
+        if self.row_totals is not None:
+            self.row_totals.append(total)
+        if self.exports:
+            plain = [value.cached if isinstance(value, xlsx.CachedFormula) else value for value in values]
+            for sink in self.exports:
+                sink.write_row(plain)
+
+    def finish(self):
+        """
+        Write the totals and close the export files.
+        """
+        sum_value, with_process_value = self.totals.values()
+        for sink in self.exports:
+            sink.write_totals(sum_value, with_process_value)
+            sink.close()
+
+    def abort(self):
+        """
+        Remove the unfinished export files.
+        """
+        for sink in self.exports:
+            sink.abort()
+
+
+def fill_formula_values(ws, total_row, results=None):
+    """
+    Work out the values of the row and total formulas of a sheet built cell by cell.
+
+    The formula cells get their formulas; the values are calculated from the
+    cells they refer to, as data_row_values gives them to the write-only path,
+    and are saved by passing them to xlsx.save_workbook.
+
+    Args:
+        ws (Worksheet): The output sheet with its data and total rows written.
+        total_row (int): Number of BOM rows.
+        results (RowResults, optional): Receives the values of every data row.
+
+    Returns:
+        dict: Coordinate -> value of every formula cell, e.g. {'S4': 12.5}.
+    """
+    results = results or RowResults()
+    cached = {}
+    for row in range(OUTPUT_FIRST_ROW, total_row + OUTPUT_FIRST_ROW + 1):
+        values = [ws.cell(row=row, column=col).value for col in range(1, COLUMN_COUNT + 1)]
+        if row > OUTPUT_FIRST_ROW:
+            row_values = excel.row_formula_values(*(values[col - 1] for col in FORMULA_INPUT_COLUMNS))
+            for col, formula, value in zip(FORMULA_COLUMNS, excel.row_formulas(row), row_values):
+                cell = ws.cell(row=row, column=col)
+                cell.value = formula
+                cached[cell.coordinate] = value
+                values[col - 1] = xlsx.CachedFormula(formula, value)
+        results.add(row, values)
+    for row, formula, value in zip((total_row + 4, total_row + 5), excel.total_formulas(total_row),
+                                   results.totals.values()):
+        cell = ws.cell(row=row, column=TOTAL_COLUMN)
+        cell.value = formula
+        cached[cell.coordinate] = value
+    return cached
+
+
+def prepare_sheet(ws, total_row):
+    """
+    Set the column widths and merged cells of a cost sheet, whose rows are written separately.
+
+    Args:
+        ws (Worksheet): The sheet.
+        total_row (int): Number of BOM rows.
+    """
+    excel.set_column_widths(ws)
+    for cell_range in excel.get_header_merges():
+        ws.merged_cells.add(cell_range)
+    ws.merged_cells.add(f'P{total_row + 4}:R{total_row + 4}')
+    ws.merged_cells.add(f'P{total_row + 5}:R{total_row + 5}')
+
+
+def write_sheet(wb, registry, model, costs=None, metrics=None, progress=None, results=None):
+    """
+    Add the cost sheet of a model to a write-only workbook, writing its rows one by one.
+
+    Args:
+        wb (Workbook): Write-only workbook.
+        registry (NamedStyleRegistry): Named styles of the workbook.
+        model (CostModel): The parsed input.
+        costs (list, optional): Precomputed calculate_row results from row 6 on.
+        metrics (RunMetrics, optional): Receives the write_rows timing.
+        progress (Progress, optional): Reports the write_rows phase.
+        results (RowResults, optional): Receives the values of every row.
+
+    Returns:
+        SheetData: The rows of the sheet, to save with xlsx.save_workbook; its
+                   ws is the sheet, which holds the column widths and merged cells.
+    """
+    metrics = metrics or instrument.RunMetrics()
+    results = results or RowResults()
+    base = model.base
+    total_row = base.max_row - BASE_FIRST_ROW
+    labels, label_nums = excel.get_labels_and_numbers(base)
+    label_name = excel.get_main_name(base)
+    query_labels = [label for label, count in zip(labels, label_nums) for _ in range(count)]
+
+    ws = wb.create_sheet(excel.get_sheet_title(labels, label_name))
+    prepare_sheet(ws, total_row)
+    data = xlsx.SheetData(ws)
+    if progress is not None:
+        progress.start('write_rows', total_row + 1)
+    with metrics.phase('write_rows'):
+        try:
+            for rows in (header_rows(registry),
+                         data_rows(registry, model, total_row, query_labels, costs, metrics, progress, results),
+                         total_rows(registry, total_row, results.totals)):
+                for cells in rows:
+                    data.append(cells)
+            data.close()
+        except BaseException:
+            # A failed or cancelled run leaves no temporary file behind.
+            data.discard()
+            raise
+    return data
+
+
+def write_rollup(wb, model, title, results, metrics=None):
+    """
+    Add the 組件小計 sheet of a cost sheet, see bomtree.write_rollup_sheet.
+
+    Args:
+        wb (Workbook): Workbook holding the cost sheet.
+        model (CostModel): The parsed input.
+        title (str): Title of the cost sheet.
+        results (RowResults): Results of the cost sheet, created with keep_totals.
+        metrics (RunMetrics, optional): Receives the rollup timing and the assemblies count.
+
+    Returns:
+        dict: The values of its formula cells for xlsx.save_workbook, {sheet: {coordinate: value}}.
+    """
+    # bomtree needs numpy, so it is only imported when a rollup is asked for.
+    import bomtree
+    metrics = metrics or instrument.RunMetrics()
+    with metrics.phase('rollup'):
+        tree = bomtree.BomTree.from_base(model.base)
+        ws, cached = bomtree.write_rollup_sheet(wb, tree, model.base, results.row_totals, title)
+    metrics.count('assemblies', len(tree.assemblies()))
+    return {ws: cached}
+
+
+def write_output(model, output_path, costs=None, metrics=None, progress=None, exports=(), rollup=False):
+    """
+    Build the cost sheet row by row in a write-only workbook and save it.
+
+    Produces the same sheet as the cell-by-cell path in main.main, but every
+    cell points at a NamedStyle registered once per distinct style, and rows
+    are serialized to a temporary file as they are computed.
+
+    Args:
+        model (CostModel): The parsed input.
+        output_path (str): 輸出 Excel 檔案路徑
+        costs (list, optional): Precomputed calculate_row results from row 6 on.
+        metrics (RunMetrics, optional): Receives the write_rows and save timings.
+        progress (Progress, optional): Reports the write_rows and save phases.
+        exports (list, optional): Open export files that also receive the rows and totals.
+        rollup (bool): Add a 組件小計 sheet with the subtotal of every assembly, see write_rollup.
+
+    Returns:
+        tuple: (results, registry), the RowResults of the sheet, with the
+               合計 of every row, and its NamedStyleRegistry, e.g. for incremental.build_manifest.
+    """
+    metrics = metrics or instrument.RunMetrics()
+    wb = Workbook(write_only=True)
+    registry = style.NamedStyleRegistry(wb)
+    results = RowResults(exports, keep_totals=True)
+    data = None
+    try:
+        data = write_sheet(wb, registry, model, costs, metrics, progress, results)
+        cached = write_rollup(wb, model, data.ws.title, results, metrics) if rollup else None
+        if progress is not None:
+            progress.start('save')
+        with metrics.phase('save'):
+            xlsx.save_workbook(wb, output_path, [data], cached)
+        with metrics.phase('export'):
+            results.finish()
+    except BaseException:
+        results.abort()
+        raise
+    finally:
+        if data is not None:
+            data.discard()
+    return results, registry
@@ -0,0 +1,651 @@
+import hashlib
+import os
+import posixpath
+import re
+import tempfile
+import zipfile
+import xml.etree.ElementTree as ET
+from datetime import timedelta
+from io import BytesIO
+
+from openpyxl.cell import Cell
+from openpyxl.cell.cell import ERROR_CODES, ILLEGAL_CHARACTERS_RE
+from openpyxl.compat import safe_string
+from openpyxl.formula.translate import Translator
+from openpyxl.styles.numbers import BUILTIN_FORMATS
+from openpyxl.styles.stylesheet import Stylesheet
+from openpyxl.utils.cell import column_index_from_string, get_column_letter
+from openpyxl.utils.datetime import (CALENDAR_MAC_1904, CALENDAR_WINDOWS_1900, from_excel, from_ISO8601, to_excel,
+                                     to_ISO8601)
+from openpyxl.worksheet.formula import ArrayFormula, DataTableFormula
+
+MAIN_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+REL_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+PKG_REL_NS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+
+_SHARED_STRING_CELL = re.compile(rb'<c\b[^>]*?\bt="s"[^>]*>\s*<v>(\d+)</v>')
+_SHARED_STRING_ITEM = re.compile(rb'<si\b(?:[^>]*/>|.*?</si>)', re.S)
+
+
+def sheet_parts(zf):
+    """
+    Map sheet names to their worksheet part paths inside an xlsx zip.
+
+    Args:
+        zf (ZipFile): The open xlsx archive.
+
+    Returns:
+        dict: Sheet name -> part path, e.g. {'鐵板重量計算': 'xl/worksheets/sheet2.xml'}.
+    """
+    rels = ET.fromstring(zf.read('xl/_rels/workbook.xml.rels'))
+    targets = {}
+    for rel in rels.iter(f'{{{PKG_REL_NS}}}Relationship'):
+        target = rel.get('Target')
+        if target.startswith('/'):
+            target = target[1:]
+        else:
+            target = posixpath.normpath(posixpath.join('xl', target))
+        targets[rel.get('Id')] = target
+
+    workbook = ET.fromstring(zf.read('xl/workbook.xml'))
+    parts = {}
+    for sheet in workbook.iter(f'{{{MAIN_NS}}}sheet'):
+        rel_id = sheet.get(f'{{{REL_NS}}}id')
+        if rel_id in targets:
+            parts[sheet.get('name')] = targets[rel_id]
+    return parts
+
+
+def sheet_digests(path, names):
+    """
+    Hash the contents of some sheets without parsing their cells.
+
+    Each digest covers the worksheet XML plus the raw shared-string items it
+    references, so identical sheets hash the same across workbooks even when
+    their shared-string tables differ.
+
+    Args:
+        path (str): Path of the xlsx file.
+        names (iterable): Sheet names to hash.
+
+    Returns:
+        dict: Sheet name -> hex digest. Sheets that are missing or use markup the
+              scan does not understand are left out.
+    """
+    with zipfile.ZipFile(path) as zf:
+        parts = sheet_parts(zf)
+        sheets = {name: zf.read(parts[name]) for name in names if name in parts}
+
+        indexes = {}
+        for name, data in sheets.items():
+            found = [int(i) for i in _SHARED_STRING_CELL.findall(data)]
+            if len(found) != data.count(b't="s"') or b"t='s'" in data:
+                continue
+            indexes[name] = found
+
+        items = []
+        if any(indexes.values()):
+            items = _SHARED_STRING_ITEM.findall(zf.read('xl/sharedStrings.xml'))
+
+    digests = {}
+    for name, found in indexes.items():
+        if found and max(found) >= len(items):
+            continue
+        digest = hashlib.sha256(sheets[name])
+        for i in found:
+            digest.update(b'\0')
+            digest.update(items[i])
+        digests[name] = digest.hexdigest()
+    return digests
+
+
+def _tag(name):
+    return f'{{{MAIN_NS}}}{name}'
+
+
+_ROW, _CELL, _VALUE, _FORMULA, _INLINE = _tag('row'), _tag('c'), _tag('v'), _tag('f'), _tag('is')
+_TEXT, _RUN, _SHARED_ITEM = _tag('t'), _tag('r'), _tag('si')
+
+
+def _text_content(node):
+    # Like openpyxl's Text.content: the plain text, then the text of each run; phonetic runs are left out.
+    if len(node) == 1 and node[0].tag == _TEXT:
+        return node[0].text or ''
+    snippets = []
+    plain = node.find(_TEXT)
+    if plain is not None and plain.text is not None:
+        snippets.append(plain.text)
+    for run in node.iterfind(_RUN):
+        text = run.findtext(_TEXT)
+        if text is not None:
+            snippets.append(text)
+    return ''.join(snippets)
+
+
+def _cast_number(value):
+    if '.' in value or 'E' in value or 'e' in value:
+        return float(value)
+    return int(value)
+
+
+class FastWorkbook:
+    """
+    Read cell values and style ids of worksheets straight from the xlsx zip.
+
+    The workbook part is read for the sheet names and the date system, the
+    shared strings and the stylesheet once, and each worksheet is streamed
+    with lxml's iterparse, clearing every row once read. Cells become plain
+    values and tuples instead of openpyxl cell objects, with the values
+    openpyxl's read-only mode would give them (numbers, dates, formulas as
+    '=...', shared formulas translated).
+
+    Raises on anything it cannot read the same way; callers fall back to openpyxl.
+
+    Args:
+        path (str): Path of the xlsx file.
+    """
+
+    def __init__(self, path):
+        # lxml is optional; without it the caller keeps using openpyxl.
+        from lxml import etree
+        self.etree = etree
+        self.zf = zipfile.ZipFile(path)
+        try:
+            self.parts = sheet_parts(self.zf)
+            workbook = etree.fromstring(self.zf.read('xl/workbook.xml'))
+            properties = workbook.find(_tag('workbookPr'))
+            date1904 = properties is not None and properties.get('date1904') in ('1', 'true')
+            self.epoch = CALENDAR_MAC_1904 if date1904 else CALENDAR_WINDOWS_1900
+            self.stylesheet = Stylesheet.from_tree(etree.fromstring(self.zf.read('xl/styles.xml')))
+            if not self.stylesheet.cell_styles:
+                raise ValueError('沒有儲存格樣式')
+            self.shared_strings = self._read_shared_strings()
+        except BaseException:
+            self.zf.close()
+            raise
+
+    def __getitem__(self, name):
+        if name not in self.parts:
+            raise KeyError(f'Worksheet {name} does not exist.')
+        return FastWorksheet(self, name)
+
+    def close(self):
+        self.zf.close()
+
+    def _read_shared_strings(self):
+        if 'xl/sharedStrings.xml' not in self.zf.namelist():
+            return []
+        strings = []
+        with self.zf.open('xl/sharedStrings.xml') as f:
+            for _, node in self.etree.iterparse(f, tag=_SHARED_ITEM):
+                strings.append(_text_content(node).replace('x005F_', ''))
+                node.clear()
+        return strings
+
+    def number_format(self, style_id):
+        """
+        Number format of a style id, as ReadOnlyCell.number_format gives it.
+        """
+        format_id = self.stylesheet.cell_styles[style_id].numFmtId
+        if format_id < 164:
+            return BUILTIN_FORMATS.get(format_id, 'General')
+        return self.stylesheet.number_formats[format_id - 164]
+
+    def cell_rows(self, name):
+        """
+        Yield the rows of a worksheet as they are stored.
+
+        Args:
+            name (str): Sheet name.
+
+        Yields:
+            tuple: (row number, cells), cells being (column, value, style id)
+                   tuples in document order.
+        """
+        date_formats = self.stylesheet.date_formats
+        timedelta_formats = self.stylesheet.timedelta_formats
+        shared_strings = self.shared_strings
+        shared_formulae = {}
+        columns = {}
+        row_counter = 0
+        with self.zf.open(self.parts[name]) as f:
+            for _, row in self.etree.iterparse(f, tag=_ROW):
+                r = row.get('r')
+                if r is None:
+                    row_counter += 1
+                else:
+                    try:
+                        row_counter = int(r)
+                    except ValueError:
+                        row_counter = int(float(r))
+                col_counter = 0
+                cells = []
+                for c in row.iterchildren(_CELL):
+                    data_type = c.get('t', 'n')
+                    style_id = int(c.get('s') or 0)
+                    coordinate = c.get('r')
+                    if coordinate:
+                        letters = coordinate.rstrip('0123456789')
+                        col_counter = columns.get(letters)
+                        if col_counter is None:
+                            col_counter = columns[letters] = column_index_from_string(letters)
+                    else:
+                        col_counter += 1
+                    formula = value = inline = None
+                    for child in c:
+                        tag = child.tag
+                        if tag == _VALUE:
+                            value = child.text or None
+                        elif tag == _FORMULA:
+                            formula = child
+                        elif tag == _INLINE:
+                            inline = child
+                    if data_type == 'inlineStr':
+                        value = None
+                    if formula is not None:
+                        value = '=' + (formula.text or '')
+                        formula_type = formula.get('t')
+                        if formula_type == 'array':
+                            value = ArrayFormula(ref=formula.get('ref'), text=value)
+                        elif formula_type == 'shared':
+                            index = formula.get('si')
+                            if index in shared_formulae:
+                                value = shared_formulae[index].translate_formula(coordinate)
+                            elif value != '=':
+                                shared_formulae[index] = Translator(value, coordinate)
+                        elif formula_type == 'dataTable':
+                            value = DataTableFormula(**formula.attrib)
+                    elif value is not None:
+                        if data_type == 'n':
+                            value = _cast_number(value)
+                            if style_id in date_formats:
+                                try:
+                                    value = from_excel(value, self.epoch, timedelta=style_id in timedelta_formats)
+                                except (OverflowError, ValueError):
+                                    value = '#VALUE!'
+                        elif data_type == 's':
+                            value = shared_strings[int(value)]
+                        elif data_type == 'b':
+                            value = bool(int(value))
+                        elif data_type == 'd':
+                            value = from_ISO8601(value)
+                    elif inline is not None:
+                        value = _text_content(inline)
+                    cells.append((col_counter, value, style_id))
+                row.clear()
+                # Drop the rows already read, so the tree does not grow with the sheet.
+                while row.getprevious() is not None:
+                    del row.getparent()[0]
+                yield row_counter, cells
+
+    def iter_rows(self, name, min_row=1, values_only=False):
+        """
+        Yield the rows of a worksheet like ReadOnlyWorksheet.iter_rows after
+        reset_dimensions(): missing rows are empty, and each row runs up to
+        the column of its last stored cell.
+
+        Args:
+            name (str): Sheet name.
+            min_row (int): First row to yield.
+            values_only (bool): Yield values instead of (value, style id) tuples.
+
+        Yields:
+            tuple: Values, or (value, style id) tuples with None for cells that are not stored.
+        """
+        counter = min_row
+        for index, cells in self.cell_rows(name):
+            while counter < index:
+                counter += 1
+                yield ()
+            if counter > index:
+                continue
+            counter += 1
+            if not cells:
+                yield ()
+                continue
+            width = cells[-1][0]
+            row = [None] * width
+            for column, value, style_id in cells:
+                if 1 <= column <= width:
+                    row[column - 1] = value if values_only else (value, style_id)
+            yield tuple(row)
+
+
+class FastWorksheet:
+    """
+    A worksheet of a FastWorkbook with the part of the ReadOnlyWorksheet
+    interface read_reference_tables uses.
+    """
+
+    def __init__(self, book, name):
+        self.book = book
+        self.title = name
+
+    def reset_dimensions(self):
+        pass
+
+    def iter_rows(self, min_row=1, values_only=False):
+        return self.book.iter_rows(self.title, min_row, values_only)
+
+
+class CachedFormula(str):
+    """
+    A formula together with the value it calculates to.
+
+    RowWriter writes it with its value as the cell's cached result, so
+    readers that do not calculate (pandas, openpyxl with data_only=True) see
+    the value instead of an empty cell. openpyxl itself only writes formulas
+    without a value; the values of formula cells of sheets it writes are
+    passed to save_workbook instead. The value is a number or an error code
+    such as '#VALUE!'.
+    """
+
+    def __new__(cls, formula, cached):
+        obj = super().__new__(cls, formula)
+        obj.cached = cached
+        return obj
+
+
+
+_XML_SPECIAL = re.compile(r'[&<>\r]')
+_XML_ESCAPES = {'&': '&amp;', '<': '&lt;', '>': '&gt;', '\r': '&#13;'}
+_COLUMN_LETTERS = [get_column_letter(col) for col in range(1, 16385)]
+_EMPTY_SHEET_DATA = re.compile(rb'<sheetData\s*/>|<sheetData>\s*</sheetData>')
+_COPY_BLOCK = 1024 * 1024
+
+
+def _escape(text):
+    if _XML_SPECIAL.search(text) is None:
+        return text
+    return _XML_SPECIAL.sub(lambda m: _XML_ESCAPES[m.group()], text)
+
+
+def _string_xml(coordinate, style, value):
+    space = ' xml:space="preserve"' if value != value.strip() else ''
+    return f'<c r="{coordinate}"{style} t="inlineStr"><is><t{space}>{_escape(value)}</t></is></c>'
+
+
+def _value_xml(value):
+    # The cached result of a formula, as CachedFormula carries it.
+    if isinstance(value, str):
+        return (' t="e"' if value in ERROR_CODES else ' t="str"'), _escape(value)
+    return '', safe_string(value)
+
+
+class RowWriter:
+    """
+    Serialize worksheet rows the way openpyxl writes them.
+
+    openpyxl builds a Cell for every value of a row, a second one when a
+    write-only sheet is handed ready cells, and writes each through the XML
+    library. The rows of a cost sheet are lists of plain values with style
+    ids looked up once per style, so here each row becomes one string.
+    Values are typed as openpyxl types them; anything but numbers and plain
+    strings goes through an openpyxl Cell. Strings are written inline, so the
+    rows refer to nothing else in the workbook.
+
+    Args:
+        ws (Worksheet): The sheet the rows are for, write-only or not.
+    """
+
+    def __init__(self, ws):
+        self.ws = ws
+
+    def row(self, row, cells):
+        """
+        Serialize one row.
+
+        Args:
+            row (int): Row number.
+            cells (list): (value, style id) per column from A, None where there is no cell.
+
+        Returns:
+            str: The <row> element.
+        """
+        parts = [f'<row r="{row}">']
+        for col, cell in enumerate(cells):
+            if cell is not None:
+                parts.append(self.cell(f'{_COLUMN_LETTERS[col]}{row}', *cell))
+        parts.append('</row>')
+        return ''.join(parts)
+
+    def cell(self, coordinate, value, style_id):
+        """
+        Serialize one cell; style id 0 is the workbook's default style.
+        """
+        style = f' s="{style_id}"' if style_id else ''
+        kind = type(value)
+        if value is None:
+            return f'<c r="{coordinate}"{style} t="n"/>'
+        if kind is float or kind is int:
+            return f'<c r="{coordinate}"{style} t="n"><v>{safe_string(value)}</v></c>'
+        if kind is CachedFormula:
+            if value.cached is None:
+                return f'<c r="{coordinate}"{style}><f>{_escape(value[1:])}</f><v></v></c>'
+            data_type, text = _value_xml(value.cached)
+            return f'<c r="{coordinate}"{style}{data_type}><f>{_escape(value[1:])}</f><v>{text}</v></c>'
+        if kind is str and not (value.startswith('=') or value in ERROR_CODES or len(value) > 32767
+                                or ILLEGAL_CHARACTERS_RE.search(value)):
+            if not value:
+                return f'<c r="{coordinate}"{style} t="inlineStr"/>'
+            return _string_xml(coordinate, style, value)
+        return self._typed_cell(coordinate, style, value)
+
+    def _typed_cell(self, coordinate, style, value):
+        # openpyxl decides the type and converts the value, raising on values it cannot store.
+        cell = Cell(self.ws, value=value)
+        data_type, value = cell.data_type, cell.value
+        if value is None or value == '':
+            return f'<c r="{coordinate}"{style} t="{"inlineStr" if data_type == "s" else data_type}"/>'
+        if data_type == 's':
+            return _string_xml(coordinate, style, str(value))
+        if data_type == 'f':
+            attributes = ''
+            if isinstance(value, (ArrayFormula, DataTableFormula)):
+                attributes = ''.join(f' {key}="{_escape(str(item))}"' for key, item in dict(value).items())
+                value = value.text if isinstance(value, ArrayFormula) else None
+            text = _escape(value[1:]) if value is not None else ''
+            return f'<c r="{coordinate}"{style}><f{attributes}>{text}</f><v></v></c>'
+        if data_type == 'd':
+            if getattr(value, 'tzinfo', None) is not None:
+                raise TypeError("Excel does not support timezones in datetimes. "
+                                "The tzinfo in the datetime/time object must be set to None.")
+            workbook = self.ws.parent
+            if workbook.iso_dates and not isinstance(value, timedelta):
+                return f'<c r="{coordinate}"{style} t="d"><v>{to_ISO8601(value)}</v></c>'
+            return f'<c r="{coordinate}"{style} t="n"><v>{safe_string(to_excel(value, workbook.epoch))}</v></c>'
+        return f'<c r="{coordinate}"{style} t="{data_type}"><v>{_escape(safe_string(value))}</v></c>'
+
+
+class SheetData(RowWriter):
+    """
+    The rows of a worksheet, serialized by RowWriter into a temporary file
+    and put into the package by save_workbook.
+
+    The sheet itself stays empty in openpyxl, which still writes everything
+    around the rows: column widths, merged cells, the title. Rows are
+    numbered from 1 in the order they are appended.
+
+    Args:
+        ws (Worksheet): The sheet the rows are for.
+        path (str, optional): An existing file of rows to take over, e.g. one
+            written in another process; a new temporary file by default.
+    """
+
+    def __init__(self, ws, path=None):
+        super().__init__(ws)
+        self.max_row = 0
+        self.style_map = None
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix='erp-cost.', suffix='.xml')
+            self._file = open(fd, 'w', encoding='utf-8', newline='')
+        else:
+            self._file = None
+        self.path = path
+
+    def append(self, cells):
+        """
+        Write the next row, see RowWriter.row.
+        """
+        self.max_row += 1
+        self._file.write(self.row(self.max_row, cells))
+
+    def close(self):
+        """
+        Finish writing; the file stays until discard.
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def discard(self):
+        """
+        Close and remove the file.
+        """
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def copy_to(self, target):
+        """
+        Copy the rows into an open package part.
+
+        With style_map set ({style id in the file: style id to write}), the
+        s attributes are renumbered on the way, e.g. for rows written in
+        another process against another workbook's styles.
+        """
+        self.close()
+        style_map = self.style_map
+        rest = b''
+        with open(self.path, 'rb') as f:
+            for block in iter(lambda: f.read(_COPY_BLOCK), b''):
+                if style_map is None:
+                    target.write(block)
+                    continue
+                # Cut after the last '>' so no tag is split between blocks.
+                data = rest + block
+                end = data.rfind(b'>') + 1
+                data, rest = data[:end], data[end:]
+                target.write(_CELL_STYLE.sub(lambda m: b'%s s="%d"' % (m.group(1), style_map[int(m.group(2))]),
+                                             data))
+        target.write(rest)
+
+
+# RowWriter always writes the style right after the coordinate.
+_CELL_STYLE = re.compile(rb'(<c r="[A-Z]+[0-9]+") s="([0-9]+)"')
+
+
+_FORMULA_CELL = re.compile(rb'<c\b([^>]*)>(<f\b[^>]*>[^<]*</f>)\s*(?:<v\s*/>|<v>[^<]*</v>)?\s*</c>')
+_COORDINATE = re.compile(rb'\br="([^"]*)"')
+_DATA_TYPE = re.compile(rb'\st="[^"]*"')
+
+
+def _fill_cached_values(source, target, values):
+    # Rewrite the formula cells of an openpyxl worksheet part whose values are
+    # known, a few rows at a time; the attributes are read in any order.
+    def fill(match):
+        coordinate = _COORDINATE.search(match.group(1))
+        value = values.get(coordinate.group(1).decode('ascii')) if coordinate is not None else None
+        if value is None:
+            return match.group(0)
+        data_type, text = _value_xml(value)
+        attributes = _DATA_TYPE.sub(b'', match.group(1)) + data_type.encode('ascii')
+        return b'<c%s>%s<v>%s</v></c>' % (attributes, match.group(2), text.encode('utf-8'))
+
+    rest = b''
+    for block in iter(lambda: source.read(_COPY_BLOCK), b''):
+        data = rest + block
+        end = data.rfind(b'</row>')
+        if end < 0:
+            rest = data
+            continue
+        end += len(b'</row>')
+        target.write(_FORMULA_CELL.sub(fill, data[:end]))
+        rest = data[end:]
+    target.write(_FORMULA_CELL.sub(fill, rest))
+
+
+def replace_rows(source, target, rows):
+    """
+    Copy a worksheet part written with RowWriter rows, replacing some of the rows.
+
+    The part is copied a few rows at a time; a row is found by its start
+    tag as RowWriter writes it, without parsing the other rows.
+
+    Args:
+        source (file): The part to read, open in binary mode.
+        target (file): Where to write the new part.
+        rows (dict): Row number -> the new <row> element, as bytes.
+
+    Raises:
+        ValueError: A row to replace is not in the part.
+    """
+    pending = sorted(rows)
+    rest = b''
+    for block in iter(lambda: source.read(_COPY_BLOCK), b''):
+        data = rest + block
+        end = data.rfind(b'</row>')
+        if end < 0:
+            rest = data
+            continue
+        end += len(b'</row>')
+        data, rest = data[:end], data[end:]
+        start = 0
+        while pending:
+            found = data.find(b'<row r="%d">' % pending[0], start)
+            if found < 0:
+                break
+            close = data.index(b'</row>', found) + len(b'</row>')
+            target.write(data[start:found])
+            target.write(rows[pending.pop(0)])
+            start = close
+        target.write(data[start:])
+    target.write(rest)
+    if pending:
+        raise ValueError(f'工作表中找不到第 {pending[0]} 列')
+
+
+def save_workbook(wb, path, rows=(), cached=None):
+    """
+    Save a workbook with the rows of SheetData objects in their sheets and
+    the values of formula cells openpyxl wrote without them.
+
+    openpyxl saves the workbook into memory first, with the sheets of rows
+    empty; the package is then written once more with the rows copied in.
+
+    Args:
+        wb (Workbook): The workbook.
+        path (str): Output path.
+        rows (list): SheetData of sheets of wb, whose openpyxl sheets hold no cells.
+        cached (dict, optional): Worksheet -> {coordinate: value} of formula cells written by openpyxl.
+    """
+    skeleton = BytesIO()
+    wb.save(skeleton)
+    try:
+        with zipfile.ZipFile(skeleton) as source, \
+                zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as target:
+            parts = sheet_parts(source)
+            row_parts = {parts[data.ws.title]: data for data in rows}
+            cached_parts = {parts[ws.title]: values for ws, values in (cached or {}).items()}
+            for info in source.infolist():
+                name = info.filename
+                if name in row_parts:
+                    sheet = source.read(name)
+                    empty = _EMPTY_SHEET_DATA.search(sheet)
+                    if empty is None:
+                        raise ValueError(f'工作表 {row_parts[name].ws.title} 已有儲存格，無法寫入列資料')
+                    with target.open(name, 'w', force_zip64=True) as f:
+                        f.write(sheet[:empty.start()])
+                        f.write(b'<sheetData>')
+                        row_parts[name].copy_to(f)
+                        f.write(b'</sheetData>')
+                        f.write(sheet[empty.end():])
+                elif name in cached_parts:
+                    with source.open(name) as src, target.open(name, 'w', force_zip64=True) as f:
+                        _fill_cached_values(src, f, cached_parts[name])
+                else:
+                    target.writestr(info, source.read(name))
+    except BaseException:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
@@ -0,0 +1,12 @@
+"""
+Benchmarks for the cost pipeline.
+
+Run from the repository root, e.g. ``python -m benchmarks.run --rows 1000 10000``.
+The modules under app/ import each other by bare name, so app/ is put on sys.path here.
+"""
+import os
+import sys
+
+APP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app')
+if APP_DIR not in sys.path:
+    sys.path.insert(0, APP_DIR)
@@ -0,0 +1,186 @@
+"""
+Synthetic ERP workbooks for benchmarking.
+
+Writes the four sheets the pipeline reads: 標準成本結構表 with products and
+their 。-nested parts, plus the three reference sheets, sized so that every
+generated BOM row finds its coefficient, price and 米數.
+"""
+import argparse
+import random
+
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, PatternFill
+
+from . import APP_DIR  # noqa: F401  (puts app/ on sys.path)
+from loader import BASE_SHEET
+from reference import WEIGHT_SHEET, MATERIAL_SHEET, MM_SHEET
+
+KNOWN_MATERIALS = ['SS400', 'SUS304', 'SUS316', 'AL5052', 'SPCC', 'SECC', 'SPHC', 'S45C', 'AL6061', 'SUS430']
+KNOWN_THICKNESSES = [0.5, 0.8, 1, 1.2, 1.5, 2, 2.5, 3, 4, 4.5, 5, 6, 8, 9, 10, 12, 15, 16, 19, 20, 22, 25, 30]
+PROCESSES = ['雷射', '折彎', '焊接', '研磨', '烤漆', '電鍍', '攻牙', '組立']
+
+HIGHLIGHT_FONT = Font(bold=True, color='FF0000')
+HIGHLIGHT_FILL = PatternFill(fill_type='solid', start_color='FFFF00', end_color='FFFF00')
+
+
+def material_names(count):
+    """
+    Get `count` material names, common grades first, then MAT001, MAT002, ...
+    """
+    names = KNOWN_MATERIALS[:count]
+    names += [f'MAT{i:03d}' for i in range(1, count - len(names) + 1)]
+    return names
+
+
+def thickness_values(count):
+    """
+    Get `count` increasing sheet thicknesses, common gauges first, then every 5 mm above.
+    """
+    values = KNOWN_THICKNESSES[:count]
+    while len(values) < count:
+        values.append(values[-1] + 5)
+    return values
+
+
+def _cell(ws, value, font=None, fill=None):
+    cell = WriteOnlyCell(ws, value=value)
+    if font is not None:
+        cell.font = font
+    if fill is not None:
+        cell.fill = fill
+    return cell
+
+
+def base_rows(ws, rnd, rows, depth, products, materials, thicknesses, blank_ratio, styled_ratio):
+    """
+    Yield the rows of 標準成本結構表: four header rows, then products, each a
+    parent row followed by parts nested up to `depth` levels of 。.
+    """
+    yield ['標準成本結構表']
+    yield ['列印日期', '2024/01/01']
+    yield []
+    yield ['品號', '品名', '規格', '材質', '厚度', '長', '寬', '用量', '其它費用']
+
+    per_product = [rows // products + (1 if i < rows % products else 0) for i in range(products)]
+    for p, count in enumerate(per_product):
+        if count == 0:
+            continue
+        yield [f'P{p + 1:05d}', f'機台組件{p + 1}型 標準版', f'SPEC-{p + 1}']
+        level = 1
+        for c in range(count - 1):
+            level = rnd.randint(1, min(level + 1, depth))
+            row = [f"{'。' * level}{p + 1:05d}-{c + 1:05d}", f'零件{c + 1}', f'{rnd.choice(PROCESSES)}件']
+            if rnd.random() >= blank_ratio:
+                thickness = rnd.choice(thicknesses)
+                row += [
+                    rnd.choice(materials),
+                    str(thickness) if rnd.random() < 0.5 else thickness,
+                    rnd.randint(10, 2400),
+                    rnd.randint(10, 1200) + (0.5 if rnd.random() < 0.2 else 0),
+                ]
+            else:
+                row += [None, None, None, None]
+            row += [rnd.choice([1, 2, 4, 0.5]), rnd.choice([None, None, 3, 12.5])]
+
+            if rnd.random() < styled_ratio:
+                row = [_cell(ws, v, font=HIGHLIGHT_FONT) if i == 1 else
+                       _cell(ws, v, fill=HIGHLIGHT_FILL) if i == 3 else v
+                       for i, v in enumerate(row)]
+            yield row
+
+
+def generate_workbook(path, rows=1000, depth=3, materials=6, thicknesses=12, price_rows=None,
+                      products=None, blank_ratio=0.1, styled_ratio=0.2, seed=0):
+    """
+    Write a synthetic input workbook.
+
+    Args:
+        path (str): Output .xlsx path.
+        rows (int): Number of BOM rows in 標準成本結構表, parents included.
+        depth (int): Deepest 。 nesting level of parts.
+        materials (int): Number of materials used by the BOM.
+        thicknesses (int): Number of thicknesses per material in the price tables.
+        price_rows (int, optional): Total rows of 鐵板材料費單價; rows beyond
+            materials * thicknesses are filled with unused materials.
+        products (int, optional): Number of parent products, defaults to one per 1000 rows.
+        blank_ratio (float): Share of parts without material data (no cost calculated).
+        styled_ratio (float): Share of parts with a highlighted font and fill.
+        seed (int): Random seed, the same arguments always give the same workbook.
+
+    Returns:
+        dict: The parameters used, for recording next to benchmark results.
+    """
+    rnd = random.Random(seed)
+    products = products or max(1, rows // 1000)
+    material_list = material_names(materials)
+    thickness_list = thickness_values(thicknesses)
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(BASE_SHEET)
+    for row in base_rows(ws, rnd, rows, max(depth, 1), products, material_list,
+                         thickness_list, blank_ratio, styled_ratio):
+        ws.append(row)
+
+    ws = wb.create_sheet(WEIGHT_SHEET)
+    ws.append(['項次', '材質', '密度', '', '', '係數'])
+    for i, material in enumerate(material_list):
+        ws.append([i + 1, material, round(rnd.uniform(2.6, 8.0), 2), None, None,
+                   round(rnd.uniform(0.0000026, 0.0000080), 10)])
+
+    ws = wb.create_sheet(MATERIAL_SHEET)
+    ws.append(['項次', '供應商', '材質', '厚度', '單價'])
+    count = 0
+    for material in material_list:
+        for thickness in thickness_list:
+            count += 1
+            ws.append([count, '供應商A', material, thickness, round(rnd.uniform(20, 120), 3)])
+    filler = 0
+    while price_rows is not None and count < price_rows:
+        filler += 1
+        for thickness in thickness_list:
+            if count >= price_rows:
+                break
+            count += 1
+            ws.append([count, '供應商B', f'OLD{filler:03d}', thickness, round(rnd.uniform(20, 120), 3)])
+
+    ws = wb.create_sheet(MM_SHEET)
+    ws.append(['材質', '厚度', '', '', '', '米數'])
+    for material in material_list:
+        previous = None
+        for thickness in thickness_list:
+            if previous is not None and rnd.random() < 0.3:
+                label = f'{previous}-{thickness}T'
+            else:
+                label = f'{thickness}T'
+            ws.append([material, label, None, None, None, round(rnd.uniform(1, 12), 2)])
+            previous = thickness
+
+    wb.save(path)
+    return {
+        'rows': rows, 'depth': depth, 'materials': materials, 'thicknesses': thicknesses,
+        'price_rows': max(count, price_rows or 0), 'products': products,
+        'blank_ratio': blank_ratio, 'styled_ratio': styled_ratio, 'seed': seed,
+    }
+
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description='產生測試用的 ERP 成本結構表')
+    parser.add_argument('output', help='輸出 Excel 檔案路徑')
+    parser.add_argument('--rows', type=int, default=1000, help='標準成本結構表的列數')
+    parser.add_argument('--depth', type=int, default=3, help='BOM 最大階層數（。的個數）')
+    parser.add_argument('--materials', type=int, default=6, help='材質種類數')
+    parser.add_argument('--thicknesses', type=int, default=12, help='每種材質的厚度數')
+    parser.add_argument('--price-rows', type=int, default=None, help='鐵板材料費單價的總列數')
+    parser.add_argument('--products', type=int, default=None, help='母件數（預設每 1000 列一個）')
+    parser.add_argument('--seed', type=int, default=0, help='亂數種子')
+    args = parser.parse_args(argv)
+
+    generate_workbook(args.output, rows=args.rows, depth=args.depth, materials=args.materials,
+                      thicknesses=args.thicknesses, price_rows=args.price_rows,
+                      products=args.products, seed=args.seed)
+    print(f'已產生 {args.output}')
+
+
+if __name__ == '__main__':
+    cli()
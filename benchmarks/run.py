@@ -0,0 +1,313 @@
+"""
+Time the phases of main.main on synthetic workbooks and check for regressions.
+
+Each case runs in a fresh process so its peak memory is its own. Results are
+written as JSON; pass an earlier result file as --baseline to fail the run
+when a phase got slower or used more memory than the thresholds allow.
+With --verify, the outputs of the input readers and cost engines are
+compared cell by cell instead.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import openpyxl
+from openpyxl.utils import get_column_letter
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+from . import APP_DIR
+from .generate import generate_workbook
+
+import instrument
+import main
+import stream
+
+MODES = ('classic', 'write_only', 'stream')
+DEFAULT_ROWS = (1000, 10000)
+DEFAULT_TIME_THRESHOLD = 1.25  # fail when a phase takes 25% longer than the baseline
+DEFAULT_MEMORY_THRESHOLD = 1.25
+MIN_SECONDS = 0.05  # phases faster than this are too noisy to compare
+# (fast_reader, engine) of the runs --verify compares; the first is the reference.
+VERIFY_VARIANTS = ((False, 'python'), (True, 'python'), (False, 'pandas'), (True, 'pandas'))
+MAX_REPORTED_DIFFERENCES = 10
+
+
+def run_case(input_path, mode, trace_memory=False):
+    """
+    Run main.main once on one workbook in the current process and collect its measurements.
+
+    Args:
+        input_path (str): Generated input workbook.
+        mode (str): One of MODES.
+        trace_memory (bool): Also record the Python heap peak of each phase with
+            tracemalloc. Slows the run down, so the timings are less comparable.
+
+    Returns:
+        dict: See instrument.RunMetrics.as_dict.
+    """
+    metrics = instrument.RunMetrics(trace_memory)
+    if trace_memory:
+        tracemalloc.start()
+    fd, output_path = tempfile.mkstemp(suffix='.xlsx')
+    os.close(fd)
+    try:
+        return main.main(input_path, output_path, write_only=(mode != 'classic'), use_cache=False,
+                         metrics=metrics, log=False,
+                         chunk_size=stream.DEFAULT_CHUNK_SIZE if mode == 'stream' else None)
+    finally:
+        os.remove(output_path)
+        if trace_memory:
+            tracemalloc.stop()
+
+
+def run_isolated(input_path, mode, trace_memory=False):
+    """
+    Run a case in a fresh worker process, so imports, caches and peak memory start clean.
+    """
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+        return executor.submit(run_case, input_path, mode, trace_memory).result()
+
+
+def sheet_values(path, data_only=False):
+    """
+    Read every cell value of a workbook.
+
+    Args:
+        path (str): Workbook path.
+        data_only (bool): Read the cached values of formula cells instead of the formulas.
+
+    Returns:
+        dict: Sheet title -> list of row value tuples.
+    """
+    wb = openpyxl.load_workbook(path, read_only=True, data_only=data_only)
+    try:
+        return {ws.title: list(ws.iter_rows(values_only=True)) for ws in wb.worksheets}
+    finally:
+        wb.close()
+
+
+def compare_outputs(expected_path, actual_path):
+    """
+    Compare the cell values of two outputs, both the formulas and their cached values.
+
+    Returns:
+        list: One message per differing cell or sheet, empty when they match.
+    """
+    differences = []
+    for data_only in (False, True):
+        expected, actual = sheet_values(expected_path, data_only), sheet_values(actual_path, data_only)
+        if list(expected) != list(actual):
+            differences.append(f'工作表不同: {list(expected)} != {list(actual)}')
+            return differences
+        for title, expected_rows in expected.items():
+            actual_rows = actual[title]
+            for row in range(max(len(expected_rows), len(actual_rows))):
+                old = expected_rows[row] if row < len(expected_rows) else ()
+                new = actual_rows[row] if row < len(actual_rows) else ()
+                for col in range(max(len(old), len(new))):
+                    old_value = old[col] if col < len(old) else None
+                    new_value = new[col] if col < len(new) else None
+                    if old_value != new_value:
+                        coordinate = f'{get_column_letter(col + 1)}{row + 1}'
+                        differences.append(f"{title}!{coordinate}{'（值）' if data_only else ''}: "
+                                           f'{old_value!r} != {new_value!r}')
+    return differences
+
+
+def run_verify(rows_list=DEFAULT_ROWS, workbook_options=None, work_dir=None):
+    """
+    Build each generated workbook with every reader and engine of VERIFY_VARIANTS
+    and compare the outputs with the first one.
+
+    Args:
+        rows_list (iterable): Row counts of the generated workbooks.
+        workbook_options (dict, optional): Extra generate_workbook arguments.
+        work_dir (str, optional): Where to keep the generated workbooks and outputs,
+            a temporary directory by default.
+
+    Returns:
+        list: One message per difference, empty when every output matches.
+    """
+    workbook_options = workbook_options or {}
+    failures = []
+    with tempfile.TemporaryDirectory() as tmp:
+        work_dir = work_dir or tmp
+        os.makedirs(work_dir, exist_ok=True)
+        for rows in rows_list:
+            input_path = os.path.join(work_dir, f'bench-{rows}.xlsx')
+            generate_workbook(input_path, rows=rows, **workbook_options)
+            outputs = []
+            for fast_reader, engine in VERIFY_VARIANTS:
+                name = f"{'fast_reader' if fast_reader else 'openpyxl'}-{engine}"
+                output_path = os.path.join(work_dir, f'verify-{rows}-{name}.xlsx')
+                main.main(input_path, output_path, engine=engine, use_cache=False, log=False,
+                          fast_reader=fast_reader)
+                outputs.append((name, output_path))
+            (reference_name, reference_path), *others = outputs
+            for name, output_path in others:
+                differences = compare_outputs(reference_path, output_path)
+                if differences:
+                    failures.append(f'{rows} 列 {name} 與 {reference_name} 有 {len(differences)} 處不同')
+                    failures.extend(f'  {message}' for message in differences[:MAX_REPORTED_DIFFERENCES])
+                print(f"{rows:>7} 列 {name}: {'不一致' if differences else '一致'}", file=sys.stderr)
+    return failures
+
+
+def git_revision():
+    """
+    Get the current commit of the repository, or None outside a git checkout.
+    """
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=APP_DIR,
+                             capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return out.stdout.strip() or None
+
+
+def run_benchmarks(rows_list=DEFAULT_ROWS, modes=MODES, repeat=1, workbook_options=None,
+                   trace_memory=False, work_dir=None):
+    """
+    Generate a workbook per row count and time every mode on it.
+
+    Args:
+        rows_list (iterable): Row counts of the generated workbooks.
+        modes (iterable): Modes to run, see MODES.
+        repeat (int): Runs per case; the fastest total is kept.
+        workbook_options (dict, optional): Extra generate_workbook arguments.
+        trace_memory (bool): See run_case.
+        work_dir (str, optional): Where to keep the generated workbooks, a temporary directory by default.
+
+    Returns:
+        dict: Environment info and a list of cases.
+    """
+    workbook_options = workbook_options or {}
+    cases = []
+    with tempfile.TemporaryDirectory() as tmp:
+        work_dir = work_dir or tmp
+        os.makedirs(work_dir, exist_ok=True)
+        for rows in rows_list:
+            input_path = os.path.join(work_dir, f'bench-{rows}.xlsx')
+            params = generate_workbook(input_path, rows=rows, **workbook_options)
+            for mode in modes:
+                runs = [run_isolated(input_path, mode, trace_memory) for _ in range(max(repeat, 1))]
+                best = min(runs, key=lambda r: r['seconds'])
+                best['peak_rss_mb'] = max((r['peak_rss_mb'] or 0) for r in runs) or None
+                cases.append({'name': f'{mode}-{rows}', 'mode': mode, 'workbook': params, **best})
+                print(f"{mode:>10} {rows:>7} 列: {best['seconds']:.2f} 秒 "
+                      + ' '.join(f"{name}={seconds:.2f}" for name, seconds in best['phases'].items()
+                                 if '.' not in name),
+                      file=sys.stderr)
+
+    return {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'trace_memory': trace_memory,
+        'cases': cases,
+    }
+
+
+def compare(results, baseline, time_threshold=DEFAULT_TIME_THRESHOLD,
+            memory_threshold=DEFAULT_MEMORY_THRESHOLD, min_seconds=MIN_SECONDS):
+    """
+    Compare results with a baseline run.
+
+    Args:
+        results (dict): Output of run_benchmarks.
+        baseline (dict): An earlier output of run_benchmarks.
+        time_threshold (float): Allowed ratio of new to old time per phase and in total.
+        memory_threshold (float): Allowed ratio of new to old peak memory.
+        min_seconds (float): Phases below this time in both runs are not compared.
+
+    Returns:
+        list: One message per regression, empty when there is none.
+    """
+    old_cases = {case['name']: case for case in baseline.get('cases', [])}
+    regressions = []
+    for case in results['cases']:
+        old = old_cases.get(case['name'])
+        if old is None:
+            continue
+        timings = [('total', case['seconds'], old['seconds'])]
+        for name, seconds in case['phases'].items():
+            if name in old['phases']:
+                timings.append((name, seconds, old['phases'][name]))
+        for name, new, before in timings:
+            if max(new, before) < min_seconds:
+                continue
+            if new > before * time_threshold:
+                regressions.append(f"{case['name']} {name}: {before:.3f}s -> {new:.3f}s ({new / before:.2f}x)")
+        new_mem, old_mem = case.get('peak_rss_mb'), old.get('peak_rss_mb')
+        if new_mem and old_mem and new_mem > old_mem * memory_threshold:
+            regressions.append(f"{case['name']} peak_rss_mb: {old_mem:.1f} -> {new_mem:.1f} ({new_mem / old_mem:.2f}x)")
+    return regressions
+
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description='量測 main.main 各階段的耗時與記憶體')
+    parser.add_argument('--rows', type=int, nargs='+', default=list(DEFAULT_ROWS), help='測試檔的列數，可指定多個')
+    parser.add_argument('--mode', choices=MODES + ('all',), default='all', help='量測的輸出方式')
+    parser.add_argument('--repeat', type=int, default=1, help='每個案例重複次數，取最快的一次')
+    parser.add_argument('--depth', type=int, default=3, help='BOM 最大階層數')
+    parser.add_argument('--materials', type=int, default=6, help='材質種類數')
+    parser.add_argument('--thicknesses', type=int, default=12, help='每種材質的厚度數')
+    parser.add_argument('--price-rows', type=int, default=None, help='鐵板材料費單價的總列數')
+    parser.add_argument('--seed', type=int, default=0, help='亂數種子')
+    parser.add_argument('--trace-memory', action='store_true', help='以 tracemalloc 記錄各階段的記憶體高峰（較慢）')
+    parser.add_argument('--work-dir', default=None, help='保留產生的測試檔的資料夾')
+    parser.add_argument('-o', '--output', default=None, help='結果 JSON 檔路徑（預設輸出到標準輸出）')
+    parser.add_argument('--baseline', default=None, help='用來比較的先前結果 JSON 檔')
+    parser.add_argument('--time-threshold', type=float, default=DEFAULT_TIME_THRESHOLD,
+                        help='允許的耗時倍數，超過即視為退步')
+    parser.add_argument('--memory-threshold', type=float, default=DEFAULT_MEMORY_THRESHOLD,
+                        help='允許的記憶體高峰倍數，超過即視為退步')
+    parser.add_argument('--min-seconds', type=float, default=MIN_SECONDS, help='低於此秒數的階段不比較')
+    parser.add_argument('--verify', action='store_true',
+                        help='不量測效能，改為比較兩種讀取方式與兩種計算引擎的輸出是否逐格一致')
+    args = parser.parse_args(argv)
+
+    modes = MODES if args.mode == 'all' else (args.mode,)
+    workbook_options = {'depth': args.depth, 'materials': args.materials, 'thicknesses': args.thicknesses,
+                        'price_rows': args.price_rows, 'seed': args.seed}
+    if args.verify:
+        failures = run_verify(args.rows, workbook_options, args.work_dir)
+        if failures:
+            print('輸出不一致：', file=sys.stderr)
+            for message in failures:
+                print(f'  {message}', file=sys.stderr)
+            return 1
+        print('各讀取方式與計算引擎的輸出一致', file=sys.stderr)
+        return 0
+    results = run_benchmarks(args.rows, modes, args.repeat, workbook_options, args.trace_memory, args.work_dir)
+
+    text = json.dumps(results, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.time_threshold, args.memory_threshold, args.min_seconds)
+        if regressions:
+            print('效能退步：', file=sys.stderr)
+            for message in regressions:
+                print(f'  {message}', file=sys.stderr)
+            return 1
+        print('與基準相比沒有退步', file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(cli())
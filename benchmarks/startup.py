@@ -0,0 +1,172 @@
+"""
+Measure the cold start of the desktop app and check it against a target.
+
+Each run starts app/app.py in a fresh process under ``python -X importtime``
+with ERP_COST_STARTUP_PROBE set, so the app draws its window once and quits.
+The time from starting the process to the drawn window is the
+time-to-first-window; the import timings show what was loaded before it.
+The calculation modules (openpyxl, NumPy, pandas, lxml) are meant to be
+imported only after the window is shown, so finding one of them fails the run.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+from . import APP_DIR
+from .run import git_revision
+
+APP_SCRIPT = os.path.join(APP_DIR, 'app.py')
+WINDOW_MARKER = 'window shown'
+DEFAULT_TARGET = 1.5  # seconds from process start to the first drawn window
+DEFAULT_REPEAT = 3
+DEFERRED_MODULES = ('openpyxl', 'numpy', 'pandas', 'lxml')
+SLOWEST_IMPORTS = 15
+
+
+def parse_importtime(text):
+    """
+    Parse the output of ``-X importtime``.
+
+    Args:
+        text (str): stderr of the process.
+
+    Returns:
+        tuple: (imports, other lines); imports are dicts with module, depth
+               (0 for imports made by the script itself or by startup),
+               self_ms and cumulative_ms, in the order they finished.
+    """
+    imports = []
+    other = []
+    for line in text.splitlines():
+        if not line.startswith('import time:'):
+            other.append(line)
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue  # the header line
+        name = fields[2].rstrip()
+        stripped = name.lstrip(' ')
+        imports.append({
+            'module': stripped,
+            'depth': (len(name) - len(stripped) - 1) // 2,
+            'self_ms': int(fields[0]) / 1000,
+            'cumulative_ms': int(fields[1]) / 1000,
+        })
+    return imports, other
+
+
+def run_once(timeout=60):
+    """
+    Start the app once and time its first window.
+
+    Returns:
+        dict: window_seconds (None when no window could be shown), import_ms
+              (all imports before the window), deferred (DEFERRED_MODULES that
+              were imported), slowest (the slowest top-level imports) and error.
+    """
+    env = {**os.environ, 'ERP_COST_STARTUP_PROBE': '1'}
+    # stderr goes to a file: the import timings can fill a pipe while stdout is read.
+    with tempfile.TemporaryFile('w+', encoding='utf-8', errors='replace') as err:
+        start = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, '-X', 'importtime', APP_SCRIPT], cwd=APP_DIR, env=env,
+                                stdout=subprocess.PIPE, stderr=err, text=True)
+        window_seconds = None
+        try:
+            for line in proc.stdout:
+                if line.strip() == WINDOW_MARKER and window_seconds is None:
+                    window_seconds = time.perf_counter() - start
+            proc.wait(timeout=timeout)
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+        err.seek(0)
+        imports, other = parse_importtime(err.read())
+
+    top_level = [item for item in imports if item['depth'] == 0]
+    loaded = {item['module'].split('.')[0] for item in imports}
+    return {
+        'window_seconds': window_seconds,
+        'import_ms': sum(item['cumulative_ms'] for item in top_level),
+        'deferred': [name for name in DEFERRED_MODULES if name in loaded],
+        'slowest': sorted(top_level, key=lambda item: -item['cumulative_ms'])[:SLOWEST_IMPORTS],
+        'error': '\n'.join(other[-5:]) if proc.returncode else None,
+    }
+
+
+def run_startup(repeat=DEFAULT_REPEAT):
+    """
+    Start the app `repeat` times; the first run is the coldest.
+
+    Returns:
+        dict: Environment info, every run, and the fastest window time as best_window_seconds.
+    """
+    runs = []
+    for i in range(max(repeat, 1)):
+        result = run_once()
+        runs.append(result)
+        window = result['window_seconds']
+        print(f"第 {i + 1} 次：視窗 {'-' if window is None else f'{window:.2f} 秒'}，"
+              f"啟動時匯入 {result['import_ms']:.0f} ms", file=sys.stderr)
+    windows = [r['window_seconds'] for r in runs if r['window_seconds'] is not None]
+    return {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'best_window_seconds': min(windows) if windows else None,
+        'runs': runs,
+    }
+
+
+def check(results, target=DEFAULT_TARGET):
+    """
+    Compare a startup measurement with the target.
+
+    Returns:
+        list: One message per problem, empty when the startup is within target.
+    """
+    problems = []
+    deferred = sorted({name for run in results['runs'] for name in run['deferred']})
+    if deferred:
+        problems.append(f"視窗顯示前就匯入了 {', '.join(deferred)}")
+    best = results['best_window_seconds']
+    if best is None:
+        error = next((run['error'] for run in results['runs'] if run['error']), None)
+        problems.append(f'無法顯示視窗（需要圖形環境與 ttkbootstrap）：{error}')
+    elif best > target:
+        problems.append(f'視窗顯示需要 {best:.2f} 秒，超過目標 {target:.2f} 秒')
+    return problems
+
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description='量測桌面程式從啟動到顯示視窗的時間與啟動時的模組匯入')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help='啟動次數，取最快的一次與目標比較')
+    parser.add_argument('--target', type=float, default=DEFAULT_TARGET, help='顯示視窗的目標秒數')
+    parser.add_argument('-o', '--output', default=None, help='結果 JSON 檔路徑（預設輸出到標準輸出）')
+    args = parser.parse_args(argv)
+
+    results = run_startup(args.repeat)
+    text = json.dumps(results, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    problems = check(results, args.target)
+    if problems:
+        for message in problems:
+            print(message, file=sys.stderr)
+        return 1
+    print(f"視窗顯示需要 {results['best_window_seconds']:.2f} 秒，在目標 {args.target:.2f} 秒內", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(cli())